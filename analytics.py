@@ -0,0 +1,240 @@
+# analytics.py
+
+import argparse
+import sys
+
+import numpy as np
+import pandas as pd
+
+TRADING_DAYS_PER_YEAR = 252
+# Upper bound on the (resamples x groups) running state the bootstrap
+# steps through the days at once, in cells
+BOOTSTRAP_BLOCK_CELLS = 1024 ** 2
+# Columns that identify a run in the tables the repo writes: sweep trade
+# tables carry config_id, exported trade logs a strategy column
+GROUP_COLUMNS = ('config_id', 'strategy')
+
+
+def default_groups(trades):
+    return [col for col in GROUP_COLUMNS if col in trades.columns][:1]
+
+
+class DailyPnl:
+    """Daily P&L of many runs as one (groups x days) array.
+
+    Built from trade log rows (``OptionBacktester.run``, the CSV exported
+    from a trade log, or a ``sweep.run_sweep`` table), ``values[g, d]`` is
+    the summed P&L of group g on ``dates[d]``, 0 on days it did not trade.
+    ``groups`` is a frame with the group columns, one row per group. Every
+    statistic below is computed for all groups at once along the day axis,
+    so thousands of sweep configs cost about as much as one.
+
+    Rows with a missing (NaN) pnl are left out altogether, from the P&L and
+    the trade counts alike, rather than counted as flat trades: one unknown
+    P&L would otherwise make its whole day, and every total and drawdown
+    after it, NaN. ``dropped`` is how many rows that was.
+    """
+
+    def __init__(self, groups, dates, values, trades=None, wins=None, dropped=0):
+        self.groups = groups
+        self.dates = dates
+        self.values = values
+        self.trades = trades
+        self.wins = wins
+        self.dropped = dropped
+
+    @classmethod
+    def from_trades(cls, trades, by=None, dates=None):
+        # `by`: group columns (default: config_id or strategy, if present).
+        # `dates`: the days to cover, e.g. runner.trading_days(...), so days
+        # with no trades count as flat days; by default the traded days.
+        by = default_groups(trades) if by is None else list(by)
+        day = trades['date'].astype(str).to_numpy()
+        if dates is None:
+            d, dates = pd.factorize(day, sort=True)
+            dates = pd.Index(dates)
+        else:
+            dates = pd.Index(np.asarray(dates, dtype=str))
+            d = dates.get_indexer(day)
+        pnl = trades['pnl'].to_numpy(dtype=float)
+        known = ~np.isnan(pnl)
+        keep = (d >= 0) & known
+        if by:
+            codes = trades.groupby(by, dropna=False, sort=True).ngroup().to_numpy()
+            groups = (trades[by].assign(_g=codes).drop_duplicates('_g').sort_values('_g')
+                      .drop(columns='_g').reset_index(drop=True))
+        else:
+            codes = np.zeros(len(trades), dtype=np.intp)
+            groups = pd.DataFrame(index=range(1 if len(trades) else 0))
+        shape = (len(groups), len(dates))
+        cells = np.ravel_multi_index((codes[keep], d[keep]), shape) if keep.any() else np.zeros(0, dtype=np.intp)
+        size = shape[0] * shape[1]
+        values = np.bincount(cells, weights=pnl[keep], minlength=size).reshape(shape)
+        counts = np.bincount(cells, minlength=size).reshape(shape)
+        wins = np.bincount(cells, weights=(pnl[keep] > 0), minlength=size).reshape(shape)
+        return cls(groups, dates, values, counts, wins, dropped=int((~known).sum()))
+
+    def equity(self):
+        return np.cumsum(self.values, axis=1)
+
+    def drawdown(self):
+        # Distance below the running peak of equity (counting the flat start),
+        # <= 0
+        equity = self.equity()
+        return equity - np.maximum(np.maximum.accumulate(equity, axis=1), 0.0)
+
+    def max_drawdown(self):
+        # Deepest drawdown of each group, as a positive amount
+        return max_drawdown(self.values)
+
+    def frame(self):
+        # Tidy (group columns..., date, pnl, trades, equity, drawdown) rows
+        rows = self.groups.loc[np.repeat(np.arange(len(self.groups)), len(self.dates))].reset_index(drop=True)
+        rows['date'] = np.tile(self.dates.to_numpy(), len(self.groups))
+        rows['pnl'] = self.values.ravel()
+        if self.trades is not None:
+            rows['trades'] = self.trades.ravel()
+        rows['equity'] = self.equity().ravel()
+        rows['drawdown'] = self.drawdown().ravel()
+        return rows
+
+    def summary(self):
+        # One row per group: totals, win rate, daily risk and the drawdown,
+        # best total first; the index is the group's row in `values`
+        values = self.values
+        days = values.shape[1]
+        std = values.std(axis=1, ddof=1) if days > 1 else np.full(len(values), np.nan)
+        summary = self.groups.copy()
+        summary['total_pnl'] = values.sum(axis=1)
+        summary['avg_daily_pnl'] = values.mean(axis=1) if days else np.nan
+        summary['days'] = days
+        if self.trades is not None:
+            trades = self.trades.sum(axis=1)
+            summary['trades'] = trades
+            with np.errstate(divide='ignore', invalid='ignore'):
+                summary['win_rate'] = self.wins.sum(axis=1) / trades
+        summary['best_day'] = values.max(axis=1) if days else np.nan
+        summary['worst_day'] = values.min(axis=1) if days else np.nan
+        with np.errstate(divide='ignore', invalid='ignore'):
+            summary['sharpe'] = summary['avg_daily_pnl'] / std * np.sqrt(TRADING_DAYS_PER_YEAR)
+        summary['max_drawdown'] = self.max_drawdown()
+        return summary.sort_values('total_pnl', ascending=False, kind='stable')
+
+    def bootstrap(self, n=10000, seed=0, confidence=0.95, block=1):
+        # Confidence intervals from n resampled histories, every group at
+        # once. Days are drawn with replacement in runs of `block` days and
+        # the same draws are used for every group, so groups stay comparable
+        # (and keep their correlation) within each resample. Returns one row
+        # per group with the interval of total P&L, average daily P&L and
+        # max drawdown, and the share of resamples that lost money, indexed
+        # like `groups`.
+        values = self.values
+        n_groups, days = values.shape
+        if not days or not n_groups:
+            return self.groups.copy()
+        rng = np.random.default_rng(seed)
+        by_day = np.ascontiguousarray(values.T)
+        chunk = max(1, BOOTSTRAP_BLOCK_CELLS // n_groups)
+        totals = np.empty((n_groups, n))
+        drawdowns = np.empty((n_groups, n))
+        for start in range(0, n, chunk):
+            stop = min(start + chunk, n)
+            idx = resample_days(rng, stop - start, days, block)
+            # Walk the resampled days once, keeping each path's equity, peak
+            # and deepest drawdown, rather than materialising the paths
+            equity = np.zeros((stop - start, n_groups))
+            peak = np.zeros_like(equity)
+            deepest = np.zeros_like(equity)
+            for d in range(days):
+                equity += by_day[idx[:, d]]
+                np.maximum(peak, equity, out=peak)
+                np.maximum(deepest, peak - equity, out=deepest)
+            totals[:, start:stop] = equity.T
+            drawdowns[:, start:stop] = deepest.T
+        tail = (1 - confidence) / 2 * 100
+        low_total, high_total = np.percentile(totals, [tail, 100 - tail], axis=1)
+        low_dd, high_dd = np.percentile(drawdowns, [tail, 100 - tail], axis=1)
+        summary = self.groups.copy()
+        summary['total_pnl'] = values.sum(axis=1)
+        summary['total_pnl_low'] = low_total
+        summary['total_pnl_high'] = high_total
+        summary['avg_daily_pnl_low'] = low_total / days
+        summary['avg_daily_pnl_high'] = high_total / days
+        summary['max_drawdown'] = self.max_drawdown()
+        summary['max_drawdown_low'] = low_dd
+        summary['max_drawdown_high'] = high_dd
+        summary['loss_probability'] = (totals < 0).mean(axis=1)
+        return summary
+
+
+def max_drawdown(values):
+    # Deepest fall from a running peak of the cumulative sum along the last
+    # axis (equity starts at 0), as a positive amount; any leading shape
+    equity = np.cumsum(values, axis=-1)
+    peak = np.maximum(np.maximum.accumulate(equity, axis=-1), 0.0)
+    return (peak - equity).max(axis=-1) if values.shape[-1] else np.zeros(values.shape[:-1])
+
+
+def resample_days(rng, n, days, block=1):
+    # (n, days) day positions: runs of `block` consecutive days starting at
+    # random days (wrapping around), which is the plain bootstrap for block=1
+    block = max(1, min(block, days))
+    runs = -(-days // block)
+    starts = rng.integers(0, days, size=(n, runs, 1))
+    return ((starts + np.arange(block)) % days).reshape(n, runs * block)[:, :days]
+
+
+def exit_reasons(trades, by=None):
+    # Per group and exit reason: trade count, share of the group's trades,
+    # total and average P&L and win rate; rows with a NaN pnl are left out,
+    # as in DailyPnl
+    by = default_groups(trades) if by is None else list(by)
+    trades = trades[trades['pnl'].notna()]
+    stats = (trades.assign(win=trades['pnl'] > 0)
+             .groupby(by + ['exit_reason'], dropna=False, sort=True)
+             .agg(trades=('pnl', 'size'), total_pnl=('pnl', 'sum'), avg_pnl=('pnl', 'mean'), wins=('win', 'sum'))
+             .reset_index())
+    totals = stats.groupby(by, dropna=False)['trades'].transform('sum') if by else stats['trades'].sum()
+    stats['share'] = stats['trades'] / totals
+    stats['win_rate'] = stats.pop('wins') / stats['trades']
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Daily P&L, drawdown and bootstrap statistics of a trade log CSV.')
+    parser.add_argument('trades', nargs='?', default='backtest_results.csv', help='trade log or sweep CSV')
+    parser.add_argument('--by', nargs='+', default=None, help='group columns (default: config_id or strategy)')
+    parser.add_argument('--bootstrap', type=int, default=0, help='resamples for confidence intervals (0: none)')
+    parser.add_argument('--block', type=int, default=1, help='days per resampled block')
+    parser.add_argument('--confidence', type=float, default=0.95)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='write the summary here instead of printing it')
+    parser.add_argument('--daily', default=None, help='also write daily P&L, equity and drawdown here')
+    parser.add_argument('--exits', default=None, help='also write the exit reason breakdown here')
+    args = parser.parse_args(argv)
+
+    trades = pd.read_csv(args.trades, dtype={'date': str})
+    if trades.empty:
+        print(f"No trades in {args.trades}", file=sys.stderr)
+        return 1
+    daily = DailyPnl.from_trades(trades, by=args.by)
+    if daily.dropped:
+        print(f"Ignoring {daily.dropped} trade(s) with no pnl in {args.trades}", file=sys.stderr)
+    summary = daily.summary()
+    if args.bootstrap:
+        intervals = daily.bootstrap(args.bootstrap, seed=args.seed, confidence=args.confidence, block=args.block)
+        extra = intervals.drop(columns=list(daily.groups.columns) + ['total_pnl', 'max_drawdown'])
+        summary = summary.join(extra)
+    if args.daily:
+        daily.frame().to_csv(args.daily, index=False)
+    if args.exits:
+        exit_reasons(trades, by=args.by).to_csv(args.exits, index=False)
+    if args.output:
+        summary.to_csv(args.output, index=False)
+    else:
+        print(summary.to_string(index=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,259 +1,475 @@
 # backtester.py
 
-from datetime import datetime, time, timedelta
+import numpy as np
 import pandas as pd
 import json
-import boto3
-import json
 from io import BytesIO
-from dotenv import load_dotenv
-import os
-
-# Load environment variables from .env
-load_dotenv()
-
-# Access them
-aws_access_key = os.getenv("AWS_ACCESS_KEY_ID")
-aws_secret_key = os.getenv("AWS_SECRET_ACCESS_KEY")
-aws_region = os.getenv("AWS_DEFAULT_REGION")
 
-# S3 setup - use your real keys if not configured globally
-s3 = boto3.client(
-    's3',
-    aws_access_key_id = aws_access_key,
-    aws_secret_access_key = aws_secret_key,
-    region_name = aws_region
-)
-
-bucket_name = 'nifty-options-data-chokli'
+from chain import compact_chain, is_compact, minute_of_day, price_array, select_rows, widen_prices
+from chain_parser import flatten_option_items, iter_json_array
+from greeks import GREEKS_FOLDER, chain_greeks, chain_minutes, delta_strike, entry_greeks, first_minute_greeks
+from incremental import IncrementalBacktester, replay_day
+from profiling import NULL_PROFILE, CountingReader, timed_items
+from result_cache import frame_fingerprint, result_key
+from storage import DAY_FOLDERS, day_key, default_storage
 
 class data_loader:
-    def __init__(self, date):
+    def __init__(self, date, cache=None, storage=None, profile=None, compact=False, dataset=None):
         self.date = date
+        self.cache = cache
+        self.storage = storage if storage is not None else default_storage()
+        # profiling.DayProfile to charge fetch/decode/flatten time and bytes to
+        self.profile = profile if profile is not None else NULL_PROFILE
+        # Hand out chain.compact_chain frames from load_data; the cache keeps
+        # the plain flattened frame either way
+        self.compact = compact
+        # Optional dataset.ChainDataset; days it holds are read from it, and
+        # only the rows asked for
+        self.dataset = dataset
+        self._minutes = None
     
     def get_data_from_s3(self, folder='nifty_options'):
-        file_key = f"{folder}/{self.date}.json"
-        response = s3.get_object(Bucket=bucket_name, Key=file_key)
-        content = response['Body'].read().decode('utf-8')
-        return json.loads(content)
-    def load_data(self):
-        data = self.get_data_from_s3()
-        flattened_data = []
-
-        for item in data:
-            base_info = {
-                'date': item['date'],
-                'strike': item['strike'],
-                'atm': item['atm'],
-                'right': item['right'],
-                'expiry': item['expiry']
-            }
-            option_info = item['option_data']
-            
-            # Merge base info with option_data
-            merged = {**base_info, **option_info}
-            flattened_data.append(merged)
-
-        # Create DataFrame
-        flattened_data = pd.DataFrame(flattened_data)
-        return flattened_data
+        return self.fetch_from_s3(folder)[0]
+
+    def fetch_from_s3(self, folder='nifty_options'):
+        profile = self.profile
+        with profile.phase('fetch'):
+            body, etag = self.storage.get(day_key(folder, self.date))
+            try:
+                content = body.read()
+            finally:
+                body.close()
+        profile.count('bytes_fetched', len(content))
+        with profile.phase('decode'):
+            return json.loads(content.decode('utf-8')), etag
+
+    def build_from_s3(self, folder, build, phase='build'):
+        # Items are decoded one by one as the body is read
+        profile = self.profile
+        with profile.phase('fetch'):
+            body, etag = self.storage.get(day_key(folder, self.date))
+        try:
+            if not profile.enabled:
+                return build(iter_json_array(body)), etag
+            # Reads count as fetch and item parsing as decode; what is left
+            # of the build is the phase's own time
+            with profile.phase(phase):
+                df = build(timed_items(iter_json_array(CountingReader(body, profile)), profile))
+            profile.count('rows_loaded', len(df))
+            return df, etag
+        finally:
+            body.close()
+
+    def load_data(self, legs=None, strikes=None, rights=None, start=None, end=None):
+        # With any of the filters (see chain.select_rows) the result is a
+        # compact frame of just those rows; from a dataset only they are read
+        filtered = any(f is not None for f in (legs, strikes, rights, start, end))
+        if self.in_dataset():
+            with self.profile.phase('dataset_read'):
+                df = self.dataset.read(self.date, legs, strikes, rights, start, end)
+            self.profile.count('rows_loaded', len(df))
+            return df
+        df = self.load_cached('nifty_options', flatten_option_items, 'flatten')
+        if self.compact or filtered:
+            with self.profile.phase('compact'):
+                df = compact_chain(df)
+        if filtered:
+            self._minutes = np.unique(df['datetime'].to_numpy())
+            df = select_rows(df, legs, strikes, rights, start, end)
+        return df
+
+    def load_minutes(self):
+        # Minute grid of the whole chain, which the engines step through even
+        # when load_data was asked for only some legs
+        if self.in_dataset():
+            return self.dataset.minutes(self.date)
+        if self._minutes is None:
+            self._minutes = np.unique(pd.to_datetime(self.load_data()['datetime']).to_numpy())
+        return self._minutes
+
+    def load_spot_data(self):
+        if self.in_dataset():
+            return self.dataset.read_spot(self.date)
+        return self.load_cached('nifty_spot', lambda items: pd.DataFrame(list(items)), 'spot_frame')
+
+    def load_greeks(self, entry_time=None):
+        # IV and Greeks (greeks.chain_greeks) of the whole chain or, given
+        # entry_time, of just the first minute from then on that has any,
+        # which is all delta-targeted legs are picked from; from a dataset
+        # only that minute's rows are read. Kept in the day cache next to the
+        # frames they are computed from and, like them, checked against the
+        # source ETags only when the cache revalidates
+        if self.cache is None:
+            return self.compute_greeks(entry_time)
+        greeks_folder = GREEKS_FOLDER if entry_time is None else f"{GREEKS_FOLDER}_{entry_time.replace(':', '')}"
+        etag = None
+        if self.cache.revalidate:
+            source = self.dataset if self.in_dataset() else self.storage
+            with self.profile.phase('fetch'):
+                etag = '-'.join(str(source.head(day_key(folder, self.date))) for folder in DAY_FOLDERS)
+        with self.profile.phase('cache_read'):
+            cached = self.cache.get(greeks_folder, self.date, etag)
+        if cached is not None:
+            self.profile.count('cache_hits')
+            return cached
+        greeks = self.compute_greeks(entry_time)
+        with self.profile.phase('cache_write'):
+            self.cache.put(greeks_folder, self.date, etag, greeks)
+        return greeks
+
+    def compute_greeks(self, entry_time=None):
+        data_spot = self.load_spot_data()
+        if entry_time is None:
+            data = self.load_data()
+            with self.profile.phase('greeks'):
+                return chain_greeks(data, data_spot)
+        if self.in_dataset():
+            minutes = self.load_minutes()
+
+            def rows_at(minute):
+                at = pd.Timestamp(minute).strftime('%H:%M')
+                return self.load_data(start=at, end=at)
+        else:
+            minutes, rows_at = chain_minutes(self.load_data())
+        with self.profile.phase('greeks'):
+            return first_minute_greeks(minutes, rows_at, data_spot, entry_time)
+
+    def in_dataset(self):
+        return self.dataset is not None and self.dataset.contains(self.date)
+
+    def load_cached(self, folder, build, phase='build'):
+        # Read-through: serve the flattened frame from disk when we have it,
+        # otherwise fetch, build and store it under the object's ETag.
+        if self.cache is None:
+            return self.build_from_s3(folder, build, phase)[0]
+        profile = self.profile
+        etag = None
+        if self.cache.revalidate:
+            with profile.phase('fetch'):
+                etag = self.storage.head(day_key(folder, self.date))
+        with profile.phase('cache_read'):
+            cached = self.cache.get(folder, self.date, etag)
+        if cached is not None:
+            profile.count('cache_hits')
+            profile.count('rows_loaded', len(cached))
+            return cached
+        df, etag = self.build_from_s3(folder, build, phase)
+        with profile.phase('cache_write'):
+            self.cache.put(folder, self.date, etag, df)
+        return df
+
+    def flatten(self, data):
+        # Same frame as load_data, for JSON that has already been decoded
+        return flatten_option_items(data)
 
 class Strategy:
     def __init__(self, config):
         self.config = config
 
-    def get_strikes(self, atm):
+    def uses_delta(self):
+        return any('delta' in leg for leg in self.config['legs'])
+
+    def get_strikes(self, atm, greeks=None):
+        # Legs with a target `delta` take the strike whose delta at the entry
+        # minute is closest to it; they need the day's greeks.chain_greeks
+        # frame (or just its entry-minute rows)
         strikes = []
+        at_entry = None
         for leg in self.config['legs']:
-            offset = leg['otm'] * 50 if 'otm' in leg else 0
-            strike = atm + offset if leg['type'].lower() == 'call' else atm - offset
-            strikes.append((strike, leg['type'].lower()))
+            right = leg['type'].lower()
+            if 'delta' in leg:
+                if greeks is None:
+                    raise ValueError("Delta-targeted legs need the day's Greeks")
+                if at_entry is None:
+                    at_entry = entry_greeks(greeks, self.config['entry_time'])
+                strike = delta_strike(at_entry, right, leg['delta'])
+                if strike is None:
+                    raise ValueError(f"No {right} strike with a delta at {self.config['entry_time']}")
+            else:
+                offset = leg['otm'] * 50 if 'otm' in leg else 0
+                strike = atm + offset if right == 'call' else atm - offset
+            strikes.append((strike, right))
         return strikes
 
+ENGINES = ('loop', 'vectorized', 'incremental')
+# Bump an engine's version whenever a change to it can alter the trade log,
+# so results cached from the old code stop matching
+ENGINE_VERSIONS = {'loop': 1, 'vectorized': 1, 'incremental': 1}
+
+
+def day_result_key(config, engine, date, fingerprint):
+    return result_key('option_backtester', config, engine, ENGINE_VERSIONS[engine], date, fingerprint)
+
+
+def spot_atm_strike(data_spot, entry_time):
+    # ATM strike off the first spot close at or after entry_time ('HH:MM')
+    times = pd.to_datetime(data_spot['datetime'])
+    data_spot_price = float(data_spot[(times.dt.strftime('%H:%M') >= entry_time).to_numpy()]['close'].iloc[0])
+    return int(round(data_spot_price / 50) * 50)
+
+
+def load_strategy_config(path, strategy_name):
+    with open(path, 'r') as f:
+        strategies = json.load(f)
+    return strategies[strategy_name]
+
+
 class OptionBacktester:
-    def __init__(self, data, data_spot,date,strategy_name, strategy_config_path='strategy_config.json'):
-        self.data = data.copy()
+    def __init__(self, data, data_spot,date,strategy_name, strategy_config_path='strategy_config.json', engine='loop',
+                 price_index=None, profile=None, result_cache=None, data_fingerprint=None, minutes=None,
+                 greeks=None):
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine {engine!r}, expected one of {ENGINES}")
+        # Compact chains (chain.compact_chain) keep their parsed datetimes,
+        # minute of day and categorical right; prices are widened back to
+        # float64 for the row-by-row engines
+        self.compact = is_compact(data)
+        self.data = widen_prices(data) if self.compact else data.copy()
         self.date = date
         self.data_spot = data_spot.copy()
         self.strategy_name = strategy_name
         self.config = self.load_strategy_config(strategy_config_path)
         self.strategy = Strategy(self.config)
+        self.engine = engine
+        # Optional PriceIndex over this day's data, used by the vectorized
+        # engine; an expiry-week index is cut down to the backtest date
+        self.price_index = price_index.day(date) if price_index is not None else None
+        self.profile = profile if profile is not None else NULL_PROFILE
+        # Optional ResultCache; the day's input is fingerprinted from the
+        # frames unless the caller already has a fingerprint (e.g. ETags)
+        self.result_cache = result_cache
+        self.data_fingerprint = data_fingerprint
+        # The whole chain's minute grid when `data` holds only some of its
+        # rows (data_loader.load_data with filters); the engines step through
+        # every minute of the day as if the rest were there
+        self.minutes = minutes
+        # The day's greeks.chain_greeks frame for delta-targeted legs;
+        # without it they are picked off the entry minute of `data`
+        self.greeks = greeks
         self.trade_log = []
 
     def load_strategy_config(self, path):
-        with open(path, 'r') as f:
-            strategies = json.load(f)
-        return strategies[self.strategy_name]
+        return load_strategy_config(path, self.strategy_name)
 
     def run(self):
-        self.run_day()
-        return pd.DataFrame(self.trade_log)
+        key = None
+        if self.result_cache is not None:
+            key = self.result_key()
+            hit, cached = self.result_cache.lookup(key)
+            if hit:
+                self.profile.count('result_cache_hits')
+                self.trade_log = cached.to_dict('records')
+                return cached
+        if self.engine == 'vectorized':
+            self.run_day_vectorized()
+        elif self.engine == 'incremental':
+            self.run_day_incremental()
+        else:
+            self.run_day()
+        result = pd.DataFrame(self.trade_log)
+        if key is not None:
+            self.result_cache.put(key, result)
+        return result
+
+    def leg_strikes(self, atm_strike):
+        greeks = None
+        if self.strategy.uses_delta():
+            greeks = self.greeks
+            if greeks is None:
+                with self.profile.phase('greeks'):
+                    greeks = first_minute_greeks(*chain_minutes(self.data), self.data_spot, self.config['entry_time'])
+        return self.strategy.get_strikes(atm_strike, greeks)
+
+    def result_key(self):
+        fingerprint = self.data_fingerprint
+        if fingerprint is None:
+            fingerprint = frame_fingerprint(self.data, self.data_spot)
+        return day_result_key(self.config, self.engine, self.date, fingerprint)
 
     def run_day(self):
         #day_data = self.data[self.data['date'] == date].copy()
+        profile = self.profile
         day_data = self.data
-        day_data['datetime'] = pd.to_datetime(day_data['datetime'])
+        with profile.phase('parse_datetime'):
+            day_data['datetime'] = pd.to_datetime(day_data['datetime'])
+        profile.count('rows', len(day_data))
         entry_time = self.config['entry_time']
         exit_time = self.config['exit_time']
         reentry = self.config.get('reentry_on_sl', False)
         reentry_no = self.config.get('max_rentries', 0)
         max_loss = self.config.get('max_loss', None)
         
-        data_spot = self.data_spot.copy()
-        data_spot['datetime'] = pd.to_datetime(data_spot['datetime'])
-        data_spot_price = float(data_spot[(data_spot['datetime'].dt.strftime('%H:%M') >= entry_time)]['close'].iloc[0])
-        atm_strike = int(round(data_spot_price / 50) * 50)
+        with profile.phase('parse_datetime'):
+            data_spot = self.data_spot.copy()
+            data_spot['datetime'] = pd.to_datetime(data_spot['datetime'])
+        atm_strike = spot_atm_strike(data_spot, entry_time)
 
         #atm_strike = day_data['atm'].iloc[0]
-        strike_pairs = self.strategy.get_strikes(atm_strike)
+        strike_pairs = self.leg_strikes(atm_strike)
         #print('strike_pairs', strike_pairs)
 
         active_legs = []
 
-        # Initialize entry for each leg
-        for strike, opt_type in strike_pairs:
-            leg_data = day_data[
-                (day_data['strike'] == strike) &
-                (day_data['right'].str.lower() == opt_type) &
-                (day_data['datetime'].dt.strftime('%H:%M') >= entry_time)
-            ].copy()
-            if leg_data.empty:
-                continue
+        with profile.phase('select_legs'):
+            rights, after_entry = self.leg_filters(day_data, entry_time)
+            # Initialize entry for each leg
+            for strike, opt_type in strike_pairs:
+                leg_data = day_data[
+                    (day_data['strike'] == strike) &
+                    (rights == opt_type) &
+                    after_entry
+                ].copy()
+                if leg_data.empty:
+                    continue
 
-            entry_row = leg_data.iloc[0]
-            entry_time_leg = entry_row['datetime']
-            entry_price = float(entry_row['open'])
-            sl_price = entry_price * (1 + self.config['stop_loss'])
-            tgt_price = entry_price * (1 - self.config['target']) if self.config['target'] else None
-
-            active_legs.append({
-                "strike": strike,
-                "type": opt_type,
-                "leg_data": leg_data,
-                "entry_time": entry_time_leg,
-                "entry_price": entry_price,
-                "sl_price": sl_price,
-                "tgt_price": tgt_price,
-                "status": "active",
-                "exit_price": None,
-                "exit_reason": None,
-                "reentries": 0
-            })
+                entry_row = leg_data.iloc[0]
+                entry_time_leg = entry_row['datetime']
+                entry_price = float(entry_row['open'])
+                sl_price = entry_price * (1 + self.config['stop_loss'])
+                tgt_price = entry_price * (1 - self.config['target']) if self.config['target'] else None
+
+                active_legs.append({
+                    "strike": strike,
+                    "type": opt_type,
+                    "leg_data": leg_data,
+                    "entry_time": entry_time_leg,
+                    "entry_price": entry_price,
+                    "sl_price": sl_price,
+                    "tgt_price": tgt_price,
+                    "status": "active",
+                    "exit_price": None,
+                    "exit_reason": None,
+                    "reentries": 0
+                })
         #print(active_legs)
         # Start iterating through minute-by-minute to simulate live P&L
-        timestamps = sorted(day_data['datetime'].unique())
-        static_sl = 0
-        static_trgt = 0
-        for timestamp in timestamps:
-            total_pnl = 0
-
-            for leg in active_legs:
-                if leg["status"] != "active":
-                    continue
+        with profile.phase('minute_loop'):
+            if self.minutes is not None:
+                timestamps = list(pd.DatetimeIndex(self.minutes))
+            else:
+                timestamps = sorted(day_data['datetime'].unique())
+            static_sl = 0
+            static_trgt = 0
+            lookups = 0
+            for timestamp in timestamps:
+                total_pnl = 0
 
-                leg_candles = leg["leg_data"]
-                candle = leg_candles[leg_candles['datetime'] == timestamp]
-                if candle.empty:
-                    continue
-
-                row = candle.iloc[0]
-                high_price = float(row['high'])
-                low_price = float(row['low'])
+                for leg in active_legs:
+                    if leg["status"] != "active":
+                        continue
+
+                    leg_candles = leg["leg_data"]
+                    candle = leg_candles[leg_candles['datetime'] == timestamp]
+                    priced_by = leg
+                    lookups += 1
+                    if candle.empty:
+                        continue
+
+                    row = candle.iloc[0]
+                    high_price = float(row['high'])
+                    low_price = float(row['low'])
                 
 
-                # Check target
-                if leg["tgt_price"] and low_price <= leg["tgt_price"]:
-                    self.trade_log.append({
-                        "date": self.date,
-                        "strike": leg["strike"],
-                        "type": leg["type"],
-                        "exit_reason": "target",
-                        "entry_time": leg["entry_time"],
-                        "exit_time": timestamp,
-                        "entry_price": leg["entry_price"],
-                        "exit_price": low_price,
-                        "pnl": leg["entry_price"] - low_price,
-                        "reentry_id": leg["reentries"]
-                    })
-                    leg.update({
-                        "status": "closed",
-                        "exit_reason": "target",
-                        "exit_price": low_price
-                    })
-                    static_trgt += leg["entry_price"] - low_price
-                    continue
-
-                # Check stop loss
-                if high_price >= leg["sl_price"]:
-                    self.trade_log.append({
-                        "date": self.date,
-                        "strike": leg["strike"],
-                        "type": leg["type"],
-                        "exit_reason": "stop_loss",
-                        "entry_time": leg["entry_time"],
-                        "exit_time": timestamp,
-                        "entry_price": leg["entry_price"],
-                        "exit_price": high_price,
-                        "pnl": leg["entry_price"] - high_price,
-                        "reentry_id": leg["reentries"]
-                    })
-                    leg.update({
-                        "status": "closed",
-                        "exit_reason": "stop_loss",
-                        "exit_price": high_price
-                    })
-                    static_sl += leg["entry_price"] - high_price
-
-                    if reentry and leg["reentries"] < reentry_no:
-                        # reentry starts from next candle
-                        next_leg_data = leg_candles[leg_candles['datetime'] > timestamp]
-                        if not next_leg_data.empty:
-                            new_entry = next_leg_data.iloc[0]
-                            entry_price = float(new_entry['open'])
-                            leg.update({
-                                "entry_time": new_entry['datetime'],
-                                "entry_price": entry_price,
-                                "sl_price": entry_price * (1 + self.config['stop_loss']),
-                                "tgt_price": entry_price * (1 - self.config['target']) if self.config['target'] else None,
-                                "status": "active",
-                                "reentries": leg["reentries"] + 1
-                            })
-
-                # Calculate current P&L for the leg
-                if leg["status"] == "active":
-                    current_price = float(row['close'])
-                    leg_pnl = leg["entry_price"] - current_price  # short premium
-                    total_pnl += leg_pnl
-                # elif leg["exit_price"] is not None:
-                #     leg_pnl = leg["entry_price"] - leg["exit_price"]
-                #     total_pnl += leg_pnl
-            total_pnl += static_sl + static_trgt
-            if max_loss is not None and total_pnl <= -abs(max_loss):
-                for leg in active_legs:
+                    # Check target
+                    if leg["tgt_price"] and low_price <= leg["tgt_price"]:
+                        self.trade_log.append({
+                            "date": self.date,
+                            "strike": leg["strike"],
+                            "type": leg["type"],
+                            "exit_reason": "target",
+                            "entry_time": leg["entry_time"],
+                            "exit_time": timestamp,
+                            "entry_price": leg["entry_price"],
+                            "exit_price": low_price,
+                            "pnl": leg["entry_price"] - low_price,
+                            "reentry_id": leg["reentries"]
+                        })
+                        leg.update({
+                            "status": "closed",
+                            "exit_reason": "target",
+                            "exit_price": low_price
+                        })
+                        static_trgt += leg["entry_price"] - low_price
+                        continue
+
+                    # Check stop loss
+                    if high_price >= leg["sl_price"]:
+                        self.trade_log.append({
+                            "date": self.date,
+                            "strike": leg["strike"],
+                            "type": leg["type"],
+                            "exit_reason": "stop_loss",
+                            "entry_time": leg["entry_time"],
+                            "exit_time": timestamp,
+                            "entry_price": leg["entry_price"],
+                            "exit_price": high_price,
+                            "pnl": leg["entry_price"] - high_price,
+                            "reentry_id": leg["reentries"]
+                        })
+                        leg.update({
+                            "status": "closed",
+                            "exit_reason": "stop_loss",
+                            "exit_price": high_price
+                        })
+                        static_sl += leg["entry_price"] - high_price
+
+                        if reentry and leg["reentries"] < reentry_no:
+                            # reentry starts from next candle
+                            next_leg_data = leg_candles[leg_candles['datetime'] > timestamp]
+                            if not next_leg_data.empty:
+                                new_entry = next_leg_data.iloc[0]
+                                entry_price = float(new_entry['open'])
+                                leg.update({
+                                    "entry_time": new_entry['datetime'],
+                                    "entry_price": entry_price,
+                                    "sl_price": entry_price * (1 + self.config['stop_loss']),
+                                    "tgt_price": entry_price * (1 - self.config['target']) if self.config['target'] else None,
+                                    "status": "active",
+                                    "reentries": leg["reentries"] + 1
+                                })
+
+                    # Calculate current P&L for the leg
                     if leg["status"] == "active":
-                        candle = leg["leg_data"][leg["leg_data"]['datetime'] == timestamp]
-                        if not candle.empty:
-                            exit_price = float(candle.iloc[0]['close'])
-                            self.trade_log.append({
-                                "date": self.date,
-                                "strike": leg["strike"],
-                                "type": leg["type"],
-                                "exit_reason": "max_loss_hit",
-                                "entry_time": leg["entry_time"],
-                                "exit_time": timestamp,
-                                "entry_price": leg["entry_price"],
-                                "exit_price": exit_price,
-                                "pnl": leg["entry_price"] - exit_price,
-                                "reentry_id": leg["reentries"]
-                            })
-                            leg.update({
-                                "status": "closed",
-                                "exit_reason": "max_loss_hit",
-                                "exit_price": float(candle.iloc[0]['close'])
-                            })
-                break  # Exit all trades for the day
+                        current_price = float(row['close'])
+                        leg_pnl = leg["entry_price"] - current_price  # short premium
+                        total_pnl += leg_pnl
+                    # elif leg["exit_price"] is not None:
+                    #     leg_pnl = leg["entry_price"] - leg["exit_price"]
+                    #     total_pnl += leg_pnl
+                total_pnl += static_sl + static_trgt
+                if max_loss is not None and total_pnl <= -abs(max_loss):
+                    for leg in active_legs:
+                        if leg["status"] == "active":
+                            candle = leg["leg_data"][leg["leg_data"]['datetime'] == timestamp]
+                            priced_by = leg
+                            if not candle.empty:
+                                exit_price = float(candle.iloc[0]['close'])
+                                self.trade_log.append({
+                                    "date": self.date,
+                                    "strike": leg["strike"],
+                                    "type": leg["type"],
+                                    "exit_reason": "max_loss_hit",
+                                    "entry_time": leg["entry_time"],
+                                    "exit_time": timestamp,
+                                    "entry_price": leg["entry_price"],
+                                    "exit_price": exit_price,
+                                    "pnl": leg["entry_price"] - exit_price,
+                                    "reentry_id": leg["reentries"]
+                                })
+                                leg.update({
+                                    "status": "closed",
+                                    "exit_reason": "max_loss_hit",
+                                    "exit_price": float(candle.iloc[0]['close'])
+                                })
+                    break  # Exit all trades for the day
+        profile.count('minutes', len(timestamps))
+        profile.count('lookups', lookups)
 
         # Save trades
+        if any(leg["status"] != "closed" for leg in active_legs) and candle.empty:
+            # The open legs are all priced off the last candle looked up
+            raise ValueError(f"No candle for {priced_by['type']} {priced_by['strike']} at {timestamp} "
+                             f"to price the day-end exit of the open legs")
         for leg in active_legs:
             if leg["status"] != "closed":
                 exit_price = float(candle.iloc[0]['close'])
@@ -270,38 +486,243 @@ class OptionBacktester:
                     "reentry_id": leg["reentries"]
                 })
 
-if __name__ == "__main__":
+    def leg_filters(self, day_data, entry_time):
+        # Lower-case rights and the rows at or after entry_time, worked out
+        # once per day rather than once per leg
+        if self.compact:
+            return day_data['right'], day_data['minute'] >= minute_of_day(entry_time)
+        return day_data['right'].str.lower(), day_data['datetime'].dt.strftime('%H:%M') >= entry_time
+
+    def run_day_vectorized(self):
+        # Same rules as run_day, but each leg's candles are aligned once onto the
+        # day's minute grid and exits are found as first-crossing indices instead
+        # of re-filtering the leg frame every minute.
+        profile = self.profile
+        entry_time = self.config['entry_time']
 
-    start_date = datetime(2024, 7, 5)
-    end_date = datetime(2024, 7, 12)
-    delta = timedelta(days=1)
-    current = start_date
-    final_df = pd.DataFrame()
-    while current <= end_date:
-        if current.weekday() >= 5:
-            current += delta
+        with profile.phase('parse_datetime'):
+            data_spot = self.data_spot.copy()
+            data_spot['datetime'] = pd.to_datetime(data_spot['datetime'])
+        atm_strike = spot_atm_strike(data_spot, entry_time)
+        strike_pairs = self.leg_strikes(atm_strike)
+
+        if self.price_index is not None:
+            # Legs come straight off the shared index's minute grid
+            timestamps = self.price_index.minutes
+        else:
+            day_data = self.data
+            profile.count('rows', len(day_data))
+            with profile.phase('parse_datetime'):
+                day_data['datetime'] = pd.to_datetime(day_data['datetime'])
+            timestamps = np.unique(day_data['datetime'].to_numpy()) if self.minutes is None else np.asarray(self.minutes)
+            rights, after_entry = self.leg_filters(day_data, entry_time)
+            rights = rights.to_numpy()
+            after_entry = after_entry.to_numpy()
+            strikes = day_data['strike'].to_numpy()
+
+        legs = []
+        for strike, opt_type in strike_pairs:
+            with profile.phase('align_legs'):
+                if self.price_index is not None:
+                    leg = self.price_index.leg(strike, opt_type, entry_time)
+                else:
+                    mask = (strikes == strike) & (rights == opt_type) & after_entry
+                    leg = align_leg(day_data[mask], timestamps) if mask.any() else None
+            profile.count('lookups')
+            if leg is None:
+                continue
+            leg.update({"strike": strike, "type": opt_type})
+            with profile.phase('segments'):
+                legs.append(leg_path(leg, leg_segments(leg, self.config)))
+        profile.count('minutes', len(timestamps))
+        with profile.phase('combine'):
+            self.trade_log.extend(combine_legs(legs, timestamps, self.config.get('max_loss', None), self.date))
+
+    def run_day_incremental(self):
+        # Same rules as run_day, replayed candle by candle through the
+        # event-driven engine used for paper trading
+        entry_time = self.config['entry_time']
+        data_spot = self.data_spot.copy()
+        data_spot['datetime'] = pd.to_datetime(data_spot['datetime'])
+        atm_strike = spot_atm_strike(data_spot, entry_time)
+
+        engine = IncrementalBacktester(self.config, self.date, self.leg_strikes(atm_strike))
+        with self.profile.phase('replay'):
+            self.trade_log.extend(replay_day(engine, self.data, self.minutes))
+        self.profile.count('rows', len(self.data))
+
+
+def align_leg(leg_data, timestamps):
+    # Scatter a leg's candles onto the minute grid; where a minute repeats the
+    # first row wins, as with .iloc[0] in run_day.
+    pos = np.searchsorted(timestamps, leg_data['datetime'].to_numpy())
+    first = ~pd.Index(pos).duplicated()
+    n = len(timestamps)
+    leg = {"pos": pos, "timestamps": timestamps, "has": np.zeros(n, dtype=bool)}
+    leg["has"][pos[first]] = True
+    for col in ('open', 'high', 'low', 'close'):
+        values = np.full(n, np.nan)
+        values[pos[first]] = price_array(leg_data, [col])[first, 0]
+        leg[col] = values
+    return leg
+
+
+def leg_segments(leg, config):
+    # Split a leg's day into entries: each runs from its entry candle to the
+    # first candle that crosses its target or stop loss.
+    stop_loss = config['stop_loss']
+    target = config['target']
+    reentry = config.get('reentry_on_sl', False)
+    reentry_no = config.get('max_rentries', 0)
+    segments = []
+    entry_idx = int(leg["pos"][0])
+    active_from, search_from, reentries = 0, 0, 0
+    while True:
+        entry_price = float(leg["open"][entry_idx])
+        sl_price = entry_price * (1 + stop_loss)
+        tgt_price = entry_price * (1 - target) if target else None
+        seg = {
+            "active_from": active_from,
+            "entry_time": pd.Timestamp(leg["timestamps"][entry_idx]),
+            "entry_price": entry_price,
+            "reentries": reentries,
+            "exit_idx": None,
+            "exit_reason": None,
+            "exit_price": None,
+            "pnl": None,
+        }
+        segments.append(seg)
+
+        with np.errstate(invalid='ignore'):
+            tgt_hit = leg["low"][search_from:] <= tgt_price if tgt_price else np.zeros(len(leg["low"]) - search_from, dtype=bool)
+            sl_hit = leg["high"][search_from:] >= sl_price
+        crossed = np.flatnonzero(tgt_hit | sl_hit)
+        if not len(crossed):
+            return segments
+        x = search_from + int(crossed[0])
+        if tgt_hit[x - search_from]:
+            exit_price, reason = float(leg["low"][x]), "target"
+        else:
+            exit_price, reason = float(leg["high"][x]), "stop_loss"
+        seg.update({"exit_idx": x, "exit_reason": reason, "exit_price": exit_price, "pnl": entry_price - exit_price})
+
+        if reason != "stop_loss" or not reentry or reentries >= reentry_no:
+            return segments
+        later = leg["pos"] > x
+        if not later.any():
+            return segments
+        # reentry starts from next candle
+        entry_idx = int(leg["pos"][np.argmax(later)])
+        active_from, search_from, reentries = x, x + 1, reentries + 1
+
+
+def leg_path(leg, segments):
+    # Mark-to-market of the leg at every minute while it is open. A leg
+    # re-entered on a stop loss is marked against the new entry price on the
+    # stop-loss candle itself, exactly as run_day does.
+    n = len(leg["timestamps"])
+    pnl = np.zeros(n)
+    for seg in segments:
+        end = seg["exit_idx"] if seg["exit_idx"] is not None else n
+        span = slice(seg["active_from"], end)
+        pnl[span] = np.where(leg["has"][span], seg["entry_price"] - leg["close"][span], 0.0)
+    for prev, seg in zip(segments, segments[1:]):
+        x = prev["exit_idx"]
+        pnl[x] = seg["entry_price"] - leg["close"][x]
+    path = dict(leg)
+    path.update({"segments": segments, "pnl": pnl})
+    return path
+
+
+def combine_legs(legs, timestamps, max_loss, date):
+    # Portfolio pass over legs from leg_path: sum open and realised P&L in the
+    # order run_day accumulates them, cut the day at the first max_loss breach
+    # and return the trade log rows.
+    if not legs:
+        return []
+    n = len(timestamps)
+    open_pnl = np.zeros(n)
+    events = []
+    for leg_no, leg in enumerate(legs):
+        open_pnl = open_pnl + leg["pnl"]
+        for seg in leg["segments"]:
+            if seg["exit_idx"] is not None:
+                events.append((seg["exit_idx"], leg_no, seg))
+    events.sort(key=lambda e: (e[0], e[1]))
+
+    realised = {}
+    for reason in ("stop_loss", "target"):
+        hits = [(idx, seg["pnl"]) for idx, _, seg in events if seg["exit_reason"] == reason]
+        cum = np.zeros(n)
+        if hits:
+            idx = np.array([h[0] for h in hits])
+            pos = np.searchsorted(idx, np.arange(n), side='right') - 1
+            cum = np.where(pos >= 0, np.cumsum([h[1] for h in hits])[pos], 0.0)
+        realised[reason] = cum
+    total_pnl = open_pnl + (realised["stop_loss"] + realised["target"])
+
+    last = n - 1
+    stopped = False
+    if max_loss is not None:
+        breach = np.flatnonzero(total_pnl <= -abs(max_loss))
+        if len(breach):
+            last = int(breach[0])
+            stopped = True
+
+    trades = []
+    for idx, leg_no, seg in events:
+        if idx > last:
+            break
+        trades.append(_trade_row(date, legs[leg_no], seg, seg["exit_reason"], timestamps[idx], seg["exit_price"]))
+
+    # Legs still running after the last processed minute, with the segment
+    # they are in at that point.
+    open_legs = []
+    for leg in legs:
+        close_idx = leg["segments"][-1]["exit_idx"]
+        if close_idx is not None and close_idx <= last:
             continue
-        try:
-            data_class = data_loader(current.strftime('%Y-%m-%d'))
-            data = data_class.load_data()
-            spot_data = pd.DataFrame(data_class.get_data_from_s3(folder='nifty_spot'))
-            #print(data)
-
-            bactest_class = OptionBacktester(data, spot_data, current.strftime('%Y-%m-%d'), 'straddle', strategy_config_path='strategy_config.json')
-            bactest_results = bactest_class.run()
-            print(bactest_results)
-            final_df = pd.concat([final_df, bactest_results], ignore_index=True)
-
-            current += delta
-        except Exception as e:
-            print(f"Error processing date {current.strftime('%Y-%m-%d')}: {e}")
-            current += delta
-
-    final_df.to_csv('backtest_results.csv', index=False)
-    # data_class = data_loader('2025-02-03')
-    # data = data_class.load_data()
-    # #print(data)
-
-    # bactest_class = OptionBacktester(data, '2025-02-03', 'strangle', strategy_config_path='strategy_config.json')
-    # bactest_results = bactest_class.run()
-    # print(bactest_results)
+        seg = [s for s in leg["segments"] if s["active_from"] <= last][-1]
+        open_legs.append((leg, seg))
+
+    # run_day prices every day-end exit off the last candle it looked up,
+    # which is the last leg it visited in the final minute.
+    visited = [leg for leg in legs if leg["segments"][-1]["exit_idx"] is None or leg["segments"][-1]["exit_idx"] >= last]
+    if stopped and open_legs:
+        visited = [leg for leg, _ in open_legs]
+        for leg, seg in open_legs:
+            if leg["has"][last]:
+                trades.append(_trade_row(date, leg, seg, "max_loss_hit", timestamps[last], float(leg["close"][last])))
+        open_legs = [(leg, seg) for leg, seg in open_legs if not leg["has"][last]]
+
+    if open_legs:
+        priced_by = visited[-1]
+        if not priced_by["has"][last]:
+            # run_day raises the same error, for the same leg
+            raise ValueError(f"No candle for {priced_by['type']} {priced_by['strike']} at {pd.Timestamp(timestamps[last])} "
+                             f"to price the day-end exit of the open legs")
+        exit_price = float(priced_by["close"][last])
+        for leg, seg in open_legs:
+            trades.append(_trade_row(date, leg, seg, 'day end', timestamps[last], exit_price))
+    return trades
+
+
+def _trade_row(date, leg, seg, exit_reason, exit_time, exit_price):
+    return {
+        "date": date,
+        "strike": leg["strike"],
+        "type": leg["type"],
+        "exit_reason": exit_reason,
+        "entry_time": seg["entry_time"],
+        "exit_time": exit_time,
+        "entry_price": seg["entry_price"],
+        "exit_price": exit_price,
+        "pnl": seg["entry_price"] - exit_price,
+        "reentry_id": seg["reentries"]
+    }
+
+if __name__ == "__main__":
+    import sys
+    from runner import main
+
+    sys.exit(main())
@@ -0,0 +1,323 @@
+# bench.py
+
+import argparse
+import contextlib
+import copy
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from backtest import OptionBacktester, data_loader
+from biased_straddle import BiDirectionalHedgedStraddleStrategy
+from runner import trading_days
+from storage import LocalStorage
+from synthetic import SyntheticMarket
+
+RESULTS_PATH = 'bench_results.jsonl'
+START_DATE = datetime(2024, 7, 1)
+ENTRY = '09:20'
+
+# Each dimension is swept on its own around BASE, so a row shows how one
+# stage scales with one knob.
+BASE = {'days': 1, 'strikes': 10, 'legs': 2, 'reentries': 2}
+SCALES = {
+    'full': {'days': (1, 3, 5), 'strikes': (5, 10, 20, 40), 'legs': (2, 4, 8), 'reentries': (0, 2, 6)},
+    'quick': {'days': (1, 2), 'strikes': (5, 10), 'legs': (2, 4), 'reentries': (0, 2)},
+}
+# Dimensions each stage is swept over
+STAGE_DIMS = {
+    'load_data': ('days', 'strikes'),
+    'run_day': ('days', 'strikes', 'legs', 'reentries'),
+    'select_strikes': ('strikes',),
+    'update_pnl_and_exit': ('days', 'strikes'),
+}
+STAGES = tuple(STAGE_DIMS)
+ENGINES = ('loop', 'vectorized')
+
+
+def best_of(fn, repeat):
+    # Fastest of `repeat` calls and the last result
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def strategy_config(legs, reentries):
+    # Straddle/strangle pairs moving one strike further out per pair. A tight
+    # stop loss and no day-level max loss make re-entries actually happen.
+    return {
+        'entry_time': ENTRY,
+        'exit_time': '15:15',
+        'stop_loss': 0.05 if reentries else 0.25,
+        'target': 0.5,
+        'reentry_on_sl': reentries > 0,
+        'max_rentries': reentries,
+        'max_loss': 1e9,
+        'legs': [{'type': ('call', 'put')[i % 2], 'otm': i // 2} for i in range(legs)],
+    }
+
+
+class BenchData:
+    # Synthetic day files per chain width, generated once under `root`
+    def __init__(self, root, seed=0):
+        self.root = root
+        self.seed = seed
+        self.frames = {}
+
+    def storage(self, strikes, days):
+        path = os.path.join(self.root, f"strikes_{strikes}")
+        dates = self.dates(days)
+        if not all(os.path.exists(os.path.join(path, 'nifty_options', f"{d}.json")) for d in dates):
+            market = SyntheticMarket(seed=self.seed, strikes_per_side=strikes)
+            market.write(path, START_DATE, datetime.strptime(dates[-1], '%Y-%m-%d'))
+        return LocalStorage(path)
+
+    def dates(self, days):
+        end = START_DATE
+        while len(trading_days(START_DATE, end)) < days:
+            end += pd.Timedelta(days=1)
+        return trading_days(START_DATE, end)
+
+    def day(self, strikes, date):
+        # (options, spot) frames as data_loader returns them
+        key = (strikes, date)
+        if key not in self.frames:
+            days = len(trading_days(START_DATE, datetime.strptime(date, '%Y-%m-%d')))
+            loader = data_loader(date, storage=self.storage(strikes, days))
+            self.frames[key] = (loader.load_data(), loader.load_spot_data())
+        return self.frames[key]
+
+
+def bench_load_data(data, days, strikes, repeat):
+    storage = data.storage(strikes, days)
+    dates = data.dates(days)
+
+    def load():
+        rows = 0
+        for date in dates:
+            loader = data_loader(date, storage=storage)
+            rows += len(loader.load_data()) + len(loader.load_spot_data())
+        return rows
+
+    seconds, rows = best_of(load, repeat)
+    return [{'stage': 'load_data', 'engine': None, 'seconds': seconds, 'rows': rows}]
+
+
+def bench_run_day(data, days, strikes, legs, reentries, repeat, engines, config_dir):
+    config_path = os.path.join(config_dir, f"bench_{legs}_{reentries}.json")
+    with open(config_path, 'w') as f:
+        json.dump({'bench': strategy_config(legs, reentries)}, f)
+    frames = [(date,) + data.day(strikes, date) for date in data.dates(days)]
+
+    rows = []
+    for engine in engines:
+        def run():
+            trades = [OptionBacktester(options, spot, date, 'bench', config_path, engine=engine).run()
+                      for date, options, spot in frames]
+            return trades
+        seconds, trades = best_of(run, repeat)
+        rows.append({'stage': 'run_day', 'engine': engine, 'seconds': seconds,
+                     'rows': sum(len(options) for _, options, _ in frames),
+                     'trades': sum(len(t) for t in trades)})
+    return rows
+
+
+def hedged_frames(data, strikes, days):
+    # The strategy keeps the candle in an `option_data` dict column and
+    # compares datetimes as strings
+    dates = data.dates(days)
+    options = pd.concat([data.day(strikes, date)[0] for date in dates], ignore_index=True)
+    spot = pd.concat([data.day(strikes, date)[1] for date in dates], ignore_index=True)
+    candle = ['datetime', 'open', 'high', 'low', 'close']
+    options = options.assign(option_data=options[candle].to_dict('records'))
+    options['datetime'] = pd.to_datetime(options['datetime']).dt.strftime('%Y-%m-%d %H:%M:%S')
+    spot['datetime'] = pd.to_datetime(spot['datetime']).dt.strftime('%Y-%m-%d %H:%M:%S')
+    return dates[0], options.drop(columns=candle[1:]), spot
+
+
+def bench_select_strikes(data, strikes, repeat):
+    date, options, spot = hedged_frames(data, strikes, 1)
+    strategy = BiDirectionalHedgedStraddleStrategy(date, spot, options, storage=data.storage(strikes, 1))
+    time_str = f"{date} {ENTRY}:00"
+    atm = round(float(spot.loc[spot['datetime'] == time_str, 'close'].iloc[0]) / 50) * 50
+
+    def select():
+        # Includes building the premium index, as a single entry would
+        strategy.premium_index = None
+        return strategy.select_strikes(atm, time_str)
+
+    seconds, _ = best_of(select, repeat)
+    return [{'stage': 'select_strikes', 'engine': None, 'seconds': seconds, 'rows': len(options)}]
+
+
+def bench_update_pnl(data, days, strikes, repeat, engines):
+    # Hold the hedged position from the first day's entry across `days` days,
+    # with per-leg limits wide enough that legs stay open and every minute is
+    # priced.
+    date, options, spot = hedged_frames(data, strikes, days)
+    rows = []
+    for engine in engines:
+        strategy = BiDirectionalHedgedStraddleStrategy(date, spot, options, max_loss=1e9, sl_per_leg=1e6,
+                                                       target_per_leg=1e6, storage=data.storage(strikes, days),
+                                                       engine=engine)
+        strategy.bias = 'positive'
+        strategy.enter_trade(f"{date} {ENTRY}:00")
+        positions = strategy.positions
+
+        def update():
+            # Includes building the vectorized engine's price index, which
+            # it does itself when it has none
+            strategy.positions = copy.deepcopy(positions)
+            strategy.price_index = None
+            strategy.update_pnl_and_exit()
+
+        seconds, _ = best_of(update, repeat)
+        rows.append({'stage': 'update_pnl_and_exit', 'engine': engine, 'seconds': seconds, 'rows': len(options)})
+    return rows
+
+
+def run_benchmarks(data, scales, stages=STAGES, engines=ENGINES, repeat=3):
+    results = []
+
+    def points(dims):
+        # BASE plus each listed dimension varied on its own
+        seen = [dict(BASE)]
+        for dim in dims:
+            for value in scales[dim]:
+                point = dict(BASE, **{dim: value})
+                if point not in seen:
+                    seen.append(point)
+        return seen
+
+    with tempfile.TemporaryDirectory(prefix='bench_config_') as config_dir:
+        for stage in stages:
+            if stage not in STAGE_DIMS:
+                raise ValueError(f"Unknown stage {stage!r}, expected one of {STAGES}")
+            for p in points(STAGE_DIMS[stage]):
+                point = {dim: p[dim] for dim in STAGE_DIMS[stage]}
+                try:
+                    if stage == 'load_data':
+                        rows = bench_load_data(data, p['days'], p['strikes'], repeat)
+                    elif stage == 'run_day':
+                        rows = bench_run_day(data, p['days'], p['strikes'], p['legs'], p['reentries'], repeat,
+                                             engines, config_dir)
+                    elif stage == 'select_strikes':
+                        rows = bench_select_strikes(data, p['strikes'], repeat)
+                    else:
+                        rows = bench_update_pnl(data, p['days'], p['strikes'], repeat, engines)
+                except Exception as e:
+                    # Keep going; the failed point is recorded instead of timed
+                    rows = [{'stage': stage, 'engine': None, 'seconds': None, 'error': f"{type(e).__name__}: {e}"}]
+                results.extend(dict(r, **point) for r in rows)
+            print(f"{stage}: done", file=sys.stderr)
+    return results
+
+
+def git_commit():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def save_run(results, path, label=None, scale=None):
+    # One JSON line per run, so results from different versions accumulate in
+    # the same file
+    commit = git_commit()
+    record = {
+        'label': label or commit,
+        'commit': commit,
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'scale': scale,
+        'results': results,
+    }
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+    return record
+
+
+def load_runs(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+KEY_COLUMNS = ['stage', 'engine', 'days', 'strikes', 'legs', 'reentries']
+
+
+def results_frame(record):
+    # Dimensions a stage is not swept over are left blank
+    df = pd.DataFrame(record['results']).reindex(columns=KEY_COLUMNS + ['seconds', 'rows', 'trades', 'error'])
+    df['engine'] = df['engine'].fillna('-')
+    return df
+
+
+def compare_runs(base, current):
+    # Matching rows of two runs side by side; ratio > 1 means slower now
+    columns = KEY_COLUMNS + ['seconds']
+    merged = results_frame(base)[columns].merge(results_frame(current)[columns], on=KEY_COLUMNS,
+                                                suffixes=('_base', '_now'))
+    merged['ratio'] = merged['seconds_now'] / merged['seconds_base']
+    return merged
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the backtest hot paths on synthetic data.')
+    parser.add_argument('--scale', default='quick', choices=sorted(SCALES))
+    parser.add_argument('--stages', nargs='+', default=list(STAGES), choices=STAGES)
+    parser.add_argument('--engines', nargs='+', default=list(ENGINES), choices=ENGINES)
+    parser.add_argument('--repeat', type=int, default=3, help='timed calls per point, the fastest is kept')
+    parser.add_argument('--data-dir', default=None, help='keep generated day files here (default: a temp dir)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=RESULTS_PATH, help='JSON lines file the run is appended to')
+    parser.add_argument('--label', default=None, help='name for this run (default: git commit)')
+    parser.add_argument('--compare', default=None, help='label of an earlier run in --output to compare against')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    base = None
+    if args.compare:
+        runs = load_runs(args.output) if os.path.exists(args.output) else []
+        matches = [r for r in runs if r['label'] == args.compare]
+        if not matches:
+            print(f"No run labelled {args.compare!r} in {args.output}", file=sys.stderr)
+            return 1
+        base = matches[-1]
+
+    # Generated day files are removed afterwards unless kept in --data-dir
+    data_dir = (contextlib.nullcontext(args.data_dir) if args.data_dir
+                else tempfile.TemporaryDirectory(prefix='bench_data_'))
+    with data_dir as root:
+        data = BenchData(root, seed=args.seed)
+        results = run_benchmarks(data, SCALES[args.scale], args.stages, args.engines, args.repeat)
+    record = save_run(results, args.output, args.label, args.scale)
+
+    with pd.option_context('display.width', 200, 'display.max_rows', None):
+        if base is None:
+            print(results_frame(record).to_string(index=False))
+        else:
+            print(compare_runs(base, record).to_string(index=False))
+    print(f"Run {record['label']!r} appended to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
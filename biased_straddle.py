@@ -1,36 +1,58 @@
 import pandas as pd
 import numpy as np
 from datetime import timedelta
-from datetime import datetime, time, timedelta
 import pandas as pd
 import json
-import boto3
 import json
 from io import BytesIO
-from dotenv import load_dotenv
-import os
 
-# Load environment variables from .env
-load_dotenv()
+from chain import is_compact, price
+from chain_parser import flatten_option_items, iter_json_array
+from price_index import PremiumIndex, PriceIndex
+from profiling import NULL_PROFILE, CountingReader, timed_items
+from result_cache import frame_fingerprint, result_key
+from storage import day_key, default_storage
+from weekly import DayStore, WeeklyAssembler
+
+ENGINES = ('loop', 'vectorized')
+# Bump an engine's version whenever a change to it can alter the positions,
+# so results cached from the old code stop matching
+ENGINE_VERSIONS = {'loop': 2, 'vectorized': 2}
+
+def encode_result(result):
+    # run()'s (positions, entry_time, exit_time) as the JSON the ResultCache
+    # keeps; exit times are Timestamps, stored as ISO text
+    if result is None:
+        return None
+    positions, entry_time, exit_time = result
+    positions = [{**pos, 'exit_time': _iso(pos['exit_time'])} if 'exit_time' in pos else pos for pos in positions]
+    return {'positions': positions, 'entry_time': entry_time, 'exit_time': _iso(exit_time)}
+
+
+def decode_result(value):
+    if value is None:
+        return None
+    positions = [{**pos, 'exit_time': _timestamp(pos['exit_time'])} if 'exit_time' in pos else pos
+                 for pos in value['positions']]
+    return positions, value['entry_time'], _timestamp(value['exit_time'])
+
 
-# Access them
-aws_access_key = os.getenv("AWS_ACCESS_KEY_ID")
-aws_secret_key = os.getenv("AWS_SECRET_ACCESS_KEY")
-aws_region = os.getenv("AWS_DEFAULT_REGION")
+def _iso(ts):
+    return None if ts is None else pd.Timestamp(ts).isoformat()
 
-# S3 setup - use your real keys if not configured globally
-s3 = boto3.client(
-    's3',
-    aws_access_key_id = aws_access_key,
-    aws_secret_access_key = aws_secret_key,
-    region_name = aws_region
-)
 
-bucket_name = 'nifty-options-data-chokli'
+def _timestamp(text):
+    return None if text is None else pd.Timestamp(text)
+
 
 class BiDirectionalHedgedStraddleStrategy:
-    def __init__(self, date,spot_df, options_df, max_loss=4000, sl_per_leg=None, target_per_leg=None):
+    def __init__(self, date,spot_df, options_df, max_loss=4000, sl_per_leg=None, target_per_leg=None, storage=None,
+                 price_index=None, engine='loop', spot_history=None, day_store=None, profile=None,
+                 result_cache=None, hedge_premium=75, premium_index=None):
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine {engine!r}, expected one of {ENGINES}")
         self.date = date
+        self.storage = storage if storage is not None else default_storage()
         self.spot_df = spot_df
         self.options_df = options_df
         self.max_loss = max_loss
@@ -40,6 +62,23 @@ class BiDirectionalHedgedStraddleStrategy:
         self.entry_time = None
         self.exit_time = None
         self.bias = None
+        # Optional PriceIndex over options_df for O(1) price lookups
+        self.price_index = price_index
+        # Hedges are bought at the strike whose premium is nearest this;
+        # a PremiumIndex can be shared between strategies that only differ
+        # in hedge_premium
+        self.hedge_premium = hedge_premium
+        self.premium_index = premium_index
+        self.engine = engine
+        # Optional SpotHistory shared across weeks
+        self.spot_history = spot_history
+        # Optional weekly.DayStore shared between overlapping expiry weeks
+        self.day_store = day_store
+        # profiling.DayProfile for per-phase timings and lookup counts
+        self.profile = profile if profile is not None else NULL_PROFILE
+        # Optional ResultCache keyed on the risk settings, engine and a
+        # fingerprint of spot_df and options_df
+        self.result_cache = result_cache
 
     def calculate_bias(self, friday_920_df):
         friday_920_df['ema_50'] = friday_920_df['close'].ewm(span=50, adjust=False).mean()
@@ -50,64 +89,57 @@ class BiDirectionalHedgedStraddleStrategy:
         else:
             self.bias = "negative"
 
-    def get_data_from_s3(self, folder='nifty_options'):
-        file_key = f"{folder}/{self.date}.json"
-        response = s3.get_object(Bucket=bucket_name, Key=file_key)
-        content = response['Body'].read().decode('utf-8')
-        return json.loads(content)
+    def get_data_from_s3(self, date_str=None, folder='nifty_options'):
+        with self.profile.phase('fetch'):
+            body, _ = self.storage.get(day_key(folder, date_str or self.date_str()))
+            try:
+                content = body.read()
+            finally:
+                body.close()
+        self.profile.count('bytes_fetched', len(content))
+        with self.profile.phase('decode'):
+            return json.loads(content.decode('utf-8'))
     
+    def date_str(self):
+        return self.date if isinstance(self.date, str) else self.date.strftime('%Y-%m-%d')
+
     def load_data(self):
-        data = self.get_data_from_s3()
-        flattened_data = []
-
-        for item in data:
-            base_info = {
-                'date': item['date'],
-                'strike': item['strike'],
-                'atm': item['atm'],
-                'right': item['right'],
-                'expiry': item['expiry']
-            }
-            option_info = item['option_data']
-            
-            # Merge base info with option_data
-            merged = {**base_info, **option_info}
-            flattened_data.append(merged)
-
-        # Create DataFrame
-        flattened_data = pd.DataFrame(flattened_data)
-        return flattened_data
+        profile = self.profile
+        with profile.phase('fetch'):
+            body, _ = self.storage.get(day_key('nifty_options', self.date_str()))
+        try:
+            if not profile.enabled:
+                return flatten_option_items(iter_json_array(body))
+            with profile.phase('flatten'):
+                df = flatten_option_items(timed_items(iter_json_array(CountingReader(body, profile)), profile))
+            profile.count('rows_loaded', len(df))
+            return df
+        finally:
+            body.close()
 
     def get_weekly_data(self):
-        date_str = self.date.strftime('%Y-%m-%d')
-        option_data = self.get_data_from_s3(date_str, 'nifty_options')
-        expiry = option_data[0]['expiry']
-        expiry = datetime.strptime(expiry.replace('Z', ''), "%Y-%m-%dT%H:%M:%S.%f")
-        option_data = self.load_data(option_data)
-
-        delta = timedelta(days=1)
-        current = self.date + delta
-
-        while current <= expiry:
-            date_str = current.strftime('%Y-%m-%d')
-            try:
-                fetched_data = self.get_data_from_s3(date_str, 'nifty_options')
-                fetched_data = self.load_data(fetched_data)
-                option_data = pd.concat([option_data, fetched_data]).reset_index(drop =True)
-            except Exception as e:
-                print(f"❌ Error fetching data for {date_str}: {e}")
-                pass
-            
-            current += delta
-
-        return option_data
+        # Entry day through expiry in one concat, with days shared through the
+        # day store; the week's price index is kept for get_option_price.
+        if self.day_store is None:
+            self.day_store = DayStore(storage=self.storage)
+        with self.profile.phase('weekly_data'):
+            week = WeeklyAssembler(self.day_store).assemble(self.date)
+        self.profile.count('rows_loaded', len(week.data))
+        for date_str, e in week.missing.items():
+            print(f"❌ Error fetching data for {date_str}: {e}")
+        self.price_index = week.index
+        return week.data
     
     def calculate_ema(self,series, period):
         return series.ewm(span=period, adjust=False).mean()
 
     def get_spot_hourly_data(self):
-        
-        
+        if self.spot_history is not None:
+            # Served from the shared history, nothing is refetched or resampled again
+            with self.profile.phase('spot_history'):
+                self.spot_df = self.spot_history.minute_window(self.date)
+                return self.spot_history.hourly(self.date)
+
         start_date = self.date - timedelta(days=7)
         delta = timedelta(1)
         current = start_date
@@ -124,21 +156,35 @@ class BiDirectionalHedgedStraddleStrategy:
                 pass
             current += delta
 
-        final_data['datetime'] = pd.to_datetime(final_data['datetime'])
-        self.spot_df = final_data.copy()
-        spot_df = final_data.set_index('datetime')
+        with self.profile.phase('resample'):
+            final_data['datetime'] = pd.to_datetime(final_data['datetime'])
+            self.spot_df = final_data.copy()
+            spot_df = final_data.set_index('datetime')
 
-        # Resample from 9:15 to 10:15, 10:15 to 11:15, etc.
-        spot_hourly = spot_df.resample('1H', offset='15min').last()
+            # Resample from 9:15 to 10:15, 10:15 to 11:15, etc.
+            spot_hourly = spot_df.resample('1h', offset='15min').last()
 
-        # Now calculate EMAs
-        spot_hourly['ema_50'] = self.calculate_ema(spot_hourly['close'], 50)
-        spot_hourly['ema_100'] = self.calculate_ema(spot_hourly['close'], 100)
+            # Now calculate EMAs
+            spot_hourly['ema_50'] = self.calculate_ema(spot_hourly['close'], 50)
+            spot_hourly['ema_100'] = self.calculate_ema(spot_hourly['close'], 100)
 
         return spot_hourly
 
     def get_option_price(self, dt, strike, right):
+        self.profile.count('lookups')
+        if self.price_index is not None:
+            return self.price_index.price(dt, strike, right, 'open')
         df = self.options_df
+        if is_compact(df):
+            # Typed chain from chain.compact_chain: parsed datetimes, a
+            # lower-case categorical right and float32 prices
+            mask = (
+                (df['datetime'] == pd.Timestamp(dt)) &
+                (df['strike'] == strike) &
+                (df['right'] == right.lower())
+            )
+            filtered = df[mask]
+            return price(filtered['open'].iloc[0]) if not filtered.empty else None
         mask = (
             (df['datetime'] == dt) &
             (df['strike'] == strike) &
@@ -149,28 +195,28 @@ class BiDirectionalHedgedStraddleStrategy:
             return float(filtered.iloc[0]['option_data']['open'])  # You can use 'ltp' if available
         return None
 
-    def select_strikes(self, atm, time_str):
-        # Get call and put hedges based on ~70–75 premium
-        calls = self.options_df[
-            (self.options_df['datetime'] == time_str) &
-            (self.options_df['right'].str.lower() == 'call')
-        ]
-        puts = self.options_df[
-            (self.options_df['datetime'] == time_str) &
-            (self.options_df['right'].str.lower() == 'put')
-        ]
-
-        def find_strike(df, target_premium):
-            df = df.copy()
-            df['premium'] = df['option_data'].apply(lambda x: float(x['open']))
-            df['diff'] = abs(df['premium'] - target_premium)
-            return df.sort_values(by='diff').iloc[0]['strike'] if not df.empty else None
-
-        call_hedge_strike = find_strike(calls, 75)
-        put_hedge_strike = find_strike(puts, 75)
+    def select_strikes(self, atm, time_str, target_premium=None):
+        # Call and put hedges: the strikes whose premium at time_str is nearest
+        # the target (hedge_premium unless given), from the premium index
+        target = self.hedge_premium if target_premium is None else target_premium
+        index = self.get_premium_index()
+        call_hedge_strike = index.strike(time_str, 'call', target)
+        put_hedge_strike = index.strike(time_str, 'put', target)
 
         return call_hedge_strike, put_hedge_strike
 
+    def get_premium_index(self):
+        if self.premium_index is None:
+            with self.profile.phase('premium_index'):
+                if self.price_index is None and self.engine == 'vectorized':
+                    # Built here rather than in update_pnl_and_exit_vectorized
+                    self.price_index = PriceIndex.from_frame(self.options_df)
+                if self.price_index is not None:
+                    self.premium_index = PremiumIndex(self.price_index)
+                else:
+                    self.premium_index = PremiumIndex.from_frame(self.options_df)
+        return self.premium_index
+
     def enter_trade(self, time_str):
         spot_price = float(self.spot_df[self.spot_df['datetime'] == time_str]['close'].iloc[0])
         atm = round(spot_price / 50) * 50
@@ -203,6 +249,8 @@ class BiDirectionalHedgedStraddleStrategy:
         self.entry_time = time_str
 
     def update_pnl_and_exit(self):
+        if self.engine == 'vectorized':
+            return self.update_pnl_and_exit_vectorized()
         total_pnl = 0
         for time_str in self.spot_df[self.spot_df['datetime'] > self.entry_time]['datetime']:
             for pos in self.positions:
@@ -216,9 +264,11 @@ class BiDirectionalHedgedStraddleStrategy:
 
                 if self.sl_per_leg and pnl < -self.sl_per_leg:
                     pos['exit_price'] = price_now
+                    pos['exit_time'] = time_str
                     pos['active'] = False
                 elif self.target_per_leg and pnl > self.target_per_leg:
                     pos['exit_price'] = price_now
+                    pos['exit_time'] = time_str
                     pos['active'] = False
 
             total_pnl = sum(
@@ -232,15 +282,122 @@ class BiDirectionalHedgedStraddleStrategy:
                 for pos in self.positions:
                     if pos['active']:
                         pos['exit_price'] = self.get_option_price(time_str, pos['strike'], pos['right'])
+                        pos['exit_time'] = time_str
                         pos['active'] = False
                 self.exit_time = time_str
                 break
 
-    def run(self,date):
+    def update_pnl_and_exit_vectorized(self):
+        # Same exits as the minute loop above: each position's open-price path
+        # over the holding period is read from the price index once, per-leg
+        # SL/target exits are first crossings, and max_loss is the first minute
+        # the summed P&L of the still-open legs breaches.
+        if self.price_index is None:
+            with self.profile.phase('price_index'):
+                self.price_index = PriceIndex.from_frame(self.options_df)
+        times = list(self.spot_df[self.spot_df['datetime'] > self.entry_time]['datetime'])
+        if not times:
+            return
+        self.profile.count('minutes', len(times))
+        self.profile.count('lookups', len(self.positions))
+        unpriced = [pos for pos in self.positions if 'active' not in pos]
+        if unpriced:
+            # A leg with no price at entry has no state; the minute loop fails
+            # on it as well (a KeyError when it reads pos['active'])
+            pos = unpriced[0]
+            raise ValueError(f"No entry price for {pos['type']} {pos['right']} {pos['strike']} "
+                             f"at {self.entry_time}, the position has no 'active' state")
+
+        minute_pos = self.price_index.locate_minutes(times)
+        n = len(times)
+        paths = []
+        for pos in self.positions:
+            path, present = self.price_index.path(pos['strike'], pos['right'], minute_pos, 'open')
+            if pos['type'] == 'sell':
+                pnl = pos['entry_price'] - path
+            else:
+                pnl = path - pos['entry_price']
+            exit_idx = n if pos['active'] else -1
+            if pos['active']:
+                with np.errstate(invalid='ignore'):
+                    hit = np.zeros(n, dtype=bool)
+                    if self.sl_per_leg:
+                        hit |= pnl < -self.sl_per_leg
+                    if self.target_per_leg:
+                        hit |= pnl > self.target_per_leg
+                crossed = np.flatnonzero(hit & present)
+                if len(crossed):
+                    exit_idx = int(crossed[0])
+            paths.append({"path": path, "present": present, "pnl": pnl, "exit_idx": exit_idx})
+
+        # P&L of the legs still open after each minute's exits, summed in
+        # position order like the generator in the loop.
+        total_pnl = np.zeros(n)
+        missing = np.zeros(n, dtype=bool)
+        for leg in paths:
+            still_open = np.arange(n) < leg["exit_idx"]
+            total_pnl = total_pnl + np.where(still_open, leg["pnl"], 0.0)
+            missing |= still_open & ~leg["present"]
+
+        breach = np.flatnonzero(total_pnl <= -self.max_loss)
+        last = int(breach[0]) if len(breach) else n
+        broken = np.flatnonzero(missing[:last + 1])
+        if len(broken):
+            # The loop cannot sum a leg with no price; fail at the same minute
+            last = int(broken[0])
+
+        for pos, leg in zip(self.positions, paths):
+            k = leg["exit_idx"]
+            if 0 <= k < n and k <= last:
+                pos['exit_price'] = float(leg["path"][k])
+                pos['exit_time'] = times[k]
+                pos['active'] = False
+
+        if len(broken):
+            # An open leg without a candle at this minute leaves the day's P&L
+            # undefined; the minute loop fails here too (a TypeError when it
+            # subtracts the missing price)
+            for pos, leg in zip(self.positions, paths):
+                if pos['active'] and not leg["present"][last]:
+                    raise ValueError(f"No open price for {pos['type']} {pos['right']} {pos['strike']} "
+                                     f"at {times[last]} while the position is open")
+        if last < n:
+            for pos, leg in zip(self.positions, paths):
+                if pos['active']:
+                    pos['exit_price'] = float(leg["path"][last]) if leg["present"][last] else None
+                    pos['exit_time'] = times[last]
+                    pos['active'] = False
+            self.exit_time = times[last]
+
+    def result_key(self, date):
+        config = {'max_loss': self.max_loss, 'sl_per_leg': self.sl_per_leg, 'target_per_leg': self.target_per_leg,
+                  'hedge_premium': self.hedge_premium}
+        fingerprint = frame_fingerprint(self.spot_df, self.options_df)
+        return result_key('hedged_straddle', config, self.engine, ENGINE_VERSIONS[self.engine], date, fingerprint)
+
+    def run(self, date):
+        if self.result_cache is None:
+            return self.run_uncached(date)
+        # Fingerprint before running, which adds columns to spot_df
+        key = self.result_key(date)
+        hit, cached = self.result_cache.lookup(key)
+        if hit:
+            self.profile.count('result_cache_hits')
+            cached = decode_result(cached)
+            if cached is not None:
+                self.positions, self.entry_time, self.exit_time = cached
+            return cached
+        result = self.run_uncached(date)
+        self.result_cache.put(key, encode_result(result))
+        return result
+
+    def run_uncached(self,date):
+        profile = self.profile
         # 1. Find Friday 9:20 AM row
-        self.spot_df['datetime'] = pd.to_datetime(self.spot_df['datetime'])
-        self.spot_df['date'] = self.spot_df['datetime'].dt.date
-        self.spot_df['time'] = self.spot_df['datetime'].dt.time
+        with profile.phase('parse_datetime'):
+            self.spot_df['datetime'] = pd.to_datetime(self.spot_df['datetime'])
+            self.spot_df['date'] = self.spot_df['datetime'].dt.date
+            self.spot_df['time'] = self.spot_df['datetime'].dt.time
 
         #for date in sorted(self.spot_df['date'].unique()):
         friday_920_time = pd.to_datetime(f"{date} 09:20:00")
@@ -252,9 +409,12 @@ class BiDirectionalHedgedStraddleStrategy:
         if len(df_till_920) < 100:
             return
 
-        self.calculate_bias(df_till_920)
-        self.enter_trade(friday_920_time.strftime('%Y-%m-%d %H:%M:%S'))
-        self.update_pnl_and_exit()
+        with profile.phase('bias'):
+            self.calculate_bias(df_till_920)
+        with profile.phase('enter_trade'):
+            self.enter_trade(friday_920_time.strftime('%Y-%m-%d %H:%M:%S'))
+        with profile.phase('update_pnl'):
+            self.update_pnl_and_exit()
 
           # Only first Friday, break after one week
 
@@ -0,0 +1,114 @@
+# chain.py
+
+import numpy as np
+import pandas as pd
+
+RIGHTS = ('call', 'put')
+PRICE_COLUMNS = ('open', 'high', 'low', 'close')
+INT_COLUMNS = ('strike', 'atm')
+# Quotes carry two decimals; float32 keeps them to well within half a paisa
+# for any option price, so rounding on the way back out restores them exactly
+PRICE_DECIMALS = 2
+
+
+def minute_of_day(hhmm):
+    # 'HH:MM' -> minutes since midnight
+    hours, minutes = hhmm.split(':')
+    return int(hours) * 60 + int(minutes)
+
+
+def is_compact(df):
+    return 'minute' in df.columns and isinstance(df['right'].dtype, pd.CategoricalDtype)
+
+
+def compact_chain(df):
+    """Typed copy of a flattened option chain (``data_loader.load_data``).
+
+    ``datetime`` is parsed once and ``minute`` (minute of day, int16) added
+    next to it, strikes are int32, ``right`` is a lower-case categorical and
+    the OHLC columns are float32. Remaining float columns become float32 and
+    string columns categoricals, which for the per-day constants (date,
+    expiry) costs one code byte a row. Row order and index are kept; frames
+    that are already compact are returned unchanged.
+    """
+    if is_compact(df):
+        return df
+    columns = {}
+    for col in df.columns:
+        series = df[col]
+        if col == 'datetime':
+            series = pd.to_datetime(series)
+            columns[col] = series
+            columns['minute'] = (series.dt.hour * 60 + series.dt.minute).astype(np.int16)
+        elif col == 'right':
+            values = series.str.lower()
+            categories = list(RIGHTS) + sorted(set(values.dropna()) - set(RIGHTS))
+            columns[col] = values.astype(pd.CategoricalDtype(categories))
+        elif col in INT_COLUMNS and pd.api.types.is_numeric_dtype(series) and not series.isna().any():
+            columns[col] = series.astype(np.int32)
+        elif col in PRICE_COLUMNS or pd.api.types.is_float_dtype(series):
+            columns[col] = series.astype(np.float32)
+        elif pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series):
+            if series.map(lambda v: isinstance(v, str)).all():
+                columns[col] = series.astype('category')
+            else:
+                columns[col] = series
+        else:
+            columns[col] = series
+    return pd.DataFrame(columns, index=df.index)
+
+
+def price_array(df, columns=PRICE_COLUMNS):
+    # float64 prices, with float32 columns rounded back to the quoted value
+    columns = list(columns)
+    values = df[columns].to_numpy(dtype=np.float64)
+    if any(df[col].dtype == np.float32 for col in columns):
+        values = np.round(values, PRICE_DECIMALS)
+    return values
+
+
+def price(value):
+    # Scalar counterpart of price_array
+    if isinstance(value, np.float32):
+        return round(float(value), PRICE_DECIMALS)
+    return float(value)
+
+
+def widen_prices(df):
+    # Copy of a compact chain whose OHLC columns are float64 again, for the
+    # engines that read prices row by row
+    df = df.copy()
+    present = [col for col in PRICE_COLUMNS if col in df.columns]
+    if present:
+        widened = price_array(df, present)
+        for i, col in enumerate(present):
+            df[col] = widened[:, i]
+    return df
+
+
+def strike_window(atm, n, step=50):
+    # ATM and n strikes either side of it
+    return [atm + i * step for i in range(-n, n + 1)]
+
+
+def select_rows(df, legs=None, strikes=None, rights=None, start=None, end=None):
+    # Rows of a compact chain for the given (strike, right) legs, strikes
+    # and rights, between the 'HH:MM' minutes start and end inclusive. Any
+    # filter left as None keeps everything.
+    mask = np.ones(len(df), dtype=bool)
+    if legs is not None:
+        in_legs = np.zeros(len(df), dtype=bool)
+        strike_values = df['strike'].to_numpy()
+        right_values = df['right'].to_numpy()
+        for strike, right in set((int(strike), right.lower()) for strike, right in legs):
+            in_legs |= (strike_values == strike) & (right_values == right)
+        mask &= in_legs
+    if strikes is not None:
+        mask &= df['strike'].isin([int(strike) for strike in strikes]).to_numpy()
+    if rights is not None:
+        mask &= df['right'].isin([right.lower() for right in rights]).to_numpy()
+    if start is not None:
+        mask &= (df['minute'] >= minute_of_day(start)).to_numpy()
+    if end is not None:
+        mask &= (df['minute'] <= minute_of_day(end)).to_numpy()
+    return df[mask]
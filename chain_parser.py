@@ -0,0 +1,179 @@
+# chain_parser.py
+
+import codecs
+import json
+import math
+from array import array
+
+import numpy as np
+import pandas as pd
+
+BASE_FIELDS = ('date', 'strike', 'atm', 'right', 'expiry')
+CHUNK_SIZE = 1 << 16
+
+_decoder = json.JSONDecoder()
+_MISSING = object()
+
+
+def iter_json_array(stream, chunk_size=CHUNK_SIZE):
+    # Yield the elements of a top-level JSON array one at a time while reading
+    # the underlying byte stream in chunks, so the whole document never has to
+    # be decoded into one list.
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    pos = 0
+    eof = False
+    started = False
+
+    def fill():
+        nonlocal buf, pos, eof
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            eof = True
+            buf = buf[pos:] + utf8.decode(b'', final=True)
+        else:
+            buf = buf[pos:] + (utf8.decode(chunk) if isinstance(chunk, bytes) else chunk)
+        pos = 0
+
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n':
+            pos += 1
+        if pos == len(buf):
+            if eof:
+                raise ValueError("Unexpected end of JSON array")
+            fill()
+            continue
+
+        char = buf[pos]
+        if not started:
+            if char != '[':
+                raise ValueError("Expected a JSON array")
+            started = True
+            pos += 1
+            continue
+        if char == ']':
+            return
+        if char == ',':
+            pos += 1
+            continue
+
+        try:
+            item, end = _decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            fill()
+            continue
+        if end == len(buf) and not eof:
+            # A bare number may continue in the next chunk
+            fill()
+            continue
+        pos = end
+        yield item
+
+
+class _Column:
+    # Grows as a typed array while every value is an int or float and drops to
+    # a plain list the first time it sees anything else; pandas then infers the
+    # dtype of that list exactly as it would for the list-of-dicts frame. With
+    # `size`, the row count, known up front the storage is allocated once at
+    # that length and filled in place; otherwise it grows by appending.
+    __slots__ = ('kind', 'values', 'length', 'size')
+
+    def __init__(self, size=None):
+        self.kind = None
+        self.values = None
+        self.length = 0
+        self.size = size
+
+    def append(self, value):
+        kind = self.kind
+        if kind == 'int':
+            if type(value) is not int or not -(1 << 63) <= value < (1 << 63):
+                if type(value) is float or value is _MISSING:
+                    self.values = array('d', self.values)
+                    self.kind = 'float'
+                    value = math.nan if value is _MISSING else value
+                else:
+                    self._to_list()
+        elif kind == 'float':
+            if type(value) is not float:
+                if type(value) is int and -(1 << 53) <= value <= (1 << 53):
+                    value = float(value)
+                elif value is _MISSING:
+                    value = math.nan
+                else:
+                    self._to_list()
+        elif kind == 'list':
+            if value is _MISSING:
+                value = math.nan
+        elif type(value) is int and -(1 << 63) <= value < (1 << 63):
+            self.kind, self.values = 'int', self._allocate(array('q', [0]))
+        elif type(value) is float:
+            self.kind, self.values = 'float', self._allocate(array('d', [0.0]))
+        else:
+            self._to_list()
+            if value is _MISSING:
+                value = math.nan
+        values = self.values
+        n = self.length
+        if n < len(values):
+            values[n] = value
+        else:
+            values.append(value)
+        self.length = n + 1
+
+    def pad(self, count):
+        # Rows seen before this column first appeared are missing
+        for _ in range(count):
+            self.append(_MISSING)
+
+    def _allocate(self, one):
+        # `one` repeated for every row, or empty when the count is unknown
+        return one * self.size if self.size else one[:0]
+
+    def _to_list(self):
+        values = self.values[:self.length].tolist() if self.kind in ('int', 'float') else []
+        self.kind = 'list'
+        self.values = values + self._allocate([None])[len(values):]
+
+    def to_array(self):
+        if self.kind == 'int':
+            return np.frombuffer(self.values, dtype=np.int64)[:self.length]
+        if self.kind == 'float':
+            return np.frombuffer(self.values, dtype=np.float64)[:self.length]
+        return self.values[:self.length] if self.values is not None else []
+
+
+def flatten_option_items(items, size=None):
+    # Columnar equivalent of merging base fields with option_data per row and
+    # building a DataFrame from the resulting list of dicts. `size` is the
+    # item count if known (taken from len() of a list); a streamed array does
+    # not say how many items it holds, so its columns grow as they fill.
+    if size is None and hasattr(items, '__len__'):
+        size = len(items)
+    columns = {}
+    rows = 0
+    for item in items:
+        option_info = item['option_data']
+        for key in BASE_FIELDS:
+            # option_data wins over the base field of the same name, as in the dict merge
+            _append(columns, key, option_info[key] if key in option_info else item[key], rows, size)
+        for key, value in option_info.items():
+            if key not in BASE_FIELDS:
+                _append(columns, key, value, rows, size)
+        rows += 1
+        for column in columns.values():
+            if column.length < rows:
+                column.append(_MISSING)
+    if not columns:
+        return pd.DataFrame()
+    return pd.DataFrame({key: column.to_array() for key, column in columns.items()})
+
+
+def _append(columns, key, value, rows, size=None):
+    column = columns.get(key)
+    if column is None:
+        column = columns[key] = _Column(size)
+        column.pad(rows)
+    column.append(value)
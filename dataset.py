@@ -0,0 +1,235 @@
+# dataset.py
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from backtest import data_loader, default_storage
+from chain import compact_chain, minute_of_day
+from day_cache import read_frame, write_frame
+from storage import day_key
+
+DEFAULT_DATASET_DIR = 'chain_dataset'
+OPTIONS_FOLDER = 'nifty_options'
+SPOT_FOLDER = 'nifty_spot'
+
+
+class ChainDataset:
+    """Local copy of the bucket's days, laid out so a backtest reads only
+    the legs it trades.
+
+    Each option day is a directory ``{root}/nifty_options/{date}/`` holding
+    the compact chain (``chain.compact_chain``) one ``.npy`` file per column,
+    rows ordered by (right, strike, datetime), plus ``meta.json`` with the row
+    range of every (right, strike) and ``minutes.npy``, the full chain's
+    minute grid. ``read`` memory-maps the columns and copies only the row
+    ranges of the selected legs, cut to the requested minutes, so I/O and
+    memory follow the legs rather than the width of the chain. Spot days are
+    small and stored whole as ``{root}/nifty_spot/{date}.npz``.
+
+    The source object's ETag is kept with each day and returned by ``head``,
+    so the dataset can stand in for the storage when fingerprinting days.
+    """
+
+    def __init__(self, root=DEFAULT_DATASET_DIR):
+        self.root = root
+        self._meta = {}
+
+    def day_dir(self, date):
+        return os.path.join(self.root, OPTIONS_FOLDER, date)
+
+    def spot_path(self, date):
+        return os.path.join(self.root, SPOT_FOLDER, f"{date}.npz")
+
+    def contains(self, date):
+        return (os.path.exists(os.path.join(self.day_dir(date), 'meta.json'))
+                and os.path.exists(self.spot_path(date)))
+
+    def dates(self):
+        options_dir = os.path.join(self.root, OPTIONS_FOLDER)
+        if not os.path.isdir(options_dir):
+            return []
+        return sorted(date for date in os.listdir(options_dir) if self.contains(date))
+
+    def head(self, key):
+        # ETag of the source object `key` ('{folder}/{date}.json') the day
+        # was built from
+        folder, name = key.split('/')
+        date = name[:-len('.json')]
+        if folder == SPOT_FOLDER:
+            if not os.path.exists(self.spot_path(date)):
+                raise FileNotFoundError(self.spot_path(date))
+            with open(self.spot_path(date) + '.etag') as f:
+                return f.read() or None
+        return self.meta(date)['etag']
+
+    def write_day(self, date, options, spot, options_etag=None, spot_etag=None):
+        # options: the flattened chain (plain or compact); spot: the spot frame
+        chain = compact_chain(options)
+        if len(chain):
+            order = np.lexsort((chain['datetime'].to_numpy(), chain['strike'].to_numpy(),
+                                chain['right'].cat.codes.to_numpy()))
+            chain = chain.iloc[order].reset_index(drop=True)
+
+        parts = []
+        if len(chain):
+            keys = pd.DataFrame({'right': chain['right'].astype(str), 'strike': chain['strike'].astype(np.int64)})
+            starts = np.flatnonzero(keys.ne(keys.shift()).any(axis=1).to_numpy())
+            stops = np.append(starts[1:], len(chain))
+            for start, stop in zip(starts, stops):
+                parts.append([keys['right'].iat[start], int(keys['strike'].iat[start]), int(start), int(stop)])
+
+        columns = []
+        arrays = {}
+        for i, col in enumerate(chain.columns):
+            series = chain[col]
+            entry = {'name': col, 'dtype': str(series.dtype)}
+            if isinstance(series.dtype, pd.CategoricalDtype):
+                entry['categories'] = [str(c) for c in series.cat.categories]
+                arrays[i] = series.cat.codes.to_numpy()
+            else:
+                arrays[i] = series.to_numpy()
+            columns.append(entry)
+        minutes = np.unique(chain['datetime'].to_numpy()) if len(chain) else np.array([], dtype='datetime64[ns]')
+        meta = {'date': date, 'rows': len(chain), 'etag': options_etag, 'columns': columns, 'parts': parts}
+
+        options_dir = os.path.join(self.root, OPTIONS_FOLDER)
+        os.makedirs(options_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=options_dir, prefix='.tmp-')
+        try:
+            for i, values in arrays.items():
+                np.save(os.path.join(tmp_dir, f"{i}.npy"), values)
+            np.save(os.path.join(tmp_dir, 'minutes.npy'), minutes)
+            with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+            day_dir = self.day_dir(date)
+            if os.path.exists(day_dir):
+                shutil.rmtree(day_dir)
+            os.replace(tmp_dir, day_dir)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        self._meta.pop(date, None)
+
+        spot_dir = os.path.join(self.root, SPOT_FOLDER)
+        os.makedirs(spot_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=spot_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write_frame(f, spot)
+            with open(self.spot_path(date) + '.etag', 'w') as f:
+                f.write(spot_etag or '')
+            os.replace(tmp_path, self.spot_path(date))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def meta(self, date):
+        if date not in self._meta:
+            with open(os.path.join(self.day_dir(date), 'meta.json')) as f:
+                self._meta[date] = json.load(f)
+        return self._meta[date]
+
+    def minutes(self, date):
+        return np.load(os.path.join(self.day_dir(date), 'minutes.npy'))
+
+    def read_spot(self, date):
+        return read_frame(self.spot_path(date))
+
+    def read(self, date, legs=None, strikes=None, rights=None, start=None, end=None):
+        # Compact chain rows for the selected legs, same filters as
+        # chain.select_rows; only those row ranges are read from disk
+        meta = self.meta(date)
+        if legs is not None:
+            legs = set((int(strike), right.lower()) for strike, right in legs)
+        if strikes is not None:
+            strikes = set(int(strike) for strike in strikes)
+        if rights is not None:
+            rights = set(right.lower() for right in rights)
+        ranges = [(first, stop) for right, strike, first, stop in meta['parts']
+                  if (legs is None or (strike, right) in legs)
+                  and (strikes is None or strike in strikes)
+                  and (rights is None or right in rights)]
+
+        day_dir = self.day_dir(date)
+        columns = meta['columns']
+        arrays = [np.load(os.path.join(day_dir, f"{i}.npy"), mmap_mode='r') for i in range(len(columns))]
+        names = [entry['name'] for entry in columns]
+        if (start is not None or end is not None) and ranges:
+            # Rows of each leg are in time order: cut every range to the
+            # minute window with a binary search on its datetimes
+            times = arrays[names.index('datetime')]
+            day = np.datetime64(date, 'm')
+            lo = day + np.timedelta64(minute_of_day(start), 'm') if start is not None else None
+            hi = day + np.timedelta64(minute_of_day(end) + 1, 'm') if end is not None else None
+            cut = []
+            for first, stop in ranges:
+                block = times[first:stop]
+                a = first + int(np.searchsorted(block, lo, 'left')) if lo is not None else first
+                b = first + int(np.searchsorted(block, hi, 'left')) if hi is not None else stop
+                if a < b:
+                    cut.append((a, b))
+            ranges = cut
+        rows = np.concatenate([np.arange(a, b) for a, b in ranges]) if ranges else np.zeros(0, dtype=np.intp)
+
+        data = {}
+        for entry, values in zip(columns, arrays):
+            taken = np.asarray(values[rows])
+            if 'categories' in entry:
+                dtype = pd.CategoricalDtype(entry['categories'])
+                data[entry['name']] = pd.Categorical.from_codes(taken, dtype=dtype)
+            else:
+                data[entry['name']] = taken
+        return pd.DataFrame(data)
+
+
+def build_dataset(dataset, dates, storage=None, cache=None, skip_existing=True):
+    # Fetch, flatten and store each date from the bucket (or a LocalStorage
+    # mirror). Returns {date: error} for the days that could not be built.
+    storage = storage if storage is not None else default_storage()
+    failed = {}
+    for date in dates:
+        if skip_existing and dataset.contains(date):
+            continue
+        try:
+            loader = data_loader(date, cache=cache, storage=storage)
+            options = loader.load_data()
+            spot = loader.load_spot_data()
+            dataset.write_day(date, options, spot, options_etag=storage.head(day_key(OPTIONS_FOLDER, date)),
+                              spot_etag=storage.head(day_key(SPOT_FOLDER, date)))
+        except Exception as e:
+            failed[date] = e
+    return failed
+
+
+def main(argv=None):
+    from runner import trading_days
+    from storage import LocalStorage
+
+    parser = argparse.ArgumentParser(description='Build the local partitioned chain dataset from the bucket.')
+    parser.add_argument('--start', required=True, help='first date, YYYY-MM-DD')
+    parser.add_argument('--end', required=True, help='last date, YYYY-MM-DD')
+    parser.add_argument('--root', default=DEFAULT_DATASET_DIR, help='dataset directory')
+    parser.add_argument('--data-dir', default=None, help='read day files from this directory instead of S3')
+    parser.add_argument('--rebuild', action='store_true', help='rebuild days that are already in the dataset')
+    args = parser.parse_args(argv)
+
+    dates = trading_days(datetime.strptime(args.start, '%Y-%m-%d'), datetime.strptime(args.end, '%Y-%m-%d'))
+    storage = LocalStorage(args.data_dir) if args.data_dir else None
+    failed = build_dataset(ChainDataset(args.root), dates, storage=storage, skip_existing=not args.rebuild)
+    print(f"{len(dates) - len(failed)} of {len(dates)} day(s) in {args.root}")
+    for date, e in failed.items():
+        print(f"  {date}: {type(e).__name__}: {e}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
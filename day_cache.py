@@ -0,0 +1,202 @@
+# day_cache.py
+
+import json
+import os
+import re
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_CACHE_DIR = '.day_cache'
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+
+class DayCache:
+    """Local on-disk cache of flattened per-day DataFrames.
+
+    Each entry is one ``.npz`` file holding the frame column by column (see
+    ``write_frame``), stored at ``{root}/{folder}/{date}__{etag}.npz``. File
+    modification times double as the LRU clock: reads touch the file, and
+    writes evict the least recently used entries until the cache fits in
+    ``max_bytes``.
+
+    By default a cached day is trusted as it is: a day re-uploaded to the
+    bucket keeps being served from the old entry until that is evicted or
+    the cache cleared. With ``revalidate`` (``BACKTEST_CACHE_REVALIDATE=1``,
+    or ``runner.py --revalidate``) readers head the source first and only
+    take the entry stored under its current ETag.
+    """
+
+    def __init__(self, root=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, revalidate=False):
+        self.root = root
+        self.max_bytes = max_bytes
+        # When set, callers should check the source ETag before trusting a hit
+        self.revalidate = revalidate
+
+    @classmethod
+    def from_env(cls):
+        root = os.getenv('BACKTEST_CACHE_DIR', DEFAULT_CACHE_DIR)
+        max_mb = os.getenv('BACKTEST_CACHE_MAX_MB')
+        max_bytes = int(float(max_mb) * 1024 ** 2) if max_mb else DEFAULT_MAX_BYTES
+        revalidate = os.getenv('BACKTEST_CACHE_REVALIDATE', '').strip().lower() in ('1', 'true', 'yes', 'on')
+        return cls(root, max_bytes=max_bytes, revalidate=revalidate)
+
+    def revalidating(self):
+        # The same cache, with readers checking the source ETags
+        return type(self)(self.root, max_bytes=self.max_bytes, revalidate=True)
+
+    def get(self, folder, date, etag=None):
+        path = self._find(folder, date, etag)
+        if path is None:
+            return None
+        try:
+            df = read_frame(path)
+        except (OSError, ValueError, KeyError):
+            # Truncated or foreign file, treat as a miss
+            self._remove(path)
+            return None
+        os.utime(path)
+        return df
+
+    def contains(self, folder, date, etag=None):
+        return self._find(folder, date, etag) is not None
+
+    def put(self, folder, date, etag, df):
+        folder_dir = os.path.join(self.root, folder)
+        os.makedirs(folder_dir, exist_ok=True)
+        for stale in self._entries(folder, date):
+            self._remove(stale)
+        path = os.path.join(folder_dir, f"{date}__{_clean_etag(etag)}.npz")
+        fd, tmp_path = tempfile.mkstemp(dir=folder_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write_frame(f, df)
+            os.replace(tmp_path, path)
+        except BaseException:
+            self._remove(tmp_path)
+            raise
+        self.evict()
+        return path
+
+    def evict(self):
+        entries = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if not name.endswith('.npz'):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def clear(self):
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if name.endswith('.npz'):
+                    self._remove(os.path.join(dirpath, name))
+
+    def _entries(self, folder, date):
+        folder_dir = os.path.join(self.root, folder)
+        if not os.path.isdir(folder_dir):
+            return []
+        prefix = f"{date}__"
+        return [os.path.join(folder_dir, name) for name in os.listdir(folder_dir)
+                if name.startswith(prefix) and name.endswith('.npz')]
+
+    def _find(self, folder, date, etag):
+        if etag is not None:
+            path = os.path.join(self.root, folder, f"{date}__{_clean_etag(etag)}.npz")
+            return path if os.path.exists(path) else None
+        entries = self._entries(folder, date)
+        if not entries:
+            return None
+        return max(entries, key=os.path.getmtime)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def write_frame(f, df):
+    # One .npz member per column plus a JSON list of names and dtypes. Nothing
+    # is pickled, so files are read back with allow_pickle=False: string
+    # columns are stored as fixed-width unicode, other object columns as
+    # integer codes into the JSON texts of their distinct values. A column
+    # whose values JSON cannot hold raises TypeError.
+    arrays = {}
+    meta = []
+    for i, col in enumerate(df.columns):
+        series = df[col]
+        values = series.to_numpy()
+        entry = {'name': col, 'dtype': str(series.dtype), 'kind': 'plain'}
+        if values.dtype == object or not isinstance(series.dtype, np.dtype):
+            values = series.to_numpy(dtype=object)
+            nulls = pd.isna(values)
+            if all(isinstance(v, str) for v in values[~nulls]):
+                filled = values.copy()
+                filled[nulls] = ''
+                arrays[f"n{i}"] = nulls
+                values = filled.astype(str)
+                entry['kind'] = 'str'
+            else:
+                # Factorized on each value's JSON text, which also takes
+                # unhashable values such as dicts; -1 marks a null
+                try:
+                    texts = [json.dumps(v, default=_json_scalar) for v in values[~nulls]]
+                except (TypeError, ValueError) as e:
+                    raise TypeError(f"Column {col!r} holds values that cannot be stored without pickling") from e
+                codes = np.full(len(values), -1, dtype=np.int64)
+                codes[~nulls], categories = pd.factorize(np.array(texts, dtype=object))
+                arrays[f"k{i}"] = np.asarray(categories, dtype=str)
+                values = codes
+                entry['kind'] = 'codes'
+        arrays[f"c{i}"] = values
+        meta.append(entry)
+    arrays['meta'] = np.array(json.dumps(meta))
+    np.savez(f, **arrays)
+
+
+def read_frame(path):
+    columns = {}
+    with np.load(path, allow_pickle=False) as npz:
+        meta = json.loads(str(npz['meta']))
+        for i, entry in enumerate(meta):
+            values = npz[f"c{i}"]
+            if entry['kind'] == 'str':
+                values = values.astype(object)
+                values[npz[f"n{i}"]] = None
+            elif entry['kind'] == 'codes':
+                # Filled one by one, so list values stay single elements; the
+                # trailing None is what code -1 picks
+                texts = npz[f"k{i}"]
+                categories = np.empty(len(texts) + 1, dtype=object)
+                for j, text in enumerate(texts):
+                    categories[j] = json.loads(str(text))
+                values = categories[values]
+            else:
+                columns[entry['name']] = pd.Series(values, dtype=entry['dtype'])
+                continue
+            columns[entry['name']] = pd.Series(values, dtype=object).astype(entry['dtype'])
+    return pd.DataFrame(columns)
+
+
+def _json_scalar(value):
+    # numpy scalars in an object column, as the Python values JSON takes
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _clean_etag(etag):
+    return re.sub(r'[^A-Za-z0-9_-]', '', str(etag)) or 'none'
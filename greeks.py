@@ -0,0 +1,198 @@
+# greeks.py
+
+import math
+
+import numpy as np
+import pandas as pd
+
+# Bump when chain_greeks changes; the DayCache folder the per-day Greeks
+# are kept under carries it, so cached days are recomputed
+GREEKS_VERSION = 1
+GREEKS_FOLDER = f'nifty_greeks_v{GREEKS_VERSION}'
+# Options expire at the close on the expiry date
+EXPIRY_CLOSE = pd.Timedelta(hours=15, minutes=30)
+MINUTES_PER_YEAR = 365 * 24 * 60
+RISK_FREE = 0.065
+MIN_VOL = 1e-4
+MAX_VOL = 5.0
+IV_TOLERANCE = 1e-6
+IV_ITERATIONS = 60
+GREEKS_COLUMNS = ('datetime', 'strike', 'right', 'spot', 'years', 'iv', 'delta', 'gamma', 'vega', 'theta')
+
+
+def norm_cdf(x):
+    # Abramowitz & Stegun 7.1.26, accurate to ~1e-7, so NumPy is enough
+    x = np.asarray(x, dtype=float)
+    z = np.abs(x) / math.sqrt(2.0)
+    t = 1.0 / (1.0 + 0.3275911 * z)
+    poly = t * (0.254829592 + t * (-0.284496736 + t * (1.421413741 + t * (-1.453152027 + t * 1.061405429))))
+    erf = 1.0 - poly * np.exp(-z * z)
+    return 0.5 * (1.0 + np.sign(x) * erf)
+
+
+def norm_pdf(x):
+    x = np.asarray(x, dtype=float)
+    return np.exp(-0.5 * x * x) / math.sqrt(2.0 * math.pi)
+
+
+def _d1(spot, strike, years, vol, rate):
+    return (np.log(spot / strike) + (rate + 0.5 * vol * vol) * years) / (vol * np.sqrt(years))
+
+
+def bs_price(spot, strike, years, vol, is_call, rate=RISK_FREE):
+    years = np.maximum(years, 1e-6)
+    sqrt_t = np.sqrt(years)
+    d1 = _d1(spot, strike, years, vol, rate)
+    d2 = d1 - vol * sqrt_t
+    discount = strike * np.exp(-rate * years)
+    call = spot * norm_cdf(d1) - discount * norm_cdf(d2)
+    put = discount * norm_cdf(-d2) - spot * norm_cdf(-d1)
+    return np.where(is_call, call, put)
+
+
+def implied_vol(prices, spot, strike, years, is_call, rate=RISK_FREE):
+    # Black-Scholes volatility that reprices each option, all at once: Newton
+    # steps kept inside a bisection bracket, so deep out-of-the-money quotes
+    # with next to no vega still converge. NaN where the price is outside
+    # the no-arbitrage bounds or an input is missing.
+    prices, spot, strike, years, is_call = np.broadcast_arrays(
+        np.asarray(prices, dtype=float), np.asarray(spot, dtype=float), np.asarray(strike, dtype=float),
+        np.maximum(np.asarray(years, dtype=float), 1e-6), np.asarray(is_call, dtype=bool))
+    discount = strike * np.exp(-rate * years)
+    lower = np.where(is_call, np.maximum(spot - discount, 0.0), np.maximum(discount - spot, 0.0))
+    upper = np.where(is_call, spot, discount)
+    valid = np.isfinite(prices) & np.isfinite(spot) & (prices > lower) & (prices < upper)
+
+    lo = np.full(prices.shape, MIN_VOL)
+    hi = np.full(prices.shape, MAX_VOL)
+    vol = np.full(prices.shape, 0.2)
+    active = valid.copy()
+    for _ in range(IV_ITERATIONS):
+        if not active.any():
+            break
+        p, s, k, t, c, v = (a[active] for a in (prices, spot, strike, years, is_call, vol))
+        diff = bs_price(s, k, t, v, c, rate) - p
+        above = diff > 0
+        hi[active] = np.where(above, v, hi[active])
+        lo[active] = np.where(above, lo[active], v)
+        vega = s * norm_pdf(_d1(s, k, t, v, rate)) * np.sqrt(t)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            step = v - diff / vega
+        inside = np.isfinite(step) & (step > lo[active]) & (step < hi[active])
+        vol[active] = np.where(inside, step, 0.5 * (lo[active] + hi[active]))
+        done = (np.abs(diff) < IV_TOLERANCE) | (hi[active] - lo[active] < IV_TOLERANCE)
+        active[np.flatnonzero(active)[done]] = False
+    return np.where(valid, vol, np.nan)
+
+
+def bs_greeks(spot, strike, years, vol, is_call, rate=RISK_FREE):
+    # {'delta', 'gamma', 'vega', 'theta'}; vega per vol point (0.01) and
+    # theta per calendar day, both in premium terms
+    years = np.maximum(np.asarray(years, dtype=float), 1e-6)
+    sqrt_t = np.sqrt(years)
+    d1 = _d1(spot, strike, years, vol, rate)
+    d2 = d1 - vol * sqrt_t
+    pdf = norm_pdf(d1)
+    discount = strike * np.exp(-rate * years)
+    decay = -spot * pdf * vol / (2 * sqrt_t)
+    return {
+        'delta': np.where(is_call, norm_cdf(d1), norm_cdf(d1) - 1.0),
+        'gamma': pdf / (spot * vol * sqrt_t),
+        'vega': spot * pdf * sqrt_t / 100,
+        'theta': np.where(is_call, decay - rate * discount * norm_cdf(d2),
+                          decay + rate * discount * norm_cdf(-d2)) / 365,
+    }
+
+
+def years_to_expiry(times, expiry):
+    # Year fractions from each candle to the close on its expiry date
+    expiry = pd.Series(expiry).astype(str)
+    codes, labels = pd.factorize(expiry)
+    dates = pd.to_datetime(pd.Series(labels), utc=True).dt.tz_convert(None).dt.normalize() + EXPIRY_CLOSE
+    close = dates.to_numpy()[codes]
+    minutes = (close - pd.to_datetime(pd.Series(times)).to_numpy()) / np.timedelta64(1, 'm')
+    return np.asarray(minutes, dtype=float) / MINUTES_PER_YEAR
+
+
+def chain_greeks(df, data_spot, field='close', rate=RISK_FREE):
+    """Implied volatility and Greeks of every candle of a flattened chain.
+
+    ``df`` is a plain or compact (``chain.compact_chain``) chain with its
+    ``expiry`` column; each candle's ``field`` price is matched against the
+    spot ``field`` of the same minute. Returns one row per chain row, in the
+    same order, with datetime, strike, right, spot and years to expiry next
+    to iv, delta, gamma, vega and theta. Candles with no spot for their
+    minute, or a price no volatility can produce, get NaN.
+    """
+    times = pd.to_datetime(df['datetime']).to_numpy()
+    spot_times = pd.to_datetime(data_spot['datetime']).to_numpy()
+    spot_prices = data_spot[field].to_numpy(dtype=float)
+    order = np.argsort(spot_times, kind='stable')
+    spot_times, spot_prices = spot_times[order], spot_prices[order]
+    pos = np.minimum(np.searchsorted(spot_times, times), max(len(spot_times) - 1, 0))
+    spot = np.full(len(times), np.nan)
+    if len(spot_times):
+        found = spot_times[pos] == times
+        spot[found] = spot_prices[pos[found]]
+
+    strike = df['strike'].to_numpy(dtype=float)
+    right = df['right'].astype(str).str.lower().to_numpy()
+    is_call = right == 'call'
+    years = years_to_expiry(times, df['expiry'])
+    prices = np.round(df[field].to_numpy(dtype=float), 2)
+    iv = implied_vol(prices, spot, strike, years, is_call, rate)
+    greeks = bs_greeks(spot, strike, years, iv, is_call, rate)
+    return pd.DataFrame({
+        'datetime': times,
+        'strike': df['strike'].to_numpy(dtype=np.int64),
+        'right': right,
+        'spot': spot,
+        'years': years,
+        'iv': iv,
+        **greeks,
+    })
+
+
+def entry_greeks(greeks, entry_time):
+    # Rows of the first minute at or after entry_time ('HH:MM') that has any
+    # Greeks at all
+    times = pd.to_datetime(greeks['datetime'])
+    usable = (times.dt.strftime('%H:%M') >= entry_time).to_numpy() & np.isfinite(greeks['delta'].to_numpy())
+    if not usable.any():
+        return greeks.iloc[:0]
+    first = times[usable].min()
+    return greeks[(times == first).to_numpy()]
+
+
+def first_minute_greeks(minutes, rows_at, data_spot, entry_time, field='close'):
+    # chain_greeks of the first of `minutes` (a chain's minute grid) at or
+    # after entry_time ('HH:MM') that has any usable delta, worked out for
+    # that minute alone: the rows entry_greeks would pick out of the whole
+    # chain's Greeks. rows_at(minute) returns the chain rows of one minute.
+    # Empty if no minute has any.
+    minutes = np.sort(np.asarray(minutes, dtype='datetime64[ns]'))
+    after_entry = np.asarray(pd.DatetimeIndex(minutes).strftime('%H:%M') >= entry_time)
+    for minute in minutes[after_entry]:
+        greeks = chain_greeks(rows_at(minute), data_spot, field)
+        if np.isfinite(greeks['delta'].to_numpy()).any():
+            return greeks
+    return pd.DataFrame({col: [] for col in GREEKS_COLUMNS})
+
+
+def chain_minutes(chain):
+    # (minute grid, rows_at) of a chain frame held in memory, for
+    # first_minute_greeks
+    times = pd.to_datetime(chain['datetime']).to_numpy()
+    return np.unique(times), lambda minute: chain[times == minute]
+
+
+def delta_strike(greeks, right, target):
+    # Strike whose |delta| is closest to |target| among the rows of one
+    # minute; the lower strike on a tie, None if there is no candidate
+    rows = greeks[(greeks['right'] == right.lower()).to_numpy() & np.isfinite(greeks['delta'].to_numpy())]
+    if rows.empty:
+        return None
+    distance = np.abs(np.abs(rows['delta'].to_numpy()) - abs(target))
+    strikes = rows['strike'].to_numpy()
+    best = np.lexsort((strikes, distance))[0]
+    return int(strikes[best])
@@ -0,0 +1,304 @@
+# incremental.py
+
+from collections import deque
+from itertools import chain
+
+import numpy as np
+import pandas as pd
+
+WAITING, ACTIVE, PENDING, CLOSED = 'waiting', 'active', 'pending', 'closed'
+
+
+class LegState:
+    __slots__ = ('strike', 'type', 'status', 'entry_time', 'entry_price', 'sl_price', 'tgt_price', 'reentries')
+
+    def __init__(self, strike, opt_type):
+        self.strike = strike
+        self.type = opt_type
+        # waiting for its first candle at or after entry_time
+        self.status = WAITING
+        self.entry_time = None
+        self.entry_price = None
+        self.sl_price = None
+        self.tgt_price = None
+        self.reentries = 0
+
+
+class IncrementalBacktester:
+    """run_day's stop-loss, target, re-entry and max_loss rules, fed one
+    candle at a time.
+
+    Candles for any strike go to ``on_candle`` in time order; those that are
+    not one of the legs only advance the clock, as every minute of the chain
+    does in run_day. A minute is settled when a candle for a later minute
+    arrives, on ``close_minute()``, or at ``finish()``. Settling costs O(legs);
+    each candle is O(1). Trade records are appended to ``trade_log`` and
+    passed to ``on_trade`` as they are settled.
+
+    A leg re-entered on a stop loss is marked against its next candle's open
+    on the stop-loss minute itself, as in run_day, so that minute's max_loss
+    check waits until the leg's next candle has been seen. Later minutes are
+    held back until then.
+
+    Fed a day's candles in time order, this produces the same trade log as
+    run_day. The one exception is a leg whose first candle arrives after
+    max_loss has already stopped the day: run_day knows about that candle in
+    advance, but a live feed cannot.
+    """
+
+    def __init__(self, config, date, strike_pairs, on_trade=None):
+        self.config = config
+        self.date = date
+        self.entry_cutoff = config['entry_time']
+        self.stop_loss = config['stop_loss']
+        self.target = config['target']
+        self.reentry = config.get('reentry_on_sl', False)
+        self.reentry_no = config.get('max_rentries', 0)
+        self.max_loss = config.get('max_loss', None)
+        self.on_trade = on_trade
+
+        self.legs = [LegState(strike, opt_type) for strike, opt_type in strike_pairs]
+        self._leg_pos = {}
+        for i, (strike, opt_type) in enumerate(strike_pairs):
+            self._leg_pos.setdefault((strike, opt_type), []).append(i)
+
+        self.trade_log = []
+        self.static_sl = 0
+        self.static_trgt = 0
+        self.stopped = False
+        self.finished = False
+        self.last_timestamp = None
+        # Candle of the last lookup run_day would have made, and its leg;
+        # day-end exits are priced off it
+        self._last_lookup = None
+        self._last_leg = None
+        # Minute being filled: timestamp and {leg position: (o, h, l, c)}
+        self._minute = None
+        self._candles = {}
+        # Complete minutes waiting to be settled, oldest first
+        self._queue = deque()
+        # Minute whose max_loss check waits for re-entry prices:
+        # (timestamp, candles, per-leg P&L terms, pending leg positions)
+        self._deferred = None
+
+    def on_candle(self, timestamp, strike, right, ohlc):
+        # Returns the trade records settled by this candle
+        if self.stopped or self.finished:
+            return []
+        if self._minute is not None and timestamp < self._minute:
+            raise ValueError(f"Candle at {timestamp} arrived after {self._minute}; feed candles in time order")
+        emitted = []
+        if timestamp != self._minute:
+            if self._minute is not None:
+                emitted = self._close_current()
+            self._minute = timestamp
+            self._candles = {}
+        for i in self._leg_pos.get((strike, right.lower()), ()):
+            # Where a minute repeats, the first candle wins
+            if i not in self._candles:
+                self._candles[i] = ohlc
+                if self._deferred is not None and i in self._deferred[3]:
+                    emitted.extend(self._settle())
+        return emitted
+
+    def close_minute(self):
+        # The current minute is complete (e.g. the live feed's bar closed)
+        if self._minute is None or self.stopped or self.finished:
+            return []
+        emitted = self._close_current()
+        self._minute = None
+        self._candles = {}
+        return emitted
+
+    def finish(self):
+        # End of the day: settle everything left and close open legs
+        if self.finished:
+            return []
+        emitted = self.close_minute()
+        while self._deferred is not None and not self.stopped:
+            # No more candles are coming; settle with what has been seen
+            emitted.extend(self._settle(final=True))
+        self.finished = True
+
+        open_legs = [leg for leg in self.legs if leg.status == ACTIVE]
+        if open_legs:
+            if self._last_lookup is None:
+                # run_day raises the same error, for the same leg
+                leg = self._last_leg
+                raise ValueError(f"No candle for {leg.type} {leg.strike} at {self.last_timestamp} "
+                                 f"to price the day-end exit of the open legs")
+            exit_price = float(self._last_lookup[3])
+            for leg in open_legs:
+                emitted.append(self._record(leg, 'day end', self.last_timestamp, exit_price))
+        return emitted
+
+    def _close_current(self):
+        self._queue.append((self._minute, self._candles))
+        return self._settle()
+
+    def _settle(self, final=False):
+        # Settle queued minutes in order, stopping at one that has to wait
+        emitted = []
+        if self._deferred is not None:
+            timestamp, candles, terms, pending = self._deferred
+            if not self._resolve(timestamp, pending, final):
+                return emitted
+            self._deferred = None
+            emitted.extend(self._check_max_loss(timestamp, candles, terms, pending))
+        while self._queue and not self.stopped and self._deferred is None:
+            timestamp, candles = self._queue.popleft()
+            emitted.extend(self._process_minute(timestamp, candles))
+        if self.stopped:
+            self._queue.clear()
+            self._minute = None
+            self._candles = {}
+        return emitted
+
+    def _resolve(self, timestamp, pending, final=False):
+        # Re-enter each pending leg at its next candle. Returns False while any
+        # has not been seen yet, unless this is the end of the day, when those
+        # legs simply stay closed as in run_day.
+        nexts = {}
+        for i in pending:
+            for later, candles in chain(self._queue, [(self._minute, self._candles)]):
+                if later is not None and later > timestamp and i in candles:
+                    nexts[i] = (later, candles[i])
+                    break
+            else:
+                if not final:
+                    return False
+        for i in pending:
+            leg = self.legs[i]
+            if i not in nexts:
+                leg.status = CLOSED
+                continue
+            later, ohlc = nexts[i]
+            self._enter(leg, later, ohlc[0])
+            leg.reentries += 1
+        return True
+
+    def _enter(self, leg, timestamp, open_price):
+        entry_price = float(open_price)
+        leg.entry_time = timestamp
+        leg.entry_price = entry_price
+        leg.sl_price = entry_price * (1 + self.stop_loss)
+        leg.tgt_price = entry_price * (1 - self.target) if self.target else None
+        leg.status = ACTIVE
+
+    def _process_minute(self, timestamp, candles):
+        emitted = []
+        self.last_timestamp = timestamp
+        can_enter = timestamp.strftime('%H:%M') >= self.entry_cutoff
+        terms = []
+        pending = []
+        for i, leg in enumerate(self.legs):
+            if leg.status == WAITING:
+                if not can_enter or i not in candles:
+                    continue
+                self._enter(leg, timestamp, candles[i][0])
+            if leg.status != ACTIVE:
+                continue
+            ohlc = candles.get(i)
+            self._last_lookup = ohlc
+            self._last_leg = leg
+            if ohlc is None:
+                continue
+            high_price = float(ohlc[1])
+            low_price = float(ohlc[2])
+
+            if leg.tgt_price and low_price <= leg.tgt_price:
+                emitted.append(self._record(leg, 'target', timestamp, low_price))
+                leg.status = CLOSED
+                self.static_trgt += leg.entry_price - low_price
+                continue
+
+            if high_price >= leg.sl_price:
+                emitted.append(self._record(leg, 'stop_loss', timestamp, high_price))
+                leg.status = CLOSED
+                self.static_sl += leg.entry_price - high_price
+                if self.reentry and leg.reentries < self.reentry_no:
+                    # Marked below once the next candle's open is known
+                    leg.status = PENDING
+                    pending.append(i)
+                    terms.append((i, float(ohlc[3])))
+                continue
+
+            terms.append((i, leg.entry_price - float(ohlc[3])))
+
+        if pending:
+            if not self._resolve(timestamp, pending):
+                self._deferred = (timestamp, candles, terms, pending)
+                return emitted
+        emitted.extend(self._check_max_loss(timestamp, candles, terms, pending))
+        return emitted
+
+    def _check_max_loss(self, timestamp, candles, terms, pending):
+        # Legs' P&L summed in leg order as run_day does; for a leg re-entered
+        # on this minute's stop loss the term is the candle's close, marked
+        # against the new entry price
+        total_pnl = 0
+        for i, term in terms:
+            if i in pending:
+                leg = self.legs[i]
+                if leg.status != ACTIVE:
+                    continue
+                total_pnl += leg.entry_price - term
+            else:
+                total_pnl += term
+        total_pnl += self.static_sl + self.static_trgt
+        if self.max_loss is None or total_pnl > -abs(self.max_loss):
+            return []
+
+        emitted = []
+        for i, leg in enumerate(self.legs):
+            if leg.status != ACTIVE:
+                continue
+            ohlc = candles.get(i)
+            self._last_lookup = ohlc
+            self._last_leg = leg
+            if ohlc is not None:
+                emitted.append(self._record(leg, 'max_loss_hit', timestamp, float(ohlc[3])))
+                leg.status = CLOSED
+        self.stopped = True
+        return emitted
+
+    def _record(self, leg, exit_reason, exit_time, exit_price):
+        trade = {
+            "date": self.date,
+            "strike": leg.strike,
+            "type": leg.type,
+            "exit_reason": exit_reason,
+            "entry_time": leg.entry_time,
+            "exit_time": exit_time,
+            "entry_price": leg.entry_price,
+            "exit_price": exit_price,
+            "pnl": leg.entry_price - exit_price,
+            "reentry_id": leg.reentries,
+        }
+        self.trade_log.append(trade)
+        if self.on_trade is not None:
+            self.on_trade(trade)
+        return trade
+
+
+def replay_day(engine, day_data, minutes=None):
+    # Feed a day's option candles to the engine in time order (rows sharing a
+    # minute keep their order) and finish the day. Returns the trade log.
+    # `minutes`, the chain's minute grid when day_data holds only some of its
+    # rows, is fed as candles of no leg so the clock ticks as it would.
+    day_data = day_data.sort_values('datetime', kind='stable')
+    timestamps = pd.to_datetime(day_data['datetime'])
+    strikes = day_data['strike'].tolist()
+    rights = day_data['right'].str.lower().tolist()
+    ohlc = day_data[['open', 'high', 'low', 'close']].to_numpy(dtype=float).tolist()
+    if minutes is not None:
+        ticks = pd.Series(pd.DatetimeIndex(minutes))
+        order = np.argsort(np.concatenate([ticks.to_numpy(), timestamps.to_numpy()]), kind='stable')
+        timestamps = pd.concat([ticks, timestamps], ignore_index=True).iloc[order]
+        strikes = [strikes[i - len(ticks)] if i >= len(ticks) else None for i in order]
+        rights = [rights[i - len(ticks)] if i >= len(ticks) else '' for i in order]
+        ohlc = [ohlc[i - len(ticks)] if i >= len(ticks) else None for i in order]
+    for timestamp, strike, right, candle in zip(timestamps, strikes, rights, ohlc):
+        engine.on_candle(timestamp, strike, right, candle)
+    engine.finish()
+    return engine.trade_log
@@ -0,0 +1,350 @@
+# jobs.py
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import pandas as pd
+
+from backtest import ENGINES
+from dataset import ChainDataset
+from day_cache import DayCache
+from result_cache import ResultCache
+from runner import ERROR_COLUMNS, run_single_day, trading_days
+from storage import LocalStorage
+from trade_log import TradeLogSink
+
+DEFAULT_JOBS_DIR = 'jobs'
+DEFAULT_MAX_ATTEMPTS = 3
+# A claim whose worker has not finished or failed within this long is
+# treated as a crashed attempt and the unit is handed out again
+DEFAULT_LEASE_SECONDS = 30 * 60
+PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+
+
+class Job:
+    """A date range x strategies backtest split into (date, strategy) units
+    and coordinated through a shared directory.
+
+    ``{dir}/manifest.json`` lists the units and how to run them, with the
+    strategy config copied next to it so every host runs the same settings.
+    Workers on any number of hosts claim an attempt at a unit by creating
+    ``units/{date}__{strategy}.{attempt}.claim`` with O_EXCL, so exactly one
+    of them gets it; finished units get a ``.done`` checkpoint after their
+    trades are in the job's trade log (``{dir}/trade_log``), failed attempts
+    a ``.failed`` record. A unit is retried until it has failed
+    ``max_attempts`` times. Claims left behind by a worker that died (its
+    process is gone, or the lease ran out) count as failed attempts.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        self.units_dir = os.path.join(path, 'units')
+        self.config_path = os.path.join(path, 'strategy_config.json')
+        self.sink = TradeLogSink(os.path.join(path, 'trade_log'))
+
+    @classmethod
+    def create(cls, root, start_date, end_date, strategies, strategy_config_path='strategy_config.json',
+               engine='loop', job_id=None, max_attempts=DEFAULT_MAX_ATTEMPTS, data_dir=None, dataset=None,
+               compact=False):
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine {engine!r}, expected one of {ENGINES}")
+        with open(strategy_config_path) as f:
+            configs = json.load(f)
+        missing = [name for name in strategies if name not in configs]
+        if missing:
+            raise KeyError(f"Strategies not in {strategy_config_path}: {missing}")
+
+        job_id = job_id or datetime.now().strftime('%Y%m%d-%H%M%S')
+        path = os.path.join(root, job_id)
+        os.makedirs(root, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=root, prefix='.tmp-')
+        try:
+            os.makedirs(os.path.join(tmp_dir, 'units'))
+            with open(os.path.join(tmp_dir, 'strategy_config.json'), 'w') as f:
+                json.dump({name: configs[name] for name in strategies}, f, indent=2)
+            manifest = {
+                'job_id': job_id,
+                'created': datetime.now().isoformat(timespec='seconds'),
+                'start': start_date.strftime('%Y-%m-%d'),
+                'end': end_date.strftime('%Y-%m-%d'),
+                'strategies': list(strategies),
+                'engine': engine,
+                'max_attempts': max_attempts,
+                # Paths as given; every host must see them at the same place
+                'data_dir': data_dir,
+                'dataset': dataset,
+                'compact': compact,
+                'units': [[day, name] for day in trading_days(start_date, end_date) for name in strategies],
+            }
+            with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as f:
+                json.dump(manifest, f, indent=2)
+            # Fails if the job already exists rather than replacing it
+            os.rename(tmp_dir, path)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        return cls(path)
+
+    def units(self):
+        return [tuple(unit) for unit in self.manifest['units']]
+
+    def states(self, lease=DEFAULT_LEASE_SECONDS):
+        # {(date, strategy): (state, attempts made)} from one directory listing
+        files = {}
+        for name in os.listdir(self.units_dir):
+            uid, _, rest = name.partition('.')
+            files.setdefault(uid, set()).add(rest)
+        states = {}
+        for date, strategy in self.units():
+            names = files.get(_unit_id(date, strategy), set())
+            claims = sorted(int(n.split('.')[0]) for n in names if n.endswith('.claim'))
+            attempts = claims[-1] if claims else 0
+            if 'done' in names:
+                state = DONE
+            elif attempts and f"{attempts}.failed" not in names and not self._expired(date, strategy, attempts, lease):
+                state = RUNNING
+            elif self._failures(names, claims, date, strategy, lease) >= self.manifest['max_attempts']:
+                state = FAILED
+            else:
+                state = PENDING
+            states[(date, strategy)] = (state, attempts)
+        return states
+
+    def claim(self, date, strategy, lease=DEFAULT_LEASE_SECONDS):
+        # The attempt number if this process now owns the unit, else None
+        state, attempts = self.states(lease).get((date, strategy), (None, 0))
+        if state != PENDING:
+            return None
+        if attempts and not os.path.exists(self._file(date, strategy, f"{attempts}.failed")):
+            # The previous attempt's worker is gone; record it as a failure
+            self._write(self._file(date, strategy, f"{attempts}.failed"),
+                        _error_row(date, strategy, 'ClaimExpired', 'worker stopped without finishing the unit', ''))
+        attempt = attempts + 1
+        try:
+            fd = os.open(self._file(date, strategy, f"{attempt}.claim"), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return None
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'host': socket.gethostname(), 'pid': os.getpid(), 'claimed': time.time()}, f)
+        return attempt
+
+    def release(self, date, strategy, attempt):
+        # Give a claim back without counting it as an attempt (e.g. Ctrl-C)
+        try:
+            os.remove(self._file(date, strategy, f"{attempt}.claim"))
+        except FileNotFoundError:
+            pass
+
+    def complete(self, date, strategy, attempt, trades):
+        self.sink.append(trades, strategy, date)
+        self._write(self._file(date, strategy, 'done'), {
+            'attempt': attempt,
+            'host': socket.gethostname(),
+            'trades': 0 if trades is None else len(trades),
+            'finished': time.time(),
+        })
+
+    def fail(self, date, strategy, attempt, error):
+        self._write(self._file(date, strategy, f"{attempt}.failed"), error)
+
+    def errors(self):
+        # The last error of every unit that used up its attempts
+        rows = []
+        for (date, strategy), (state, attempts) in self.states().items():
+            if state == FAILED:
+                with open(self._file(date, strategy, f"{attempts}.failed")) as f:
+                    rows.append(json.load(f))
+        return pd.DataFrame(rows, columns=ERROR_COLUMNS)
+
+    def summary(self, lease=DEFAULT_LEASE_SECONDS):
+        counts = {PENDING: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+        for state, _ in self.states(lease).values():
+            counts[state] += 1
+        return counts
+
+    def export(self, output, errors_path=None):
+        # Trade log CSV (with a strategy column) and, if any unit failed for
+        # good, the error report. Returns (trades, failed units).
+        trades = self.sink.reader().to_csv(output, self.manifest['start'], self.manifest['end'],
+                                           self.manifest['strategies'])
+        errors = self.errors()
+        if errors_path and not errors.empty:
+            errors.to_csv(errors_path, index=False)
+        return trades, len(errors)
+
+    def _failures(self, names, claims, date, strategy, lease):
+        failed = sum(1 for n in names if n.endswith('.failed'))
+        if claims and f"{claims[-1]}.failed" not in names and self._expired(date, strategy, claims[-1], lease):
+            failed += 1
+        return failed
+
+    def _expired(self, date, strategy, attempt, lease):
+        path = self._file(date, strategy, f"{attempt}.claim")
+        try:
+            with open(path) as f:
+                claim = json.load(f)
+            claimed = os.path.getmtime(path)
+        except (FileNotFoundError, ValueError):
+            # Being written or already released
+            return False
+        if claim.get('host') == socket.gethostname() and not _alive(claim.get('pid')):
+            return True
+        return time.time() - claimed > lease
+
+    def _file(self, date, strategy, suffix):
+        return os.path.join(self.units_dir, f"{_unit_id(date, strategy)}.{suffix}")
+
+    def _write(self, path, record):
+        fd, tmp_path = tempfile.mkstemp(dir=self.units_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(record, f, default=str)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+def work(job_path, lease=DEFAULT_LEASE_SECONDS, max_units=None):
+    # One worker: claim and run units in manifest order until none is left
+    # to claim. Units running elsewhere are skipped, not waited for. Returns
+    # the number of units this worker finished.
+    job = Job(job_path)
+    manifest = job.manifest
+    storage = LocalStorage(manifest['data_dir']) if manifest['data_dir'] else None
+    dataset = ChainDataset(manifest['dataset']) if manifest['dataset'] else None
+    cache = DayCache.from_env()
+    result_cache = ResultCache.from_env()
+    finished = 0
+    for date, strategy in job.units():
+        if max_units is not None and finished >= max_units:
+            break
+        attempt = job.claim(date, strategy, lease)
+        if attempt is None:
+            continue
+        try:
+            trades = run_single_day(date, strategy, job.config_path, manifest['engine'], cache, storage,
+                                    result_cache=result_cache, compact=manifest['compact'], dataset=dataset)
+        except KeyboardInterrupt:
+            job.release(date, strategy, attempt)
+            raise
+        except Exception as e:
+            job.fail(date, strategy, attempt,
+                     _error_row(date, strategy, type(e).__name__, str(e), traceback.format_exc()))
+            continue
+        job.complete(date, strategy, attempt, trades)
+        finished += 1
+    return finished
+
+
+def run_workers(job_path, workers=None, lease=DEFAULT_LEASE_SECONDS):
+    # `workers` local processes working on the job side by side. A unit
+    # that fails is handed out again on the next pass, until every unit is
+    # done or out of attempts; units other hosts are running are left to
+    # them.
+    workers = workers or os.cpu_count() or 1
+    job = Job(job_path)
+    while True:
+        if workers == 1:
+            work(job_path, lease)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                for future in [pool.submit(work, job_path, lease) for _ in range(workers)]:
+                    future.result()
+        if job.summary(lease)[PENDING] == 0:
+            return job.summary(lease)
+
+
+def _unit_id(date, strategy):
+    return f"{date}__{strategy}"
+
+
+def _alive(pid):
+    if pid is None:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _error_row(date, strategy, error_type, message, tb):
+    return {'date': date, 'strategy': strategy, 'error_type': error_type, 'message': message, 'traceback': tb}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Checkpointed batch backtests shared through a job directory.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    create = commands.add_parser('create', help='write the manifest of (date, strategy) units for a new job')
+    create.add_argument('--start', required=True, help='first date, YYYY-MM-DD')
+    create.add_argument('--end', required=True, help='last date, YYYY-MM-DD')
+    create.add_argument('--strategies', nargs='+', default=['straddle'], help='strategy names in the config file')
+    create.add_argument('--config', default='strategy_config.json', help='strategy config path')
+    create.add_argument('--engine', default='loop', choices=ENGINES)
+    create.add_argument('--root', default=DEFAULT_JOBS_DIR, help='shared directory the job is created in')
+    create.add_argument('--job-id', default=None, help='job name (default: creation time)')
+    create.add_argument('--max-attempts', type=int, default=DEFAULT_MAX_ATTEMPTS, help='tries per unit')
+    create.add_argument('--data-dir', default=None, help='read day files from this directory instead of S3')
+    create.add_argument('--dataset', default=None, help='chain dataset directory (see dataset.py)')
+    create.add_argument('--compact', action='store_true', help='load chains with compact typed columns')
+
+    for name, help_text in (('work', 'claim and run units of a job'),
+                            ('resume', 'run only the units of a job that are not done yet')):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument('job', help='job directory')
+        command.add_argument('--workers', type=int, default=None, help='worker processes (default: CPU count)')
+        command.add_argument('--lease', type=float, default=DEFAULT_LEASE_SECONDS,
+                             help='seconds before an unfinished claim from another host is taken over')
+
+    status = commands.add_parser('status', help='count units by state')
+    status.add_argument('job', help='job directory')
+
+    export = commands.add_parser('export', help='write the trade log and error report of a job')
+    export.add_argument('job', help='job directory')
+    export.add_argument('--output', default='backtest_results.csv', help='trade log CSV')
+    export.add_argument('--errors', default='backtest_errors.csv', help='error report CSV for units that failed')
+
+    args = parser.parse_args(argv)
+    if args.command == 'create':
+        job = Job.create(args.root, datetime.strptime(args.start, '%Y-%m-%d'),
+                         datetime.strptime(args.end, '%Y-%m-%d'), args.strategies, args.config, engine=args.engine,
+                         job_id=args.job_id, max_attempts=args.max_attempts, data_dir=args.data_dir,
+                         dataset=args.dataset, compact=args.compact)
+        print(f"{len(job.units())} units in {job.path}")
+        return 0
+    if args.command == 'status':
+        print(' '.join(f"{state}={count}" for state, count in Job(args.job).summary().items()))
+        return 0
+    if args.command == 'export':
+        trades, failed = Job(args.job).export(args.output, args.errors)
+        print(f"{trades} trades written to {args.output}")
+        if failed:
+            print(f"{failed} unit(s) failed, see {args.errors}", file=sys.stderr)
+            return 1
+        return 0
+
+    # work and resume: done units are skipped either way; resume just says
+    # that the job has been run before
+    counts = run_workers(args.job, args.workers, args.lease)
+    print(' '.join(f"{state}={count}" for state, count in counts.items()))
+    return 1 if counts[FAILED] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
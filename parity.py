@@ -0,0 +1,494 @@
+# parity.py
+
+import argparse
+import contextlib
+import copy
+import io
+import itertools
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from analytics import DailyPnl, exit_reasons
+from backtest import OptionBacktester, data_loader
+from biased_straddle import BiDirectionalHedgedStraddleStrategy
+from chain import compact_chain
+from dataset import ChainDataset
+from day_cache import DayCache
+from jobs import Job
+from runner import run_backtest, run_single_day, trading_days
+from spot_history import SpotHistory
+from storage import DAY_FOLDERS, LocalStorage, Prefetcher, day_key
+from synthetic import SyntheticMarket
+from trade_log import TradeLogSink
+
+START_DATE = datetime(2024, 7, 1)
+ENTRY = '09:20'
+# Share of dropped candles per generated market: a full chain and one with
+# gaps, where legs miss minutes and the engines' edge cases show up
+GAP_RATES = (0.0, 0.15)
+# Hedged strategy grid: day max_loss, then (sl_per_leg, target_per_leg)
+# pairs with neither, either and both set
+HEDGED_MAX_LOSS = (5, 20, 4000)
+HEDGED_LEG_LIMITS = ((None, None), (5, None), (None, 5), (15, 20))
+# What a run may raise instead of returning a trade log: the engines'
+# ValueError for a day they cannot simulate (e.g. no candle to price the
+# day-end exit). The hedged minute loop fails on the same days with a
+# KeyError (a leg with no entry price) or a TypeError (a leg with no
+# price to sum), where the vectorized engine raises ValueError.
+EXPECTED_ERRORS = (ValueError,)
+HEDGED_LOOP_ERRORS = (KeyError, TypeError)
+# Weeks of market the cache, history, job and trade log checks run over:
+# enough days to evict from a SpotHistory and to fill a small DayCache
+HISTORY_WEEKS = 3
+CLAIM_WORKERS = 4
+CHECKS = ('engines', 'parser', 'compact', 'dataset', 'hedged', 'day_cache', 'spot_history', 'prefetch', 'jobs',
+          'analytics', 'trade_log')
+
+
+def strategy_configs():
+    # Stop losses tight enough to re-enter, targets that hit, a day-level
+    # max_loss or none, and two or three legs
+    configs = {}
+    grid = itertools.product((0.05, 0.25), (0, 0.5), (None, 5), (0, 3), (0, 2))
+    for i, (stop_loss, target, max_loss, reentries, otm) in enumerate(grid):
+        config = {
+            'entry_time': ENTRY,
+            'exit_time': '15:15',
+            'stop_loss': stop_loss,
+            'target': target,
+            'reentry_on_sl': reentries > 0,
+            'max_rentries': reentries,
+            'legs': [{'type': 'call', 'otm': otm}, {'type': 'put', 'otm': otm}],
+        }
+        if max_loss is not None:
+            config['max_loss'] = max_loss
+        if i % 2:
+            config['legs'].append({'type': 'call', 'otm': otm + 1})
+        configs[f"parity_{i}"] = config
+    return configs
+
+
+class Failed:
+    # A run that raised instead of returning its result
+    def __init__(self, error):
+        self.error = error
+
+    def __repr__(self):
+        return f"{type(self.error).__name__}: {self.error}"
+
+
+def outcome(fn):
+    # The run's result, or Failed with what it raised
+    try:
+        return fn()
+    except Exception as e:
+        return Failed(e)
+
+
+def same(a, b):
+    try:
+        pd.testing.assert_frame_equal(a, b, check_exact=True)
+    except AssertionError:
+        return False
+    return True
+
+
+class Tally:
+    """Runs of one check and how they compared.
+
+    A run matches when both sides return equal results. Runs where both
+    sides failed are counted apart from matches, and only when each side
+    raised an error it is expected to raise; by default both must be the
+    same one of EXPECTED_ERRORS with the same message. Anything else,
+    including a failure on one side only, is a mismatch.
+    """
+
+    def __init__(self):
+        self.runs = 0
+        self.failed = 0
+        self.mismatches = []
+
+    @property
+    def matched(self):
+        return self.runs - self.failed - len(self.mismatches)
+
+    def compare(self, label, expected, got, equal=same, errors=None):
+        # `errors`: (expected's, got's) error classes, when they fail
+        # differently; their messages are then not compared
+        self.runs += 1
+        failed = isinstance(expected, Failed), isinstance(got, Failed)
+        if not any(failed):
+            if not equal(expected, got):
+                self.mismatches.append(label)
+        elif not all(failed):
+            self.mismatches.append(label + (expected if failed[0] else got,))
+        elif errors is None:
+            if (type(expected.error) is not type(got.error) or not isinstance(expected.error, EXPECTED_ERRORS)
+                    or str(expected.error) != str(got.error)):
+                self.mismatches.append(label + (expected, got))
+            else:
+                self.failed += 1
+        elif isinstance(expected.error, errors[0]) and isinstance(got.error, errors[1]):
+            self.failed += 1
+        else:
+            self.mismatches.append(label + (expected, got))
+
+    def check(self, label, ok):
+        # A run with nothing to compare against, just a condition to hold
+        self.runs += 1
+        if not ok:
+            self.mismatches.append(label)
+
+
+class ParityData:
+    # Synthetic day files per gap rate, generated once under `root`, and a
+    # strategy config file with every parity config
+    def __init__(self, root, days, strikes=10, seed=0):
+        self.root = root
+        self.dates = trading_days(START_DATE, START_DATE + pd.Timedelta(days=days * 2))[:days]
+        self.strikes = strikes
+        self.seed = seed
+        self.configs = strategy_configs()
+        self.config_path = os.path.join(root, 'strategy_config.json')
+        with open(self.config_path, 'w') as f:
+            json.dump(self.configs, f)
+        self.markets = {}
+        self._expected = {}
+        self._history_dates = None
+        for gap_rate in GAP_RATES:
+            market = SyntheticMarket(seed=seed, strikes_per_side=strikes, gap_rate=gap_rate)
+            market.write(self.path(gap_rate), START_DATE, datetime.strptime(self.dates[-1], '%Y-%m-%d'))
+            self.markets[gap_rate] = market
+
+    def path(self, gap_rate):
+        return os.path.join(self.root, f"gaps_{gap_rate}")
+
+    def storage(self, gap_rate):
+        return LocalStorage(self.path(gap_rate))
+
+    def history(self):
+        # (storage, dates) of HISTORY_WEEKS weeks of the full market, written
+        # the first time a check asks for them
+        path = os.path.join(self.root, 'history')
+        if self._history_dates is None:
+            end = START_DATE + pd.Timedelta(weeks=HISTORY_WEEKS) - pd.Timedelta(days=1)
+            self._history_dates = SyntheticMarket(seed=self.seed, strikes_per_side=self.strikes).write(
+                path, START_DATE, end)
+        return LocalStorage(path), self._history_dates
+
+    def days(self):
+        # (gap_rate, date, options, spot) for every generated day
+        for gap_rate in GAP_RATES:
+            for date in self.dates:
+                loader = data_loader(date, storage=self.storage(gap_rate))
+                yield gap_rate, date, loader.load_data(), loader.load_spot_data()
+
+    def expected(self, gap_rate, date, name, options, spot):
+        # The loop engine's outcome on the plain frames, which every check
+        # compares against; run once per day and config
+        key = (gap_rate, date, name)
+        if key not in self._expected:
+            self._expected[key] = outcome(lambda: OptionBacktester(options.copy(), spot, date, name,
+                                                                   self.config_path).run())
+        return self._expected[key]
+
+
+def check_engines(data):
+    # vectorized and incremental against loop on the same frames
+    tally = Tally()
+    for gap_rate, date, options, spot in data.days():
+        for name in data.configs:
+            expected = data.expected(gap_rate, date, name, options, spot)
+            for engine in ('vectorized', 'incremental'):
+                got = outcome(lambda: OptionBacktester(options, spot, date, name, data.config_path,
+                                                       engine=engine).run())
+                tally.compare((gap_rate, date, name, engine), expected, got)
+    return tally
+
+
+def check_parser(data):
+    # The streaming flattener against json.loads plus the original per-item
+    # dict merge
+    tally = Tally()
+    for gap_rate in GAP_RATES:
+        storage = data.storage(gap_rate)
+        for date in data.dates:
+            with open(storage.path(f"nifty_options/{date}.json")) as f:
+                items = json.load(f)
+            expected = pd.DataFrame([{**{k: item[k] for k in ('date', 'strike', 'atm', 'right', 'expiry')},
+                                      **item['option_data']} for item in items])
+            tally.compare((gap_rate, date, 'load_data', 'streaming'), expected,
+                          outcome(lambda: data_loader(date, storage=storage).load_data()))
+    return tally
+
+
+def check_compact(data):
+    # Every engine on a compact_chain frame against loop on the plain frame
+    tally = Tally()
+    for gap_rate, date, options, spot in data.days():
+        compact = compact_chain(options)
+        for name in data.configs:
+            expected = data.expected(gap_rate, date, name, options, spot)
+            for engine in ('loop', 'vectorized', 'incremental'):
+                got = outcome(lambda: OptionBacktester(compact, spot, date, name, data.config_path,
+                                                       engine=engine).run())
+                tally.compare((gap_rate, date, name, f"compact {engine}"), expected, got)
+    return tally
+
+
+def check_dataset(data):
+    # runner.run_single_day reading only the traded legs from a ChainDataset
+    # against loop on the full day
+    tally = Tally()
+    for gap_rate in GAP_RATES:
+        storage = data.storage(gap_rate)
+        dataset = ChainDataset(os.path.join(data.root, f"dataset_{gap_rate}"))
+        for date in data.dates:
+            loader = data_loader(date, storage=storage)
+            options, spot = loader.load_data(), loader.load_spot_data()
+            dataset.write_day(date, options, spot)
+            for name in data.configs:
+                expected = data.expected(gap_rate, date, name, options, spot)
+                for engine in ('loop', 'vectorized', 'incremental'):
+                    got = outcome(lambda: run_single_day(date, name, data.config_path, engine, storage=storage,
+                                                         dataset=dataset))
+                    tally.compare((gap_rate, date, name, f"dataset {engine}"), expected, got)
+    return tally
+
+
+def hedged_frames(options, spot):
+    # The hedged strategy keeps the candle in an `option_data` dict column
+    # and compares datetimes as strings
+    candle = ['datetime', 'open', 'high', 'low', 'close']
+    options = options.assign(option_data=options[candle].to_dict('records')).drop(columns=candle[1:])
+    return options, spot.copy()
+
+
+def check_hedged(data):
+    # BiDirectionalHedgedStraddleStrategy's vectorized exits against its
+    # minute loop, for both biases and a grid of risk limits
+    tally = Tally()
+    for gap_rate, date, options, spot in data.days():
+        options, spot = hedged_frames(options, spot)
+        entry = f"{date} {ENTRY}:00"
+        for bias, max_loss, (sl, target) in itertools.product(('positive', 'negative'), HEDGED_MAX_LOSS,
+                                                              HEDGED_LEG_LIMITS):
+            def run(engine):
+                strategy = BiDirectionalHedgedStraddleStrategy(date, spot.copy(), options, max_loss=max_loss,
+                                                               sl_per_leg=sl, target_per_leg=target,
+                                                               storage=data.storage(gap_rate), engine=engine)
+                strategy.bias = bias
+                strategy.enter_trade(entry)
+                strategy.update_pnl_and_exit()
+                return copy.deepcopy(strategy.positions), strategy.exit_time
+
+            tally.compare((gap_rate, date, (bias, max_loss, sl, target), 'hedged vectorized'),
+                          outcome(lambda: run('loop')), outcome(lambda: run('vectorized')),
+                          equal=lambda a, b: a == b, errors=(HEDGED_LOOP_ERRORS, EXPECTED_ERRORS))
+    return tally
+
+
+def cached_bytes(cache):
+    return sum(os.path.getsize(os.path.join(dirpath, name)) for dirpath, _, names in os.walk(cache.root)
+               for name in names if name.endswith('.npz'))
+
+
+def check_day_cache(data):
+    # Days read through a DayCache with room for about two of them,
+    # forwards, backwards and forwards again, against the same days read
+    # directly; the cache must stay within max_bytes and evict along the way
+    storage, dates = data.history()
+    expected = {date: data_loader(date, storage=storage) for date in dates}
+    expected = {date: (loader.load_data(), loader.load_spot_data()) for date, loader in expected.items()}
+    sizing = DayCache(os.path.join(data.root, 'day_cache_size'))
+    for folder, df in zip(DAY_FOLDERS, expected[dates[0]]):
+        sizing.put(folder, dates[0], None, df)
+    max_bytes = int(cached_bytes(sizing) * 2.5)
+    tally = Tally()
+    for revalidate in (False, True):
+        cache = DayCache(os.path.join(data.root, f"day_cache_{revalidate}"), max_bytes=max_bytes,
+                         revalidate=revalidate)
+        for date in dates + dates[::-1] + dates:
+            loader = data_loader(date, cache=cache, storage=storage)
+            got = outcome(loader.load_data), outcome(loader.load_spot_data)
+            for folder, frame, got_frame in zip(DAY_FOLDERS, expected[date], got):
+                tally.compare((date, folder, f"day_cache revalidate={revalidate}"), frame, got_frame)
+            tally.check((date, f"day_cache revalidate={revalidate} within max_bytes"),
+                        cached_bytes(cache) <= cache.max_bytes)
+        tally.check(('day_cache', f"revalidate={revalidate} evicted"),
+                    sum(cache.contains('nifty_options', date) for date in dates) < len(dates))
+    return tally
+
+
+def reference_spot(storage, date):
+    # Hourly bars and 09:20 bias the hedged strategy computes without a
+    # SpotHistory
+    strategy = BiDirectionalHedgedStraddleStrategy(datetime.strptime(date, '%Y-%m-%d'), None, None, storage=storage)
+    with contextlib.redirect_stdout(io.StringIO()):
+        # It prints each weekend day it finds no file for
+        hourly = strategy.get_spot_hourly_data()
+    spot_df = strategy.spot_df
+    strategy.calculate_bias(spot_df[spot_df['datetime'] <= pd.to_datetime(f"{date} {ENTRY}:00")].copy())
+    return hourly, strategy.bias
+
+
+def check_spot_history(data):
+    # SpotHistory's hourly EMAs and bias against the hedged strategy's own
+    # computation, for every day in three query orders on one history that
+    # has to evict days along the way
+    storage, dates = data.history()
+    expected = {date: reference_spot(storage, date) for date in dates}
+    history = SpotHistory(storage, max_days=0)
+    tally = Tally()
+    for date in dates + dates[::-1] + dates[::2] + dates[1::2]:
+        hourly, bias = expected[date]
+        tally.compare((date, 'spot_history hourly'), hourly, outcome(lambda: history.hourly(date)))
+        tally.compare((date, 'spot_history bias'), bias, outcome(lambda: history.bias(date, ENTRY)),
+                      equal=lambda a, b: a == b)
+        tally.check((date, 'spot_history within max_days'), len(history.minutes) <= history.max_days)
+    tally.check(('spot_history', 'evicted'), len(history.minutes) < len(history.days))
+    return tally
+
+
+def check_prefetch(data):
+    # Days run off Prefetcher storages whose cache is cleared before each
+    # day is read, so whatever the prefetcher skipped because the cache held
+    # it has to come from the underlying storage
+    storage, dates = data.history()
+    dates = dates[:5]
+    tally = Tally()
+    for revalidate in (False, True):
+        cache = DayCache(os.path.join(data.root, f"prefetch_cache_{revalidate}"), revalidate=revalidate)
+        for date in dates[::2]:
+            loader = data_loader(date, cache=cache, storage=storage)
+            loader.load_data()
+            loader.load_spot_data()
+        for date, day_storage in Prefetcher(storage, dates, cache=cache):
+            if date == dates[0]:
+                # Held by the cache when the prefetcher started, so only the
+                # fallback can serve it now
+                tally.check((date, f"prefetch revalidate={revalidate} skipped cached day"),
+                            not any(day_key(folder, date) in day_storage.objects for folder in DAY_FOLDERS))
+            cache.clear()
+            loader = data_loader(date, cache=cache, storage=day_storage)
+            direct = data_loader(date, storage=storage)
+            tally.compare((date, f"prefetch revalidate={revalidate} options"), direct.load_data(),
+                          outcome(loader.load_data))
+            tally.compare((date, f"prefetch revalidate={revalidate} spot"), direct.load_spot_data(),
+                          outcome(loader.load_spot_data))
+    return tally
+
+
+def claim_all(job_path, start_at):
+    # Every unit this process wins, trying all of them from `start_at` on
+    job = Job(job_path)
+    time.sleep(max(start_at - time.time(), 0))
+    return [(date, strategy, attempt) for date, strategy in job.units()
+            for attempt in [job.claim(date, strategy)] if attempt is not None]
+
+
+def check_jobs(data):
+    # CLAIM_WORKERS processes racing for every unit of a job at once, twice:
+    # each attempt must go to exactly one of them
+    _, dates = data.history()
+    job = Job.create(os.path.join(data.root, 'jobs'), datetime.strptime(dates[0], '%Y-%m-%d'),
+                     datetime.strptime(dates[4], '%Y-%m-%d'), list(data.configs)[:2], data.config_path,
+                     job_id='claims', max_attempts=2)
+    tally = Tally()
+    with ProcessPoolExecutor(max_workers=CLAIM_WORKERS) as pool:
+        for attempt in (1, 2):
+            start_at = time.time() + 1.0
+            futures = [pool.submit(claim_all, job.path, start_at) for _ in range(CLAIM_WORKERS)]
+            claims = [claim for future in futures for claim in future.result()]
+            for date, strategy in job.units():
+                won = [a for d, s, a in claims if (d, s) == (date, strategy)]
+                tally.check((date, strategy, f"jobs attempt {attempt} claimed once"), won == [attempt])
+                job.fail(date, strategy, attempt, {'error_type': 'Parity'})
+    return tally
+
+
+def check_analytics(data):
+    # DailyPnl and exit_reasons on the parity trade logs with some pnl
+    # values missing, against the same logs without those rows
+    logs = {(date, name): data.expected(gap_rate, date, name, options, spot)
+            for gap_rate, date, options, spot in data.days() if gap_rate == 0.0 for name in data.configs}
+    trades = pd.concat([log.assign(strategy=name) for (_, name), log in logs.items() if not isinstance(log, Failed)],
+                       ignore_index=True)
+    # Every other trade of each strategy, so none loses all its rows
+    missing = (trades.groupby('strategy').cumcount() % 2 == 1).to_numpy()
+    with_nan = trades.assign(pnl=trades['pnl'].mask(missing))
+    without = trades[~missing]
+    tally = Tally()
+    daily = DailyPnl.from_trades(with_nan, dates=data.dates)
+    kept = DailyPnl.from_trades(without, dates=data.dates)
+    tally.compare(('analytics', 'daily frame'), kept.frame(), outcome(daily.frame))
+    tally.compare(('analytics', 'summary'), kept.summary(), outcome(daily.summary))
+    tally.check(('analytics', 'dropped'), daily.dropped == int(missing.sum()))
+    tally.check(('analytics', 'finite'), bool(np.isfinite(daily.values).all()))
+    tally.compare(('analytics', 'exit_reasons'), exit_reasons(without), outcome(lambda: exit_reasons(with_nan)))
+    return tally
+
+
+def check_trade_log(data):
+    # A day that fails after an earlier run wrote its trades must lose its
+    # part; the other days keep theirs
+    storage, dates = data.history()
+    name = list(data.configs)[0]
+    first, second = datetime.strptime(dates[0], '%Y-%m-%d'), datetime.strptime(dates[1], '%Y-%m-%d')
+    sink = TradeLogSink(os.path.join(data.root, 'trade_log'))
+    run_backtest(first, second, name, data.config_path, workers=1, storage=storage, prefetch=0, sink=sink)
+    before = sink.reader().read(start=dates[1], end=dates[1])
+
+    # The same days with the first one's chain gone
+    broken = os.path.join(data.root, 'history_broken')
+    for folder in DAY_FOLDERS:
+        os.makedirs(os.path.join(broken, folder), exist_ok=True)
+        for date in dates[:2]:
+            if (folder, date) != ('nifty_options', dates[0]):
+                shutil.copy(storage.path(day_key(folder, date)), os.path.join(broken, folder))
+    _, errors = run_backtest(first, second, name, data.config_path, workers=1, storage=LocalStorage(broken),
+                             prefetch=0, sink=sink)
+    tally = Tally()
+    tally.check((dates[0], 'trade_log failed'), list(errors['date']) == [dates[0]])
+    tally.check((dates[0], 'trade_log stale part removed'), not sink.contains(name, dates[0]))
+    tally.compare((dates[1], 'trade_log part kept'), before,
+                  outcome(lambda: sink.reader().read(start=dates[1], end=dates[1])))
+    return tally
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Check that every engine and data path gives the same result as the loop engine.')
+    parser.add_argument('--days', type=int, default=1, help='synthetic trading days per market')
+    parser.add_argument('--strikes', type=int, default=10, help='strikes either side of ATM')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--checks', nargs='+', default=list(CHECKS), choices=CHECKS)
+    args = parser.parse_args(argv)
+
+    checks = {'engines': check_engines, 'parser': check_parser, 'compact': check_compact,
+              'dataset': check_dataset, 'hedged': check_hedged, 'day_cache': check_day_cache,
+              'spot_history': check_spot_history, 'prefetch': check_prefetch, 'jobs': check_jobs,
+              'analytics': check_analytics, 'trade_log': check_trade_log}
+    failed = 0
+    with tempfile.TemporaryDirectory(prefix='parity_') as root:
+        data = ParityData(root, args.days, args.strikes, args.seed)
+        for name in args.checks:
+            tally = checks[name](data)
+            failed += len(tally.mismatches)
+            print(f"{name}: {tally.matched} of {tally.runs} match, {tally.failed} failed the same way on both sides")
+            for mismatch in tally.mismatches:
+                print(f"  mismatch: {mismatch}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,239 @@
+# price_index.py
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from chain import price_array
+
+FIELDS = ('open', 'high', 'low', 'close')
+
+
+class PriceIndex:
+    """Dense OHLC array over (field, strike, right, minute) for one day or one
+    expiry week, with dict lookups from strike, right and timestamp to array
+    positions. Missing candles are NaN and flagged False in ``present``.
+
+    Build it once with ``from_frame`` and hand the same object to
+    OptionBacktester (which works on the backtest date's ``day``) and
+    BiDirectionalHedgedStraddleStrategy. ``save`` writes
+    it to a directory that ``load`` can memory-map, so worker processes share
+    the pages instead of each holding a copy.
+    """
+
+    def __init__(self, strikes, rights, minutes, values, present):
+        self.strikes = strikes
+        self.rights = list(rights)
+        self.minutes = minutes
+        self.values = values
+        self.present = present
+        self._strike_pos = {s.item(): i for i, s in enumerate(strikes)}
+        self._right_pos = {r: i for i, r in enumerate(self.rights)}
+        self._minute_pos = {m: i for i, m in enumerate(minutes.astype('datetime64[ns]').view('i8').tolist())}
+        self._minute_of_day = None
+
+    @classmethod
+    def from_frame(cls, df):
+        # Accepts the flattened frame from data_loader.load_data (plain or
+        # compact), or a frame that still keeps the candle in an
+        # `option_data` dict column. Where a (strike, right, minute) repeats,
+        # the first row wins.
+        minutes, m_idx = np.unique(pd.to_datetime(df['datetime']).to_numpy(), return_inverse=True)
+        strikes, s_idx = np.unique(df['strike'].to_numpy(), return_inverse=True)
+        rights, r_idx = np.unique(df['right'].str.lower().to_numpy(dtype=str), return_inverse=True)
+        if all(field in df.columns for field in FIELDS):
+            ohlc = price_array(df, FIELDS)
+        else:
+            ohlc = np.array([[candle[field] for field in FIELDS] for candle in df['option_data']], dtype=float)
+            ohlc = ohlc.reshape(len(df), len(FIELDS))
+
+        shape = (len(strikes), len(rights), len(minutes))
+        values = np.full((len(FIELDS),) + shape, np.nan)
+        present = np.zeros(shape, dtype=bool)
+        flat = np.ravel_multi_index((s_idx, r_idx, m_idx), shape) if len(df) else np.zeros(0, dtype=np.intp)
+        first = ~pd.Index(flat).duplicated()
+        values.reshape(len(FIELDS), -1)[:, flat[first]] = ohlc[first].T
+        present.reshape(-1)[flat[first]] = True
+        return cls(strikes, rights, minutes, values, present)
+
+    def day(self, date):
+        # The index cut down to one date's minutes ('YYYY-MM-DD'), sharing
+        # this one's arrays; itself when it covers only that date
+        days = self.minutes.astype('datetime64[D]')
+        target = np.datetime64(date, 'D')
+        lo, hi = np.searchsorted(days, target, 'left'), np.searchsorted(days, target, 'right')
+        if lo == 0 and hi == len(days):
+            return self
+        return PriceIndex(self.strikes, self.rights, self.minutes[lo:hi], self.values[..., lo:hi],
+                          self.present[..., lo:hi])
+
+    def locate(self, dt, strike, right):
+        # (strike, right, minute) positions, or None if any of them is unknown
+        i = self._strike_pos.get(strike)
+        j = self._right_pos.get(right.lower()) if isinstance(right, str) else None
+        k = self._minute_pos.get(pd.Timestamp(dt).value) if dt is not None else None
+        if i is None or j is None or k is None:
+            return None
+        return i, j, k
+
+    def price(self, dt, strike, right, field='open'):
+        loc = self.locate(dt, strike, right)
+        if loc is None or not self.present[loc]:
+            return None
+        return float(self.values[(FIELDS.index(field),) + loc])
+
+    def series(self, strike, right, field='close'):
+        # A leg's values across every minute in the index (NaN where missing)
+        i = self._strike_pos.get(strike)
+        j = self._right_pos.get(right.lower())
+        if i is None or j is None:
+            return None
+        return self.values[FIELDS.index(field), i, j]
+
+    def locate_minutes(self, times):
+        # Grid position of each timestamp, -1 where the index has no such minute
+        ns = pd.to_datetime(pd.Series(times)).to_numpy().astype('datetime64[ns]').view('i8')
+        grid = self.minutes.astype('datetime64[ns]').view('i8')
+        pos = np.searchsorted(grid, ns)
+        pos[pos == len(grid)] = 0
+        found = (grid[pos] == ns) if len(grid) else np.zeros(len(ns), dtype=bool)
+        return np.where(found, pos, -1)
+
+    def path(self, strike, right, minute_pos, field='open'):
+        # One leg's prices at the given grid positions and whether a candle
+        # exists there (prices are NaN where it does not)
+        prices = np.full(len(minute_pos), np.nan)
+        present = np.zeros(len(minute_pos), dtype=bool)
+        i = self._strike_pos.get(strike)
+        j = self._right_pos.get(right.lower()) if isinstance(right, str) else None
+        if i is None or j is None:
+            return prices, present
+        valid = minute_pos >= 0
+        k = minute_pos[valid]
+        present[valid] = self.present[i, j][k]
+        prices[valid] = np.where(present[valid], self.values[FIELDS.index(field), i, j][k], np.nan)
+        return prices, present
+
+    def minute_of_day(self):
+        if self._minute_of_day is None:
+            minutes = self.minutes.astype('datetime64[m]')
+            self._minute_of_day = (minutes - minutes.astype('datetime64[D]')).astype(np.int32)
+        return self._minute_of_day
+
+    def leg(self, strike, right, entry_time=None):
+        # The leg arrays align_leg would build for the same strike and right
+        # on this index's minute grid, optionally from entry_time ('HH:MM') on.
+        # entry_time is matched on minute of day alone, so on a multi-day
+        # index take the day() first.
+        i = self._strike_pos.get(strike)
+        j = self._right_pos.get(right.lower())
+        if i is None or j is None:
+            return None
+        has = np.array(self.present[i, j])
+        if entry_time is not None:
+            hours, mins = entry_time.split(':')
+            has &= self.minute_of_day() >= int(hours) * 60 + int(mins)
+        if not has.any():
+            return None
+        leg = {"pos": np.flatnonzero(has), "timestamps": self.minutes, "has": has}
+        for f, field in enumerate(FIELDS):
+            leg[field] = np.where(has, self.values[f, i, j], np.nan)
+        return leg
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'values.npy'), self.values)
+        np.save(os.path.join(path, 'present.npy'), self.present)
+        np.save(os.path.join(path, 'strikes.npy'), self.strikes)
+        np.save(os.path.join(path, 'minutes.npy'), self.minutes)
+        with open(os.path.join(path, 'rights.json'), 'w') as f:
+            json.dump(self.rights, f)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        mode = 'r' if mmap else None
+        with open(os.path.join(path, 'rights.json')) as f:
+            rights = json.load(f)
+        return cls(
+            np.load(os.path.join(path, 'strikes.npy')),
+            rights,
+            np.load(os.path.join(path, 'minutes.npy')),
+            np.load(os.path.join(path, 'values.npy'), mmap_mode=mode),
+            np.load(os.path.join(path, 'present.npy'), mmap_mode=mode),
+        )
+
+
+class PremiumIndex:
+    """Strikes sorted by premium for every (right, minute) of a PriceIndex.
+
+    ``nearest`` answers "which strike's premium is closest to P" for any
+    number of (minute, target) pairs in one call, with a binary search per
+    pair run as array operations. Minutes without a candle for a strike
+    leave it out of that minute's list. On equal distance the lower strike
+    wins.
+    """
+
+    def __init__(self, price_index, field='open'):
+        self.price_index = price_index
+        # (right, minute, strike) premiums, NaN where there is no candle
+        premiums = np.moveaxis(np.asarray(price_index.values[FIELDS.index(field)]), 0, -1)
+        order = np.argsort(premiums, axis=-1, kind='stable')
+        self.order = order
+        self.sorted = np.take_along_axis(premiums, order, axis=-1)
+        self.counts = np.count_nonzero(~np.isnan(premiums), axis=-1)
+
+    @classmethod
+    def from_frame(cls, df, field='open'):
+        return cls(PriceIndex.from_frame(df), field)
+
+    def nearest(self, times, right, targets):
+        # (strikes, found) for each time and target; either may be a scalar.
+        # strikes is 0 where found is False.
+        minute_pos, targets = np.broadcast_arrays(self.price_index.locate_minutes(np.atleast_1d(times)),
+                                                  np.asarray(targets, dtype=float))
+        strikes = np.zeros(len(minute_pos), dtype=self.price_index.strikes.dtype)
+        found = np.zeros(len(minute_pos), dtype=bool)
+        j = self.price_index._right_pos.get(right.lower())
+        if j is None or not len(minute_pos):
+            return strikes, found
+        k = np.where(minute_pos >= 0, minute_pos, 0)
+        grid = self.sorted[j]
+        last = grid.shape[1] - 1
+        counts = np.where(minute_pos >= 0, self.counts[j, k], 0)
+        zeros = np.zeros_like(counts)
+
+        # First position at or above the target, then the lowest strike
+        # sharing the premium just below it
+        up = _search(grid, k, zeros, counts, targets)
+        has_up = up < counts
+        has_down = up > 0
+        below = grid[k, np.maximum(up - 1, 0)]
+        down = _search(grid, k, zeros, np.maximum(up - 1, 0), below)
+
+        d_up = np.abs(grid[k, np.minimum(up, last)] - targets)
+        d_down = np.abs(below - targets)
+        s_up = self.price_index.strikes[self.order[j, k, np.minimum(up, last)]]
+        s_down = self.price_index.strikes[self.order[j, k, down]]
+        take_down = has_down & (~has_up | (d_down < d_up) | ((d_down == d_up) & (s_down < s_up)))
+        found = has_up | has_down
+        strikes = np.where(take_down, s_down, np.where(found, s_up, 0))
+        return strikes, found
+
+    def strike(self, dt, right, target):
+        strikes, found = self.nearest([dt], right, target)
+        return strikes[0].item() if found[0] else None
+
+
+def _search(grid, k, lo, hi, targets):
+    # Lower bound of each target in grid[k, lo:hi], every query at once
+    last = grid.shape[1] - 1
+    while True:
+        open_ = lo < hi
+        if not open_.any():
+            return lo
+        mid = (lo + hi) // 2
+        less = grid[k, np.minimum(mid, last)] < targets
+        lo = np.where(open_ & less, mid + 1, lo)
+        hi = np.where(open_ & ~less, mid, hi)
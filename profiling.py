@@ -0,0 +1,189 @@
+# profiling.py
+
+import json
+import time
+
+
+class DayProfile:
+    """Phase timings and counters for one backtest day.
+
+    Phases nest: time spent in an inner phase is charged to it and not to the
+    one around it, so no time is counted twice; whatever runs outside any
+    phase shows up only in ``wall``. Counters are plain sums (bytes fetched,
+    rows, price lookups, ...).
+    """
+
+    enabled = True
+
+    def __init__(self, date, profiler=None):
+        self.date = date
+        self.profiler = profiler
+        self.phases = {}
+        self.counters = {}
+        self._stack = []
+        self._mark = None
+        self._started = time.perf_counter()
+        self._finished = None
+
+    def phase(self, name):
+        # Context manager; start/stop do the same for code that spans
+        # branches awkward to wrap in a with block
+        return _Phase(self, name)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def start(self, name):
+        now = time.perf_counter()
+        if self._stack:
+            top = self._stack[-1]
+            self.phases[top] = self.phases.get(top, 0.0) + (now - self._mark)
+        self._stack.append(name)
+        self._mark = now
+
+    def stop(self):
+        now = time.perf_counter()
+        top = self._stack.pop()
+        self.phases[top] = self.phases.get(top, 0.0) + (now - self._mark)
+        self._mark = now
+
+    def record(self):
+        end = self._finished if self._finished is not None else time.perf_counter()
+        return {
+            'date': self.date,
+            'wall': end - self._started,
+            'phases': dict(self.phases),
+            'counters': dict(self.counters),
+        }
+
+    def finish(self, **extra):
+        # Close the day and hand its record to the profiler's hooks
+        if self._finished is None:
+            self._finished = time.perf_counter()
+        record = dict(self.record(), **extra)
+        if self.profiler is not None:
+            self.profiler.emit(record)
+        return record
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.finish(error=None if exc is None else f"{type(exc).__name__}: {exc}")
+        return False
+
+
+class _Phase:
+    __slots__ = ('profile', 'name')
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.profile.start(self.name)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.profile.stop()
+        return False
+
+
+class _NullPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+class NullProfile:
+    # Stand-in used when profiling is off: every call is a no-op, so the
+    # instrumented code pays one attribute lookup and call per hook.
+    enabled = False
+    _phase = _NullPhase()
+
+    def phase(self, name):
+        return self._phase
+
+    def count(self, name, n=1):
+        pass
+
+    def start(self, name):
+        pass
+
+    def stop(self):
+        pass
+
+    def finish(self, **extra):
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_PROFILE = NullProfile()
+
+
+class Profiler:
+    """Hands out a DayProfile per day and passes each finished day's record,
+    a plain dict, to every registered hook."""
+
+    def __init__(self, hooks=()):
+        self.hooks = list(hooks)
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+        return hook
+
+    def day(self, date):
+        return DayProfile(date, self)
+
+    def emit(self, record):
+        for hook in self.hooks:
+            hook(record)
+
+
+class JsonLinesHook:
+    # Appends each day's record to a JSON lines file
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, record):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+
+
+class CountingReader:
+    # Wraps a storage body so bytes read and time spent reading are charged
+    # to the profile's 'fetch' phase
+    def __init__(self, body, profile):
+        self.body = body
+        self.profile = profile
+
+    def read(self, *args):
+        with self.profile.phase('fetch'):
+            chunk = self.body.read(*args)
+        self.profile.count('bytes_fetched', len(chunk))
+        return chunk
+
+    def close(self):
+        self.body.close()
+
+
+def timed_items(items, profile, phase='decode', counter='items'):
+    # Re-yield items, charging the time spent producing each one to `phase`
+    it = iter(items)
+    while True:
+        with profile.phase(phase):
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+        profile.count(counter)
+        yield item
@@ -0,0 +1,172 @@
+# result_cache.py
+
+import hashlib
+import json
+import os
+import tempfile
+
+import pandas as pd
+
+from day_cache import _json_scalar, read_frame, write_frame
+
+DEFAULT_RESULT_DIR = '.result_cache'
+DEFAULT_MAX_BYTES = 512 * 1024 ** 2
+_EXTENSIONS = ('.npz', '.json')
+# Pickled entries written before results were kept as JSON; never read,
+# only cleared away
+_LEGACY_EXTENSIONS = ('.pkl',)
+# Bump when what a key vouches for changes, so entries stored under the old
+# meaning stop matching. 2: runner fingerprints name the simulated bytes
+# (results stored before could be from a stale day cache entry)
+KEY_VERSION = 2
+
+
+def config_hash(config):
+    # Canonical JSON, so key order and whitespace in strategy_config.json do
+    # not matter
+    canonical = json.dumps(config, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def frame_fingerprint(*frames):
+    # Content hash of the input frames: column names, dtypes and values
+    digest = hashlib.sha256()
+    for df in frames:
+        digest.update(json.dumps([[str(c), str(t)] for c, t in df.dtypes.items()]).encode('utf-8'))
+        for col in df.columns:
+            series = df[col]
+            try:
+                hashed = pd.util.hash_pandas_object(series, index=False)
+            except TypeError:
+                # Unhashable cells: dicts such as option_data are expanded to
+                # columns, anything else is hashed by its repr
+                if series.map(lambda v: isinstance(v, dict)).all():
+                    expanded = pd.DataFrame(series.tolist())
+                    expanded = expanded[sorted(expanded.columns, key=str)]
+                    digest.update(json.dumps([str(c) for c in expanded.columns]).encode('utf-8'))
+                    hashed = pd.util.hash_pandas_object(expanded, index=False)
+                else:
+                    hashed = pd.util.hash_pandas_object(series.map(repr), index=False)
+            digest.update(hashed.to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def result_key(kind, config, engine, version, date, fingerprint):
+    parts = [kind, config_hash(config), engine, str(version), str(date), str(fingerprint), str(KEY_VERSION)]
+    return hashlib.sha256('|'.join(parts).encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """On-disk memo of per-day results.
+
+    Keys come from ``result_key``: what is being run, the strategy config,
+    the engine and its version, the date and a fingerprint of the day's
+    input, so any change to one of them is simply a miss. DataFrames are
+    stored column by column in ``.npz`` like the DayCache, other results as
+    JSON. Nothing is pickled: ``put`` raises TypeError for a value neither
+    can hold. As with the DayCache, file modification times are the LRU
+    clock for evicting down to ``max_bytes``.
+    """
+
+    def __init__(self, root=DEFAULT_RESULT_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+
+    @classmethod
+    def from_env(cls):
+        root = os.getenv('BACKTEST_RESULT_CACHE_DIR', DEFAULT_RESULT_DIR)
+        max_mb = os.getenv('BACKTEST_RESULT_CACHE_MAX_MB')
+        max_bytes = int(float(max_mb) * 1024 ** 2) if max_mb else DEFAULT_MAX_BYTES
+        return cls(root, max_bytes=max_bytes)
+
+    def lookup(self, key):
+        # (True, value) on a hit, (False, None) on a miss; a stored value may
+        # itself be None
+        path = self._find(key)
+        if path is None:
+            return False, None
+        try:
+            if path.endswith('.npz'):
+                value = read_frame(path)
+            else:
+                with open(path, encoding='utf-8') as f:
+                    value = json.load(f)
+        except (OSError, ValueError, KeyError, EOFError):
+            self._remove(path)
+            return False, None
+        os.utime(path)
+        return True, value
+
+    def get(self, key, default=None):
+        hit, value = self.lookup(key)
+        return value if hit else default
+
+    def contains(self, key):
+        return self._find(key) is not None
+
+    def put(self, key, value):
+        key_dir = os.path.join(self.root, key[:2])
+        is_frame = isinstance(value, pd.DataFrame)
+        if not is_frame:
+            # Serialized up front, so a value JSON cannot hold leaves no file
+            try:
+                text = json.dumps(value, default=_json_scalar)
+            except (TypeError, ValueError) as e:
+                raise TypeError(f"{type(value).__name__} result cannot be stored without pickling") from e
+        os.makedirs(key_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=key_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if is_frame:
+                    write_frame(f, value)
+                else:
+                    f.write(text.encode('utf-8'))
+            path = os.path.join(key_dir, key + ('.npz' if is_frame else '.json'))
+            os.replace(tmp_path, path)
+        except BaseException:
+            self._remove(tmp_path)
+            raise
+        self.evict()
+        return path
+
+    def evict(self):
+        entries = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if name.endswith(_LEGACY_EXTENSIONS):
+                    self._remove(path)
+                    continue
+                if not name.endswith(_EXTENSIONS):
+                    continue
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def clear(self):
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if name.endswith(_EXTENSIONS + _LEGACY_EXTENSIONS):
+                    self._remove(os.path.join(dirpath, name))
+
+    def _find(self, key):
+        for ext in _EXTENSIONS:
+            path = os.path.join(self.root, key[:2], key + ext)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
@@ -0,0 +1,242 @@
+# runner.py
+
+import argparse
+import os
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from backtest import (ENGINES, OptionBacktester, Strategy, data_loader, day_result_key, default_storage,
+                      load_strategy_config, spot_atm_strike)
+from dataset import ChainDataset
+from day_cache import DayCache
+from profiling import DayProfile, JsonLinesHook, Profiler
+from result_cache import ResultCache
+from storage import DAY_FOLDERS, LocalStorage, Prefetcher, day_key
+from trade_log import TradeLogSink
+
+ERROR_COLUMNS = ['date', 'strategy', 'error_type', 'message', 'traceback']
+
+
+def trading_days(start_date, end_date):
+    days = []
+    current = start_date
+    while current <= end_date:
+        if current.weekday() < 5:
+            days.append(current.strftime('%Y-%m-%d'))
+        current += timedelta(days=1)
+    return days
+
+
+def source_fingerprint(storage, date):
+    # The day's input as its objects' ETags, read without downloading them
+    return '|'.join(str(storage.head(day_key(folder, date))) for folder in DAY_FOLDERS)
+
+
+def run_single_day(date, strategy_name, strategy_config_path='strategy_config.json', engine='loop', cache=None,
+                   storage=None, profile=None, result_cache=None, fingerprint=None, compact=False, dataset=None):
+    data_class = data_loader(date, cache=cache, storage=storage, profile=profile, compact=compact, dataset=dataset)
+    spot_data = data_class.load_spot_data()
+    config = load_strategy_config(strategy_config_path, strategy_name)
+    strategy = Strategy(config)
+    minutes = None
+    # Delta-targeted legs are picked off the entry minute's Greeks, which the
+    # day cache keeps between runs
+    greeks = data_class.load_greeks(config['entry_time']) if strategy.uses_delta() else None
+    if dataset is not None:
+        # Only the legs the strategy trades, from its entry minute on, plus
+        # the chain's minute grid
+        legs = strategy.get_strikes(spot_atm_strike(spot_data, config['entry_time']), greeks)
+        data = data_class.load_data(legs=legs, start=config['entry_time'])
+        minutes = data_class.load_minutes()
+    else:
+        data = data_class.load_data()
+    backtester = OptionBacktester(data, spot_data, date, strategy_name,
+                                  strategy_config_path=strategy_config_path, engine=engine, profile=profile,
+                                  result_cache=result_cache, data_fingerprint=fingerprint, minutes=minutes,
+                                  greeks=greeks)
+    return backtester.run()
+
+
+def _run_day_safe(date, strategy_name, strategy_config_path, engine, cache, storage=None, profile=False,
+                  result_cache=None, fingerprint=None, compact=False, dataset=None):
+    # Runs in the worker: failures come back as data so one bad day does not
+    # take down the whole pool. The day's profile record, if asked for, is
+    # returned too and handed to the hooks in the parent process.
+    day_profile = DayProfile(date) if profile else None
+    try:
+        df = run_single_day(date, strategy_name, strategy_config_path, engine, cache, storage, day_profile,
+                            result_cache, fingerprint, compact, dataset)
+        error = None
+    except Exception as e:
+        df = None
+        error = {
+            'date': date,
+            'strategy': strategy_name,
+            'error_type': type(e).__name__,
+            'message': str(e),
+            'traceback': traceback.format_exc(),
+        }
+    record = None
+    if day_profile is not None:
+        record = day_profile.finish(strategy=strategy_name, engine=engine,
+                                    trades=0 if df is None else len(df),
+                                    error=None if error is None else error['error_type'])
+    return df, error, record
+
+
+def run_backtest(start_date, end_date, strategy_name, strategy_config_path='strategy_config.json',
+                 engine='loop', workers=None, cache=None, storage=None, prefetch=2, profiler=None, sink=None,
+                 result_cache=None, compact=False, dataset=None):
+    # Fan the trading days out over a process pool. Results are merged in date
+    # order regardless of which worker finishes first. Returns the combined
+    # trade log and a frame with one row per failed day. With a single worker
+    # the next `prefetch` days download in the background while the current
+    # one is simulated. A profiling.Profiler gets one record per day, in date
+    # order. With a trade_log.TradeLogSink each day's trades are written out as
+    # soon as it finishes and the returned trade log is None. Days whose
+    # result is in `result_cache` for the same config, engine version and
+    # source ETags are neither downloaded nor simulated. With `compact` each
+    # day's chain is loaded as a chain.compact_chain frame. Days held by a
+    # dataset.ChainDataset are read from it, only the strategy's legs, and
+    # are not downloaded.
+    days = trading_days(start_date, end_date)
+    workers = workers or os.cpu_count() or 1
+    profile = profiler is not None
+
+    fingerprints = {}
+    hits = {}
+    if result_cache is not None and cache is not None and not cache.revalidate:
+        # Results are keyed by the source's current ETags, so the frames a
+        # day is simulated on must be the ones stored under those ETags, not
+        # whatever the day cache last held for the date
+        cache = cache.revalidating()
+    if result_cache is not None:
+        source = storage or default_storage()
+        config = load_strategy_config(strategy_config_path, strategy_name)
+        for day in days:
+            try:
+                day_source = dataset if dataset is not None and dataset.contains(day) else source
+                fingerprints[day] = source_fingerprint(day_source, day)
+            except Exception:
+                # Missing object: leave it to the run to report
+                continue
+            hit, df = result_cache.lookup(day_result_key(config, engine, day, fingerprints[day]))
+            if hit:
+                hits[day] = df
+    todo = [day for day in days if day not in hits]
+    args = {day: dict(date=day, strategy_name=strategy_name, strategy_config_path=strategy_config_path,
+                      engine=engine, cache=cache, storage=storage, profile=profile, result_cache=result_cache,
+                      fingerprint=fingerprints.get(day), compact=compact, dataset=dataset) for day in todo}
+
+    results = []
+    errors = []
+
+    def cached(day):
+        record = None
+        if profile:
+            day_profile = DayProfile(day)
+            day_profile.count('result_cache_hits')
+            record = day_profile.finish(strategy=strategy_name, engine=engine, trades=len(hits[day]), error=None)
+        return hits[day], None, record
+
+    def collect(day, outcome):
+        df, error, record = outcome
+        if profiler is not None:
+            profiler.emit(record)
+        if error is not None:
+            errors.append(error)
+            if sink is not None:
+                sink.remove(strategy_name, day)
+        elif sink is not None:
+            sink.append(df, strategy_name, day)
+        elif not df.empty:
+            results.append(df)
+
+    if workers == 1 or len(todo) <= 1:
+        downloads = [day for day in todo if dataset is None or not dataset.contains(day)]
+        if prefetch and downloads:
+            prefetched = iter(Prefetcher(storage or default_storage(), downloads, depth=prefetch, cache=cache))
+
+            def run(day):
+                if day not in downloads:
+                    return _run_day_safe(**args[day])
+                _, day_storage = next(prefetched)
+                return _run_day_safe(**{**args[day], 'storage': day_storage})
+        else:
+            def run(day):
+                return _run_day_safe(**args[day])
+        for day in days:
+            collect(day, cached(day) if day in hits else run(day))
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(todo))) as pool:
+            futures = {day: pool.submit(_run_day_safe, **args[day]) for day in todo}
+            for day in days:
+                collect(day, cached(day) if day in hits else futures[day].result())
+
+    final_df = None
+    if sink is None:
+        final_df = pd.concat(results, ignore_index=True) if results else pd.DataFrame()
+    return final_df, pd.DataFrame(errors, columns=ERROR_COLUMNS)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Run an option strategy backtest over a date range.')
+    parser.add_argument('--start', default='2024-07-05', help='first date, YYYY-MM-DD')
+    parser.add_argument('--end', default='2024-07-12', help='last date, YYYY-MM-DD')
+    parser.add_argument('--strategy', default='straddle', help='strategy name in the config file')
+    parser.add_argument('--config', default='strategy_config.json', help='strategy config path')
+    parser.add_argument('--engine', default='loop', choices=ENGINES)
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: CPU count)')
+    parser.add_argument('--output', default='backtest_results.csv', help='CSV exported from the trade log at the end')
+    parser.add_argument('--trade-log', default='trade_log', help='directory each finished day is written to')
+    parser.add_argument('--errors', default='backtest_errors.csv', help='where to write the per-day error report')
+    parser.add_argument('--no-cache', action='store_true', help='always fetch from S3')
+    parser.add_argument('--revalidate', action='store_true',
+                        help='check cached days against the source ETags (also BACKTEST_CACHE_REVALIDATE=1)')
+    parser.add_argument('--no-result-cache', action='store_true', help='resimulate days even if their result is cached')
+    parser.add_argument('--data-dir', default=None, help='read day files from this directory instead of S3')
+    parser.add_argument('--prefetch', type=int, default=2, help='days to download ahead when running with one worker')
+    parser.add_argument('--profile', default=None, help='append a per-day phase timing record to this JSON lines file')
+    parser.add_argument('--compact', action='store_true', help='load chains with compact typed columns')
+    parser.add_argument('--dataset', default=None,
+                        help='read days held in this chain dataset (see dataset.py), only the legs traded')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    start_date = datetime.strptime(args.start, '%Y-%m-%d')
+    end_date = datetime.strptime(args.end, '%Y-%m-%d')
+    cache = None if args.no_cache else DayCache.from_env()
+    if cache is not None and args.revalidate:
+        cache.revalidate = True
+    result_cache = None if args.no_result_cache else ResultCache.from_env()
+    storage = LocalStorage(args.data_dir) if args.data_dir else None
+    dataset = ChainDataset(args.dataset) if args.dataset else None
+    profiler = Profiler([JsonLinesHook(args.profile)]) if args.profile else None
+    sink = TradeLogSink(args.trade_log)
+
+    _, errors = run_backtest(start_date, end_date, args.strategy, args.config,
+                             engine=args.engine, workers=args.workers, cache=cache,
+                             storage=storage, prefetch=args.prefetch, profiler=profiler, sink=sink,
+                             result_cache=result_cache, compact=args.compact, dataset=dataset)
+    trades = sink.reader().to_csv(args.output, start=args.start, end=args.end, strategies=[args.strategy],
+                                  include_strategy=False)
+    print(f"{trades} trades written to {args.output}")
+
+    # The report always describes this run: an empty one when no day failed
+    errors.to_csv(args.errors, index=False)
+    if not errors.empty:
+        print(f"{len(errors)} day(s) failed, see {args.errors}:", file=sys.stderr)
+        for err in errors.itertuples():
+            print(f"  {err.date}: {err.error_type}: {err.message}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,261 @@
+# spot_history.py
+
+import json
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from storage import day_key
+
+HOURLY_FREQ = '1h'
+HOURLY_OFFSET = '15min'
+EMA_PERIODS = (50, 100)
+# Days of bars held before the least recently used are evicted
+DEFAULT_MAX_DAYS = 30
+
+
+class EmaState:
+    # Running equivalent of series.ewm(span=period, adjust=False).mean(),
+    # including how pandas carries the average across NaN rows.
+    __slots__ = ('alpha', 'weighted', 'old_wt', 'nobs')
+
+    def __init__(self, period):
+        # Derived through the centre of mass, as pandas does for span
+        self.alpha = 1.0 / (1.0 + (period - 1) / 2.0)
+        self.weighted = float('nan')
+        self.old_wt = 1.0
+        self.nobs = 0
+
+    def update(self, value):
+        is_observation = value == value
+        if self.nobs == 0 and self.weighted != self.weighted:
+            if is_observation:
+                self.weighted = value
+                self.nobs = 1
+            return self.weighted
+        self.nobs += is_observation
+        if self.weighted == self.weighted:
+            self.old_wt *= 1.0 - self.alpha
+            if is_observation:
+                if self.weighted != value:
+                    self.weighted = self.old_wt * self.weighted + self.alpha * value
+                    self.weighted /= (self.old_wt + self.alpha)
+                self.old_wt = 1.0
+        elif is_observation:
+            self.weighted = value
+        return self.weighted
+
+    def copy(self):
+        other = EmaState.__new__(EmaState)
+        for name in EmaState.__slots__:
+            setattr(other, name, getattr(self, name))
+        return other
+
+
+class SpotHistory:
+    """Spot bars kept per day, fetched at most once each.
+
+    Besides the minute bars it keeps each day's hourly bars and running EMA
+    state over both hourly and minute closes, snapshotted at the end of
+    every stored day, so a week-by-week run does not re-download or
+    re-resample the same lookback window every week. Only the bars of the
+    ``max_days`` most recently used days are held; evicted days keep just
+    their snapshot and are fetched again if a query or a replay needs them.
+
+    The EMAs ``hourly`` and ``bias`` report start at the lookback window's
+    first bar, exactly as get_spot_hourly_data and calculate_bias compute
+    them without a history, so they depend on the date alone. With
+    ``carry_history`` they instead continue from the snapshot of every day
+    stored before the window, which makes them depend on what earlier
+    queries have stored.
+    """
+
+    def __init__(self, storage, lookback_days=7, periods=EMA_PERIODS, max_days=DEFAULT_MAX_DAYS,
+                 carry_history=False):
+        self.storage = storage
+        self.lookback_days = lookback_days
+        self.periods = periods
+        self.carry_history = carry_history
+        # Never fewer than one lookback window's worth of days
+        self.max_days = max(max_days, lookback_days + 1)
+        self.minutes = {}
+        self.hourly_bars = {}
+        self.missing = set()
+        # Every day stored so far, including ones whose bars were evicted
+        self.days = set()
+        # Running EMA state at the end of each stored day
+        self._snapshots = {}
+
+    def ensure(self, date):
+        # Fetch whichever days of the lookback window ending at `date` we do
+        # not hold. Days with no object (weekends, holidays) are remembered
+        # so they are not asked for again.
+        for day in self.window_days(date):
+            if day in self.minutes:
+                # Most recently used last, for eviction
+                self.minutes[day] = self.minutes.pop(day)
+            elif day not in self.missing:
+                self._fetch(day)
+
+    def window_days(self, date):
+        end = _as_datetime(date)
+        start = end - timedelta(days=self.lookback_days)
+        return [(start + timedelta(days=i)).strftime('%Y-%m-%d') for i in range((end - start).days + 1)]
+
+    def append_day(self, day, df):
+        df = df.copy()
+        df['datetime'] = pd.to_datetime(df['datetime'])
+        self.minutes.pop(day, None)
+        self.minutes[day] = df
+        self.hourly_bars[day] = df.set_index('datetime').resample(HOURLY_FREQ, offset=HOURLY_OFFSET).last()
+        self.days.add(day)
+        if day not in self._snapshots:
+            # A day inserted before already-replayed ones invalidates their
+            # states; an evicted day fetched again leaves them as they are
+            for later in [d for d in self._snapshots if d > day]:
+                del self._snapshots[later]
+        self._evict(keep=day)
+
+    def minute_window(self, date):
+        # Minute bars for the lookback window, concatenated the way
+        # get_spot_hourly_data builds spot_df
+        self.ensure(date)
+        frames = [self.minutes[day] for day in self.window_days(date) if day in self.minutes]
+        return pd.concat(frames) if frames else pd.DataFrame()
+
+    def hourly(self, date):
+        # Hourly bars over the lookback window (empty hours as NaN rows), as
+        # get_spot_hourly_data builds them, with ema_50/ema_100 over the
+        # window or, with carry_history, continued from the snapshot before
+        # the window's first day
+        self.ensure(date)
+        days = [day for day in self.window_days(date) if day in self.hourly_bars]
+        if not days:
+            return pd.DataFrame()
+        hourly = pd.concat([self.hourly_bars[day] for day in days])
+        if not self.carry_history:
+            hourly = hourly.reindex(pd.date_range(hourly.index[0], hourly.index[-1], freq=HOURLY_FREQ,
+                                                  name=hourly.index.name))
+            for p in self.periods:
+                hourly[f'ema_{p}'] = hourly['close'].ewm(span=p, adjust=False).mean()
+            return hourly
+        state = self._state_through(days[0], inclusive=False)
+        states = {p: s.copy() for p, s in state['hourly'].items()}
+        hourly = hourly.reindex(pd.date_range(hourly.index[0], hourly.index[-1], freq=HOURLY_FREQ, name=hourly.index.name))
+        if state['last_bar'] is not None:
+            _skip_hours(states, state['last_bar'], hourly.index[0])
+        emas = {p: np.empty(len(hourly)) for p in self.periods}
+        for i, close in enumerate(hourly['close'].to_numpy(dtype=float)):
+            for p, s in states.items():
+                emas[p][i] = s.update(close)
+        for p in self.periods:
+            hourly[f'ema_{p}'] = emas[p]
+        return hourly
+
+    def running_ema(self, date):
+        # EMA of hourly and minute closes over all stored history up to the end
+        # of `date`: {'hourly': {50: x, 100: y}, 'minute': {...}}
+        state = self._state_through(date)
+        return {kind: {p: s.weighted for p, s in states.items()} for kind, states in state.items()
+                if kind in ('hourly', 'minute')}
+
+    def bias(self, date, at='09:20'):
+        # calculate_bias for the given day and time: the minute EMAs over the
+        # lookback window's closes up to `at` or, with carry_history, from
+        # the previous day's snapshot on
+        day = _as_datetime(date).strftime('%Y-%m-%d')
+        cutoff = pd.to_datetime(f"{day} {at}:00")
+        if not self.carry_history:
+            window = self.minute_window(date)
+            closes = window.loc[window['datetime'] <= cutoff, 'close'] if len(window) else pd.Series(dtype=float)
+            if closes.empty:
+                # No EMAs to compare, as with carry_history before any data
+                return "negative"
+            fast, slow = (closes.ewm(span=p, adjust=False).mean().iloc[-1] for p in self.periods[:2])
+            return "positive" if fast > slow else "negative"
+        self.ensure(date)
+        today = self.minutes.get(day)
+        state = self._state_through(day, inclusive=False)
+        minute_states = {p: s.copy() for p, s in state['minute'].items()}
+        if today is not None:
+            for close in today.loc[today['datetime'] <= cutoff, 'close'].to_numpy(dtype=float):
+                for s in minute_states.values():
+                    s.update(close)
+        fast, slow = (minute_states[p].weighted for p in self.periods[:2])
+        return "positive" if fast > slow else "negative"
+
+    def _fetch(self, day):
+        try:
+            body, _ = self.storage.get(day_key('nifty_spot', day))
+            try:
+                data = json.loads(body.read().decode('utf-8'))
+            finally:
+                body.close()
+        except Exception:
+            self.missing.add(day)
+            self.days.discard(day)
+            return False
+        self.append_day(day, pd.DataFrame(data))
+        return True
+
+    def _evict(self, keep=None):
+        # Drop the bars of the least recently used days beyond max_days
+        # (`minutes` is kept in use order); snapshots stay
+        while len(self.minutes) > self.max_days:
+            oldest = next(day for day in self.minutes if day != keep)
+            del self.minutes[oldest]
+            del self.hourly_bars[oldest]
+
+    def _state_through(self, date, inclusive=True):
+        # Replay stored days in order from the latest snapshot not after `date`
+        day_limit = _as_datetime(date).strftime('%Y-%m-%d')
+        days = sorted(d for d in self.days if d < day_limit or (inclusive and d == day_limit))
+        state = {'hourly': {p: EmaState(p) for p in self.periods},
+                 'minute': {p: EmaState(p) for p in self.periods},
+                 'last_bar': None}
+        start = 0
+        for i in range(len(days) - 1, -1, -1):
+            if days[i] in self._snapshots:
+                state = _copy_state(self._snapshots[days[i]])
+                start = i + 1
+                break
+        for day in days[start:]:
+            if day not in self.minutes and not self._fetch(day):
+                # Evicted and no longer in the bucket
+                continue
+            hourly = self.hourly_bars[day]
+            if len(hourly):
+                if state['last_bar'] is not None:
+                    _skip_hours(state['hourly'], state['last_bar'], hourly.index[0])
+                for close in hourly['close'].to_numpy(dtype=float):
+                    for s in state['hourly'].values():
+                        s.update(close)
+                state['last_bar'] = hourly.index[-1]
+            for close in self.minutes[day]['close'].to_numpy(dtype=float):
+                for s in state['minute'].values():
+                    s.update(close)
+            self._snapshots[day] = _copy_state(state)
+        return state
+
+
+def _skip_hours(states, last_bar, next_bar):
+    # Empty hours between one day's last bar and the next one's first
+    gap = int((next_bar - last_bar) / pd.Timedelta(HOURLY_FREQ)) - 1
+    for _ in range(max(gap, 0)):
+        for s in states.values():
+            s.update(float('nan'))
+
+
+def _copy_state(state):
+    return {
+        'hourly': {p: s.copy() for p, s in state['hourly'].items()},
+        'minute': {p: s.copy() for p, s in state['minute'].items()},
+        'last_bar': state['last_bar'],
+    }
+
+
+def _as_datetime(date):
+    if isinstance(date, str):
+        return datetime.strptime(date[:10], '%Y-%m-%d')
+    return datetime(date.year, date.month, date.day)
@@ -0,0 +1,203 @@
+# storage.py
+
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+DAY_FOLDERS = ('nifty_options', 'nifty_spot')
+DEFAULT_BUCKET = 'nifty-options-data-chokli'
+DEFAULT_POOL_SIZE = 16
+DEFAULT_MAX_RETRIES = 5
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def day_key(folder, date):
+    return f"{folder}/{date}.json"
+
+
+def is_not_found(error):
+    # Whether a storage error says the key does not exist, as opposed to a
+    # failure worth retrying: a missing local file or an S3 NoSuchKey/404
+    if isinstance(error, FileNotFoundError):
+        return True
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict):
+        return str(response.get('Error', {}).get('Code')) in ('NoSuchKey', 'NotFound', '404')
+    return False
+
+
+def s3_client():
+    # One boto3 session and client, with its connection pool, per process.
+    # Built on first use, so importing the strategies needs neither boto3 nor
+    # credentials; a forked worker builds its own rather than sharing the
+    # parent's sockets. Pool size and retries come from BACKTEST_S3_POOL_SIZE
+    # and BACKTEST_S3_MAX_RETRIES.
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+    with _client_lock:
+        if _client is None or _client_pid != pid:
+            import boto3
+            from botocore.config import Config
+            from dotenv import load_dotenv
+
+            load_dotenv()
+            session = boto3.session.Session(
+                aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+                aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+                region_name=os.getenv("AWS_DEFAULT_REGION"),
+            )
+            config = Config(
+                max_pool_connections=int(os.getenv('BACKTEST_S3_POOL_SIZE', DEFAULT_POOL_SIZE)),
+                retries={'max_attempts': int(os.getenv('BACKTEST_S3_MAX_RETRIES', DEFAULT_MAX_RETRIES)),
+                         'mode': 'standard'},
+            )
+            _client = session.client('s3', config=config)
+            _client_pid = pid
+    return _client
+
+
+def default_storage(bucket=None):
+    return S3Storage(bucket=bucket or os.getenv('BACKTEST_S3_BUCKET', DEFAULT_BUCKET))
+
+
+class S3Storage:
+    # Without an explicit client the process-wide s3_client() is used, looked
+    # up on first request; such an instance pickles without it and picks up
+    # the worker's own client on the other side.
+    def __init__(self, client=None, bucket=DEFAULT_BUCKET):
+        self._client = client
+        self.bucket = bucket
+
+    @property
+    def client(self):
+        return self._client if self._client is not None else s3_client()
+
+    def get(self, key):
+        # (readable body, etag)
+        response = self.client.get_object(Bucket=self.bucket, Key=key)
+        return response['Body'], response.get('ETag')
+
+    def head(self, key):
+        return self.client.head_object(Bucket=self.bucket, Key=key).get('ETag')
+
+
+class LocalStorage:
+    # Same key layout as the bucket, rooted at a local directory. Handy for
+    # tests and for working offline from a mirrored copy.
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def get(self, key):
+        path = self.path(key)
+        f = open(path, 'rb')
+        return f, self._etag(os.fstat(f.fileno()))
+
+    def head(self, key):
+        return self._etag(os.stat(self.path(key)))
+
+    def _etag(self, stat):
+        return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+
+class MemoryStorage:
+    # Objects already downloaded by the Prefetcher. Keys that failed to
+    # download re-raise their original error when asked for; keys it did
+    # not download (e.g. because the cache held them, and may have evicted
+    # them since) are read from `fallback` if there is one.
+    def __init__(self, objects, fallback=None):
+        self.objects = objects
+        self.fallback = fallback
+
+    def get(self, key):
+        if key not in self.objects:
+            if self.fallback is None:
+                raise KeyError(key)
+            return self.fallback.get(key)
+        body, etag = self.objects[key]
+        if isinstance(body, BaseException):
+            raise body
+        return BytesIO(body), etag
+
+    def head(self, key):
+        if key not in self.objects and self.fallback is not None:
+            return self.fallback.head(key)
+        return self.get(key)[1]
+
+
+class Prefetcher:
+    """Download the objects for upcoming days on background threads.
+
+    Iterating yields ``(date, MemoryStorage)`` in date order. At most ``depth``
+    days are downloading or waiting to be consumed at any time, which bounds
+    memory to roughly ``depth`` days of raw JSON. Keys the cache already
+    holds (under the current ETag, if it revalidates) are not downloaded;
+    should the cache evict them before the day is run, they are read from
+    ``storage`` then.
+    """
+
+    def __init__(self, storage, dates, folders=DAY_FOLDERS, depth=2, workers=None, cache=None):
+        self.storage = storage
+        self.dates = list(dates)
+        self.folders = folders
+        self.depth = max(1, depth)
+        self.workers = workers or self.depth * len(folders)
+        self.cache = cache
+
+    def __iter__(self):
+        pending = deque()
+        dates = iter(self.dates)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            try:
+                for date in dates:
+                    pending.append((date, self._submit(pool, date)))
+                    if len(pending) >= self.depth:
+                        break
+                while pending:
+                    date, futures = pending.popleft()
+                    objects = {key: future.result() for key, future in futures.items()}
+                    # None: the cache turned out to hold it
+                    objects = {key: result for key, result in objects.items() if result is not None}
+                    # Keep the window full while the caller works on this day
+                    for next_date in dates:
+                        pending.append((next_date, self._submit(pool, next_date)))
+                        break
+                    yield date, MemoryStorage(objects, fallback=self.storage)
+            finally:
+                for _, futures in pending:
+                    for future in futures.values():
+                        future.cancel()
+
+    def _submit(self, pool, date):
+        futures = {}
+        for folder in self.folders:
+            if self.cache is not None and not self.cache.revalidate and self.cache.contains(folder, date):
+                continue
+            key = day_key(folder, date)
+            futures[key] = pool.submit(self._download, key, folder, date)
+        return futures
+
+    def _download(self, key, folder, date):
+        try:
+            if self.cache is not None and self.cache.revalidate:
+                # Only what the cache does not hold under the current ETag
+                if self.cache.contains(folder, date, self.storage.head(key)):
+                    return None
+            body, etag = self.storage.get(key)
+            try:
+                return body.read(), etag
+            finally:
+                close = getattr(body, 'close', None)
+                if close is not None:
+                    close()
+        except Exception as e:
+            return e, None
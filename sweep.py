@@ -0,0 +1,203 @@
+# sweep.py
+
+import copy
+import itertools
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from backtest import Strategy, align_leg, combine_legs, data_loader, leg_path, leg_segments
+from greeks import chain_minutes, first_minute_greeks
+from runner import ERROR_COLUMNS, trading_days
+
+SWEEP_PARAMS = ('stop_loss', 'target', 'otm', 'delta', 'max_loss', 'max_rentries', 'reentry_on_sl')
+# The runner's error report plus the config that failed; empty for a day
+# that could not be loaded at all
+SWEEP_ERROR_COLUMNS = ERROR_COLUMNS[:2] + ['config_id'] + ERROR_COLUMNS[2:]
+
+# Config keys that decide where a leg's exits fall; max_loss only acts when
+# the legs are combined, so segments are shared across max_loss values.
+_SEGMENT_KEYS = ('stop_loss', 'target', 'reentry_on_sl', 'max_rentries')
+
+
+def expand_grid(grid):
+    # {'stop_loss': [0.2, 0.3], 'otm': [0, 2]} -> one params dict per combination
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def apply_params(base_config, params):
+    config = copy.deepcopy(base_config)
+    for name, value in params.items():
+        if name not in SWEEP_PARAMS:
+            raise ValueError(f"Cannot sweep {name!r}, expected one of {SWEEP_PARAMS}")
+        if name in ('otm', 'delta'):
+            # Legs are placed by one or the other; None drops the key from
+            # every leg, like it drops the config-level params below
+            for leg in config['legs']:
+                if value is None:
+                    leg.pop(name, None)
+                else:
+                    leg.pop('delta' if name == 'otm' else 'otm', None)
+                    leg[name] = value
+        elif value is None:
+            config.pop(name, None)
+        else:
+            config[name] = value
+    return config
+
+
+class SweepDay:
+    """One day's option and spot data, parsed and indexed once and then shared
+    by every config evaluated against it."""
+
+    def __init__(self, date, data, data_spot):
+        self.date = date
+        self.data = data.copy()
+        self.data['datetime'] = pd.to_datetime(self.data['datetime'])
+        self.data_spot = data_spot.copy()
+        self.data_spot['datetime'] = pd.to_datetime(self.data_spot['datetime'])
+
+        self.timestamps = np.unique(self.data['datetime'].to_numpy())
+        self.hhmm = self.data['datetime'].dt.strftime('%H:%M').to_numpy()
+        self.spot_hhmm = self.data_spot['datetime'].dt.strftime('%H:%M').to_numpy()
+        self.rights = self.data['right'].str.lower().to_numpy()
+        self.strikes = self.data['strike'].to_numpy()
+
+        self._atm = {}
+        self._greeks = {}
+        self._legs = {}
+        self._paths = {}
+
+    def atm_strike(self, entry_time):
+        if entry_time not in self._atm:
+            spot_price = float(self.data_spot['close'].to_numpy()[self.spot_hhmm >= entry_time][0])
+            self._atm[entry_time] = int(round(spot_price / 50) * 50)
+        return self._atm[entry_time]
+
+    def greeks(self, entry_time):
+        # Greeks of the entry minute, worked out the first time a config
+        # entering then targets delta
+        if entry_time not in self._greeks:
+            self._greeks[entry_time] = first_minute_greeks(*chain_minutes(self.data), self.data_spot, entry_time)
+        return self._greeks[entry_time]
+
+    def leg(self, strike, opt_type, entry_time):
+        key = (strike, opt_type, entry_time)
+        if key not in self._legs:
+            mask = (self.strikes == strike) & (self.rights == opt_type) & (self.hhmm >= entry_time)
+            leg = None
+            if mask.any():
+                leg = align_leg(self.data[mask], self.timestamps)
+                leg.update({"strike": strike, "type": opt_type})
+            self._legs[key] = leg
+        return self._legs[key]
+
+    def leg_path(self, strike, opt_type, config):
+        key = (strike, opt_type, config['entry_time']) + tuple(config.get(k) for k in _SEGMENT_KEYS)
+        if key not in self._paths:
+            leg = self.leg(strike, opt_type, config['entry_time'])
+            self._paths[key] = None if leg is None else leg_path(leg, leg_segments(leg, config))
+        return self._paths[key]
+
+    def run(self, config):
+        # Trade log rows for one config, same as OptionBacktester(..., engine='vectorized')
+        strategy = Strategy(config)
+        greeks = self.greeks(config['entry_time']) if strategy.uses_delta() else None
+        strike_pairs = strategy.get_strikes(self.atm_strike(config['entry_time']), greeks)
+        legs = [self.leg_path(strike, opt_type, config) for strike, opt_type in strike_pairs]
+        legs = [leg for leg in legs if leg is not None]
+        return combine_legs(legs, self.timestamps, config.get('max_loss', None), self.date)
+
+
+def sweep_day(date, data, data_spot, base_config, param_sets):
+    # Tidy trade table for every params dict in param_sets on one day: the
+    # usual trade log columns plus config_id and one column per parameter.
+    # A config that fails is reported in the returned error rows and the rest
+    # of the grid still runs.
+    day = SweepDay(date, data, data_spot)
+    frames = []
+    errors = []
+    for config_id, params in enumerate(param_sets):
+        try:
+            trades = day.run(apply_params(base_config, params))
+        except Exception as e:
+            errors.append(_error_row(date, 'sweep', e, config_id))
+            continue
+        if not trades:
+            continue
+        df = pd.DataFrame(trades)
+        df.insert(0, 'config_id', config_id)
+        for i, (name, value) in enumerate(params.items()):
+            df.insert(1 + i, name, value)
+        frames.append(df)
+    trades = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    return trades, errors
+
+
+def _sweep_day_safe(date, base_config, param_sets, cache):
+    try:
+        data_class = data_loader(date, cache=cache)
+        return sweep_day(date, data_class.load_data(), data_class.load_spot_data(), base_config, param_sets)
+    except Exception as e:
+        return None, [_error_row(date, 'sweep', e)]
+
+
+def _error_row(date, strategy, error, config_id=None):
+    return {
+        'date': date,
+        'strategy': strategy,
+        'config_id': config_id,
+        'error_type': type(error).__name__,
+        'message': str(error),
+        'traceback': traceback.format_exc(),
+    }
+
+
+def run_sweep(start_date, end_date, base_config, grid=None, param_sets=None, workers=None, cache=None):
+    # Evaluate a parameter grid (or an explicit list of params dicts) over a
+    # date range. Each day is loaded once and all configs run against it.
+    # Returns the tidy trade table and the per-day error report.
+    if param_sets is None:
+        param_sets = expand_grid(grid or {})
+    param_sets = list(param_sets) or [{}]
+    days = trading_days(start_date, end_date)
+    workers = workers or os.cpu_count() or 1
+    args = [(day, base_config, param_sets, cache) for day in days]
+
+    if workers == 1 or len(days) <= 1:
+        outcomes = [_sweep_day_safe(*a) for a in args]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(days))) as pool:
+            futures = [pool.submit(_sweep_day_safe, *a) for a in args]
+            outcomes = [f.result() for f in futures]
+
+    results = [df for df, _ in outcomes if df is not None and not df.empty]
+    errors = [err for _, day_errors in outcomes for err in day_errors]
+    trades = pd.concat(results, ignore_index=True) if results else pd.DataFrame()
+    return trades, pd.DataFrame(errors, columns=SWEEP_ERROR_COLUMNS)
+
+
+def summarize_sweep(trades, params=None):
+    # One row per parameter combination: total and average daily P&L, trade
+    # count and the share of trades that made money.
+    if trades.empty:
+        return pd.DataFrame()
+    if params is None:
+        params = [c for c in trades.columns if c in SWEEP_PARAMS]
+    keys = ['config_id'] + list(params)
+    daily = (trades.assign(win=trades['pnl'] > 0)
+             .groupby(keys + ['date'], dropna=False, sort=False)
+             .agg(pnl=('pnl', 'sum'), trades=('pnl', 'size'), wins=('win', 'sum')))
+    summary = daily.groupby(level=keys, dropna=False, sort=False).agg(
+        total_pnl=('pnl', 'sum'),
+        avg_daily_pnl=('pnl', 'mean'),
+        days=('pnl', 'size'),
+        trades=('trades', 'sum'),
+        wins=('wins', 'sum'),
+    )
+    summary['win_rate'] = summary.pop('wins') / summary['trades']
+    return summary.reset_index().sort_values('total_pnl', ascending=False, ignore_index=True)
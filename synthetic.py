@@ -0,0 +1,136 @@
+# synthetic.py
+
+import json
+import math
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from greeks import bs_price
+
+STRIKE_STEP = 50
+SESSION_START = '09:15'
+SESSION_MINUTES = 375
+EXPIRY_WEEKDAY = 3  # Thursday
+ORIGIN = datetime(2024, 1, 1)
+
+
+def next_expiry(day):
+    return day + timedelta(days=(EXPIRY_WEEKDAY - day.weekday()) % 7)
+
+
+class SyntheticMarket:
+    """Deterministic Nifty-like spot and weekly option chains.
+
+    Spot is a seeded random walk carried from day to day; option minute
+    bars are Black-Scholes prices along that walk, so strikes, rights and expiry
+    move together the way a real chain does. The same seed always gives the
+    same data. ``gap_rate`` drops that share of option candles to mimic
+    illiquid minutes.
+    """
+
+    def __init__(self, seed=0, start_spot=24000.0, vol=0.13, strikes_per_side=10, substeps=4, gap_rate=0.0):
+        self.seed = seed
+        self.start_spot = start_spot
+        self.vol = vol
+        self.strikes_per_side = strikes_per_side
+        self.substeps = substeps
+        self.gap_rate = gap_rate
+        self._steps = {}
+
+    def _day_rng(self, day):
+        return np.random.default_rng([self.seed, day.toordinal()])
+
+    def _day_steps(self, day):
+        # Log-returns of one session's sub-steps, opening gap first
+        if day.toordinal() not in self._steps:
+            rng = self._day_rng(day)
+            sigma = self.vol / math.sqrt(252 * SESSION_MINUTES * self.substeps)
+            steps = rng.normal(0.0, sigma, SESSION_MINUTES * self.substeps)
+            steps[0] += rng.normal(0.0, self.vol / math.sqrt(252) / 3)
+            self._steps[day.toordinal()] = steps
+        return self._steps[day.toordinal()]
+
+    def spot_path(self, day):
+        # Sub-step spot levels for one session. The walk starts at start_spot
+        # on ORIGIN and each weekday opens from the previous one's close.
+        ordinal = day.toordinal()
+        origin = ORIGIN.toordinal()
+        between = [datetime.fromordinal(o) for o in range(min(ordinal, origin), max(ordinal, origin))]
+        carried = sum(self._day_steps(d).sum() for d in between if d.weekday() < 5)
+        level = self.start_spot * math.exp(carried if ordinal >= origin else -carried)
+        return level * np.exp(np.cumsum(self._day_steps(day)))
+
+    def day(self, day):
+        # (options items, spot records) in the shape stored in the bucket
+        day = datetime(day.year, day.month, day.day)
+        date_str = day.strftime('%Y-%m-%d')
+        expiry = next_expiry(day)
+        path = self.spot_path(day).reshape(SESSION_MINUTES, self.substeps)
+        start = datetime.strptime(f"{date_str} {SESSION_START}", '%Y-%m-%d %H:%M')
+        stamps = [(start + timedelta(minutes=m)).strftime('%Y-%m-%d %H:%M:%S') for m in range(SESSION_MINUTES)]
+
+        spot = [{'datetime': stamps[m], 'open': round(float(path[m, 0]), 2), 'high': round(float(path[m].max()), 2),
+                 'low': round(float(path[m].min()), 2), 'close': round(float(path[m, -1]), 2)}
+                for m in range(SESSION_MINUTES)]
+
+        atm = int(round(path[0, 0] / STRIKE_STEP) * STRIKE_STEP)
+        strikes = atm + STRIKE_STEP * np.arange(-self.strikes_per_side, self.strikes_per_side + 1)
+        minutes_left = (expiry + timedelta(hours=15, minutes=30) - start).total_seconds() / 60.0
+        years = (minutes_left - np.arange(SESSION_MINUTES * self.substeps) / self.substeps) / (365 * 24 * 60)
+        years = years.reshape(SESSION_MINUTES, self.substeps)
+
+        rng = np.random.default_rng([self.seed, day.toordinal(), 1])
+        volume = rng.integers(50, 5000, size=(len(strikes), 2, SESSION_MINUTES))
+        dropped = rng.random((len(strikes), 2, SESSION_MINUTES)) < self.gap_rate
+        expiry_str = expiry.strftime('%Y-%m-%dT00:00:00.000Z')
+        items = []
+        for i, strike in enumerate(strikes):
+            for j, right in enumerate(('call', 'put')):
+                prices = bs_price(path, float(strike), years, self.vol, right == 'call')
+                prices = np.maximum(np.round(prices, 2), 0.05)
+                for m in np.flatnonzero(~dropped[i, j]):
+                    items.append({
+                        'date': date_str,
+                        'strike': int(strike),
+                        'atm': atm,
+                        'right': right,
+                        'expiry': expiry_str,
+                        'option_data': {
+                            'datetime': stamps[m],
+                            'open': float(prices[m, 0]),
+                            'high': float(prices[m].max()),
+                            'low': float(prices[m].min()),
+                            'close': float(prices[m, -1]),
+                            'volume': int(volume[i, j, m]),
+                        },
+                    })
+        return items, spot
+
+    def write(self, root, start_date, end_date):
+        # Write weekday files under root/nifty_options and root/nifty_spot,
+        # the layout LocalStorage reads. Returns the dates written.
+        written = []
+        for folder in ('nifty_options', 'nifty_spot'):
+            os.makedirs(os.path.join(root, folder), exist_ok=True)
+        current = start_date
+        while current <= end_date:
+            if current.weekday() < 5:
+                date_str = current.strftime('%Y-%m-%d')
+                items, spot = self.day(current)
+                with open(os.path.join(root, 'nifty_options', f"{date_str}.json"), 'w') as f:
+                    json.dump(items, f)
+                with open(os.path.join(root, 'nifty_spot', f"{date_str}.json"), 'w') as f:
+                    json.dump(spot, f)
+                written.append(date_str)
+            current += timedelta(days=1)
+        return written
+
+    def frames(self, day):
+        # (flattened options frame, spot frame) without touching disk
+        items, spot = self.day(day)
+        rows = [{**{k: item[k] for k in ('date', 'strike', 'atm', 'right', 'expiry')}, **item['option_data']}
+                for item in items]
+        return pd.DataFrame(rows), pd.DataFrame(spot)
@@ -0,0 +1,148 @@
+# trade_log.py
+
+import csv
+import os
+import tempfile
+
+import pandas as pd
+
+from day_cache import read_frame, write_frame
+
+TRADE_COLUMNS = ['date', 'strike', 'type', 'exit_reason', 'entry_time', 'exit_time',
+                 'entry_price', 'exit_price', 'pnl', 'reentry_id']
+TRADE_DTYPES = {
+    'date': 'str',
+    'strike': 'int64',
+    'type': 'str',
+    'exit_reason': 'str',
+    'entry_time': 'datetime64[ns]',
+    'exit_time': 'datetime64[ns]',
+    'entry_price': 'float64',
+    'exit_price': 'float64',
+    'pnl': 'float64',
+    'reentry_id': 'int64',
+}
+
+
+def typed_trades(df):
+    # The trade log with a fixed column order and dtypes, whichever engine
+    # produced it; extra columns are kept after the standard ones
+    if df is None or df.empty:
+        return pd.DataFrame({col: pd.Series(dtype=object if dtype == 'str' else dtype)
+                             for col, dtype in TRADE_DTYPES.items()})
+    df = df.copy()
+    for col, dtype in TRADE_DTYPES.items():
+        if col not in df.columns:
+            df[col] = None
+        if dtype == 'str':
+            df[col] = df[col].map(lambda v: None if pd.isna(v) else str(v)).astype(object)
+        elif dtype.startswith('datetime64'):
+            df[col] = pd.to_datetime(df[col]).astype(dtype)
+        else:
+            df[col] = df[col].astype(dtype)
+    extra = [col for col in df.columns if col not in TRADE_DTYPES]
+    return df[TRADE_COLUMNS + extra]
+
+
+class TradeLogSink:
+    """Append-only on-disk trade log.
+
+    Each finished day is written as its own columnar part,
+    ``{root}/{strategy}/{date}.npz``, as soon as it is appended, so a crash
+    loses at most the day in flight and nothing is held in memory. Writing a
+    day again replaces its part. Days with no trades still get an (empty)
+    part, which records that they ran.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def append(self, df, strategy, date):
+        strategy_dir = os.path.join(self.root, strategy)
+        os.makedirs(strategy_dir, exist_ok=True)
+        path = os.path.join(strategy_dir, f"{date}.npz")
+        fd, tmp_path = tempfile.mkstemp(dir=strategy_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write_frame(f, typed_trades(df))
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        return path
+
+    def remove(self, strategy, date):
+        # Drop a day's part, e.g. one left by an earlier run of a day that
+        # has now failed, so it is not exported as this run's result
+        try:
+            os.remove(os.path.join(self.root, strategy, f"{date}.npz"))
+        except FileNotFoundError:
+            pass
+
+    def contains(self, strategy, date):
+        return os.path.exists(os.path.join(self.root, strategy, f"{date}.npz"))
+
+    def reader(self):
+        return TradeLogReader(self.root)
+
+
+class TradeLogReader:
+    # Reads parts back one at a time; filters on date and strategy are applied
+    # to the file names, so skipped days are never opened.
+    def __init__(self, root):
+        self.root = root
+
+    def parts(self, start=None, end=None, strategies=None):
+        # [(date, strategy, path)] in date order
+        if not os.path.isdir(self.root):
+            return []
+        found = []
+        for strategy in sorted(os.listdir(self.root)):
+            if strategies is not None and strategy not in strategies:
+                continue
+            strategy_dir = os.path.join(self.root, strategy)
+            if not os.path.isdir(strategy_dir):
+                continue
+            for name in os.listdir(strategy_dir):
+                if not name.endswith('.npz'):
+                    continue
+                date = name[:-len('.npz')]
+                if (start is not None and date < start) or (end is not None and date > end):
+                    continue
+                found.append((date, strategy, os.path.join(strategy_dir, name)))
+        return sorted(found)
+
+    def iter_batches(self, start=None, end=None, strategies=None):
+        # One frame per stored day, with the strategy as a column
+        for date, strategy, path in self.parts(start, end, strategies):
+            df = read_frame(path)
+            df.insert(0, 'strategy', strategy)
+            yield df
+
+    def read(self, start=None, end=None, strategies=None):
+        batches = [df for df in self.iter_batches(start, end, strategies) if not df.empty]
+        if not batches:
+            return typed_trades(None).assign(strategy=pd.Series(dtype=object))[['strategy'] + TRADE_COLUMNS]
+        return pd.concat(batches, ignore_index=True)
+
+    def to_csv(self, path, start=None, end=None, strategies=None, include_strategy=True):
+        # Streams the selected days into one CSV; returns the number of trades
+        rows = 0
+        header = True
+        with open(path, 'w', newline='') as f:
+            for df in self.iter_batches(start, end, strategies):
+                if not include_strategy:
+                    df = df.drop(columns='strategy')
+                if header:
+                    df.to_csv(f, index=False)
+                    header = False
+                elif not df.empty:
+                    df.to_csv(f, index=False, header=False)
+                rows += len(df)
+            if header:
+                columns = TRADE_COLUMNS if not include_strategy else ['strategy'] + TRADE_COLUMNS
+                csv.writer(f).writerow(columns)
+        return rows
@@ -0,0 +1,83 @@
+# weekly.py
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from backtest import data_loader
+from price_index import PriceIndex
+from storage import is_not_found
+
+
+def parse_expiry(expiry):
+    return datetime.strptime(expiry.replace('Z', ''), "%Y-%m-%dT%H:%M:%S.%f")
+
+
+class DayStore:
+    # Flattened option chains by date, shared between expiry weeks so a day
+    # is loaded once however many entry dates cover it. Keeps the most
+    # recently used `max_days` in memory; a DayCache behind it keeps the rest
+    # on disk. With `compact` the days are held as chain.compact_chain frames.
+    # Days whose object does not exist are remembered as missing; any other
+    # failure is raised as is and the day is tried again on the next get.
+    def __init__(self, storage=None, cache=None, max_days=16, compact=False):
+        self.storage = storage
+        self.cache = cache
+        self.max_days = max_days
+        self.compact = compact
+        self.days = OrderedDict()
+        self.missing = {}
+
+    def get(self, date_str):
+        if date_str in self.days:
+            self.days.move_to_end(date_str)
+            return self.days[date_str]
+        if date_str in self.missing:
+            raise FileNotFoundError(f"No option chain for {date_str}") from self.missing[date_str]
+        try:
+            df = data_loader(date_str, cache=self.cache, storage=self.storage, compact=self.compact).load_data()
+        except Exception as e:
+            if is_not_found(e):
+                self.missing[date_str] = e
+            raise
+        self.days[date_str] = df
+        while len(self.days) > self.max_days:
+            self.days.popitem(last=False)
+        return df
+
+
+class ExpiryWeek:
+    def __init__(self, entry_date, expiry, data, index, missing):
+        self.entry_date = entry_date
+        self.expiry = expiry
+        self.data = data
+        self.index = index
+        # {date: error} for days between entry and expiry that could not be loaded
+        self.missing = missing
+
+
+class WeeklyAssembler:
+    def __init__(self, store):
+        self.store = store
+
+    def assemble(self, entry_date):
+        # Chain from entry_date through its expiry: day chunks are collected
+        # and concatenated once, then indexed for price lookups.
+        entry_date = datetime(entry_date.year, entry_date.month, entry_date.day)
+        first = self.store.get(entry_date.strftime('%Y-%m-%d'))
+        expiry = parse_expiry(first['expiry'].iloc[0])
+
+        chunks = [first]
+        missing = {}
+        current = entry_date + timedelta(days=1)
+        while current <= expiry:
+            date_str = current.strftime('%Y-%m-%d')
+            try:
+                chunks.append(self.store.get(date_str))
+            except Exception as e:
+                missing[date_str] = e
+            current += timedelta(days=1)
+
+        data = pd.concat(chunks, ignore_index=True)
+        return ExpiryWeek(entry_date, expiry, data, PriceIndex.from_frame(data), missing)